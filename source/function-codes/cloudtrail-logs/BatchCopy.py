@@ -1,4 +1,5 @@
 import json
+import re
 from urllib import parse
 import cfnresponse
 import logging
@@ -31,7 +32,8 @@ query_function_name = str(os.environ['query_function'])
 my_sns_topic_arn = str(os.environ['sns_topic_arn'])     
 
 # Other Variables
-function_invocation_type = 'RequestResponse'            
+# The query function waits for its queries, it is invoked asynchronously
+function_invocation_type = 'Event'            
 
 # Specify variables #############################
 
@@ -70,6 +72,36 @@ def send_sns_message(sns_topic_arn, sns_message):
         logger.error(e)
 
 
+# Embedded Metrics Function, set metrics_file to write the records to a local file
+metrics_namespace = 'AWSSupportTroubleshootingToolForS3'
+my_metrics_file = os.environ.get('metrics_file')
+
+
+def put_metrics(dimensions, metrics, properties=None):
+    # metrics maps each metric name to a (value, unit) pair, metrics without a value are left out
+    metrics = {name: metric for name, metric in metrics.items() if metric[0] is not None}
+    emf_record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': metrics_namespace,
+                'Dimensions': [list(dimensions.keys())],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in metrics.items()]
+            }]
+        },
+        'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    }
+    emf_record.update(properties or {})
+    emf_record.update(dimensions)
+    emf_record.update({name: value for name, (value, unit) in metrics.items()})
+    emf_line = json.dumps(emf_record, default=str)
+    if my_metrics_file:
+        with open(my_metrics_file, 'a') as metrics_file:
+            metrics_file.write(f'{emf_line}\n')
+    else:
+        print(emf_line, flush=True)
+
+
 # Function to Invoke Copy Function Worker
 def invoke_function(function_name, invocation_type, payload):
     invoke_response = lambdaClient.invoke(
@@ -78,15 +110,36 @@ def invoke_function(function_name, invocation_type, payload):
         Payload=payload,
 
     )
-    response_payload = json.loads(invoke_response['Payload'].read().decode("utf-8"))
-    return response_payload                 
+    response_payload = invoke_response['Payload'].read().decode("utf-8")
+    return json.loads(response_payload) if response_payload else invoke_response.get('StatusCode')                 
+
+
+# Split a comma separated list of AWS Regions, an empty list selects all Regions
+def get_log_regions(log_regions_string):
+    return [log_region.strip() for log_region in (log_regions_string or '').split(',') if log_region.strip()]
+
+
+# Normalize the log prefix to the trail prefix that ends with CloudTrail/
+# An empty prefix is a trail delivering to the bucket root, and a prefix ending with a Region folder selects that Region
+def get_trail_prefix(log_prefix, log_regions):
+    if not log_prefix:
+        return f'AWSLogs/{accountId}/CloudTrail/', log_regions
+    trail_prefix, separator, log_region = log_prefix.partition('/CloudTrail/')
+    log_region = log_region.strip('/')
+    if log_region and not log_regions and re.fullmatch('[a-z]{2}(-[a-z]+)+-[0-9]', log_region):
+        log_regions = [log_region]
+    return f'{trail_prefix}/CloudTrail/', log_regions
 
 
 # S3 Batch Copy Function
+# The copy keeps the key of each log object, so the CloudTrail layout <prefix><region>/YYYY/MM/DD/ is kept under the
+# copy location and the Glue table can prune the copied logs by Region and day with partition projection.
+# When Regions are specified, only the logs of these Regions are copied.
 
-def s3_batch_ops_copy_manifest_generator(target_key_prefix, source_bucket_arn, source_bucket_prefix, obj_created_before_string, obj_created_after_string):
+def s3_batch_ops_copy_manifest_generator(target_key_prefix, source_bucket_arn, source_bucket_prefix, obj_created_before_string, obj_created_after_string, log_regions):
     # Convert input date to datetime format
     debug_start_days = datetime.strptime(obj_created_after_string, '%Y-%m-%d')
+    my_stage_start = time.monotonic()
     # Initiate Batch Operations Request parameters          
     my_request_kwargs = {
         'AccountId': accountId,
@@ -136,10 +189,10 @@ def s3_batch_ops_copy_manifest_generator(target_key_prefix, source_bucket_arn, s
     }
 
     logger.info(my_request_kwargs)
-    # Include Source Bucket Prefix if specified
+    # Include Source Bucket Prefix if specified, one prefix per Region when Regions are specified
     if source_bucket_prefix:
         my_request_kwargs['ManifestGenerator']['S3JobManifestGenerator']['Filter']['KeyNameConstraint'] = {
-            'MatchAnyPrefix': [source_bucket_prefix, ]}
+            'MatchAnyPrefix': [f'{source_bucket_prefix}{log_region}/' for log_region in log_regions] or [source_bucket_prefix, ]}
         logger.info(f"Source Prefix is present, modified request kwargs to: {my_request_kwargs}")
 
     # Include Created before time if specified
@@ -154,12 +207,22 @@ def s3_batch_ops_copy_manifest_generator(target_key_prefix, source_bucket_arn, s
         logger.info(f"JobID is: {response['JobId']}")
         logger.info(f"S3 RequestID is: {response['ResponseMetadata']['RequestId']}")
         logger.info(f"S3 Extended RequestID is:{response['ResponseMetadata']['HostId']}")
+        put_metrics({'Stage': 'BatchCopy'}, {
+            'CopyJobsCreated': (1, 'Count'),
+            'StageDuration': ((time.monotonic() - my_stage_start) * 1000, 'Milliseconds')
+        }, {'JobId': response['JobId']})
         return response['JobId']
     except ClientError as e:
         logger.error(e)
         raise e
 
 
+# The window is [created after, created before), it must hold at least one day for the copy and the analyses
+def check_log_window(log_created_after, log_created_before):
+    if log_created_before and log_created_before <= log_created_after:
+        raise ValueError(f"LogObjectCreatedBefore ({log_created_before}) must be later than LogObjectCreatedAfter ({log_created_after})")
+
+
 def lambda_handler(event, context):
     logger.info(f'Event detail is: {event}')
     my_copy_destination = None
@@ -169,7 +232,18 @@ def lambda_handler(event, context):
     my_log_type = event.get('ResourceProperties').get('your_log_type')
     my_log_created_before = event.get('ResourceProperties').get('log_created_before')
     my_log_created_after = event.get('ResourceProperties').get('log_created_after')                           
+    my_log_prefix, my_log_regions = get_trail_prefix(my_log_prefix, get_log_regions(event.get('ResourceProperties').get('log_regions')))
     logger.info(f"my_log_prefix is {my_log_prefix}")
+    # Reject an empty window before anything is copied or queried
+    if event.get('RequestType') in ['Create', 'Update']:
+        try:
+            check_log_window(my_log_created_after, my_log_created_before)
+        except ValueError as e:
+            logger.error(e)
+            responseData = {}
+            responseData['message'] = str(e)
+            cfnresponse.send(event, context, cfnresponse.FAILED, responseData, reason=str(e))
+            return
     
     # Set Copy destination depending on Log Type
     if my_log_type == 'CloudTrail':
@@ -190,7 +264,7 @@ def lambda_handler(event, context):
             # sleep is included intentionally
             # nosemgrep: arbitrary-sleep
             time.sleep(150)  # nosemgrep: arbitrary-sleep
-            s3_batch_ops_copy_manifest_generator(my_copy_destination, my_logs_bucket_arn, my_log_prefix, my_log_created_before, my_log_created_after)
+            s3_batch_ops_copy_manifest_generator(my_copy_destination, my_logs_bucket_arn, my_log_prefix, my_log_created_before, my_log_created_after, my_log_regions)
             responseData = {}
             responseData['message'] = "Successful"
             logger.info(f"Sending Invocation Response {responseData['message']} to Cloudformation Service")
@@ -210,6 +284,7 @@ def lambda_handler(event, context):
         previous_my_log_prefix = event.get('OldResourceProperties').get('your_s3_log_prefix')        
         previous_my_log_created_after = event.get('OldResourceProperties').get('log_created_after')
         previous_my_log_created_before = event.get('OldResourceProperties').get('log_created_before')
+        previous_my_log_prefix, previous_my_log_regions = get_trail_prefix(previous_my_log_prefix, get_log_regions(event.get('OldResourceProperties').get('log_regions')))
         logger.info(f"previous_my_log_created_after is: {previous_my_log_created_after}")
         logger.info(f"previous_my_log_created_before is: {previous_my_log_created_before}")
         # Convert from string to datetime and selectively perform a copy
@@ -218,12 +293,12 @@ def lambda_handler(event, context):
         old_after_date = datetime.strptime(previous_my_log_created_after, '%Y-%m-%d')
         old_before_date = datetime.strptime(previous_my_log_created_before, '%Y-%m-%d')
         # Initiate Batch Operations copy only if the logs files are not already included in previous copy
-        if current_after_date < old_after_date or current_before_date > old_before_date or my_logs_bucket != previous_my_logs_bucket or my_log_prefix != previous_my_log_prefix :
+        if current_after_date < old_after_date or current_before_date > old_before_date or my_logs_bucket != previous_my_logs_bucket or my_log_prefix != previous_my_log_prefix or my_log_regions != previous_my_log_regions :
             # Initiate Batch Operations copy
-            logger.info(f"The current CreatedAfterDate Or CreatedBeforeDate or  S3 Logs Bucket or S3 Logs Prefix has been modified. Now Initiate BOPs Job...")
+            logger.info(f"The current CreatedAfterDate Or CreatedBeforeDate or  S3 Logs Bucket or S3 Logs Prefix or Regions has been modified. Now Initiate BOPs Job...")
             try:  
                 logger.info("Stack event is Create or Update. Initiating Logs copy to SupportToolBucket...")
-                s3_batch_ops_copy_manifest_generator(my_copy_destination, my_logs_bucket_arn, my_log_prefix, my_log_created_before, my_log_created_after)
+                s3_batch_ops_copy_manifest_generator(my_copy_destination, my_logs_bucket_arn, my_log_prefix, my_log_created_before, my_log_created_after, my_log_regions)
                 responseData = {}
                 responseData['message'] = "Successful"
                 logger.info(f"Sending Invocation Response {responseData['message']} to Cloudformation Service")
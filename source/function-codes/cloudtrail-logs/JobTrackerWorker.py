@@ -2,6 +2,7 @@ import json
 import boto3
 import botocore
 import os
+import time
 import logging
 import datetime
 import uuid
@@ -17,11 +18,12 @@ logger.setLevel('INFO')
 # Lambda Environment Variables
 accountId = str(os.environ['my_account_id'])
 my_region = str(os.environ['AWS_REGION'])
-query_function_name = str(os.environ['query_function'])
+conversion_function_name = str(os.environ['conversion_function'])
 my_sns_topic_arn = str(os.environ['sns_topic_arn'])     
 
 # Other Variables
-function_invocation_type = 'RequestResponse'          
+# The conversion function waits for its queries, it is invoked asynchronously
+function_invocation_type = 'Event'          
 
 # Create Service Clients
 s3ControlClient = boto3.client('s3control', region_name=my_region)
@@ -49,6 +51,36 @@ def send_sns_message(sns_topic_arn, sns_message):
         logger.error(e)
 
 
+# Embedded Metrics Function, set metrics_file to write the records to a local file
+metrics_namespace = 'AWSSupportTroubleshootingToolForS3'
+my_metrics_file = os.environ.get('metrics_file')
+
+
+def put_metrics(dimensions, metrics, properties=None):
+    # metrics maps each metric name to a (value, unit) pair, metrics without a value are left out
+    metrics = {name: metric for name, metric in metrics.items() if metric[0] is not None}
+    emf_record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': metrics_namespace,
+                'Dimensions': [list(dimensions.keys())],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in metrics.items()]
+            }]
+        },
+        'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    }
+    emf_record.update(properties or {})
+    emf_record.update(dimensions)
+    emf_record.update({name: value for name, (value, unit) in metrics.items()})
+    emf_line = json.dumps(emf_record, default=str)
+    if my_metrics_file:
+        with open(my_metrics_file, 'a') as metrics_file:
+            metrics_file.write(f'{emf_line}\n')
+    else:
+        print(emf_line, flush=True)
+
+
 # Function to Invoke Copy Function Worker
 def invoke_function(function_name, invocation_type, payload):
     invoke_response = lambdaClient.invoke(
@@ -57,8 +89,8 @@ def invoke_function(function_name, invocation_type, payload):
         Payload=payload,
 
     )
-    response_payload = json.loads(invoke_response['Payload'].read().decode("utf-8"))
-    return response_payload        
+    response_payload = invoke_response['Payload'].read().decode("utf-8")
+    return json.loads(response_payload) if response_payload else invoke_response.get('StatusCode')        
 
 
 # Get S3 Batch Operations Tag
@@ -78,6 +110,17 @@ def get_job_tagging(bops_job_id):
         return tag_key, tag_value
 
 
+# Copy Job Metrics, task counts, failure rate and duration of a copy job or of a run of copy jobs
+def put_copy_metrics(stage, number_of_tasks, tasks_succeeded, tasks_failed, creation_time, termination_time, properties):
+    put_metrics({'Stage': stage}, {
+        'TasksTotal': (number_of_tasks, 'Count'),
+        'TasksSucceeded': (tasks_succeeded, 'Count'),
+        'TasksFailed': (tasks_failed, 'Count'),
+        'TaskFailureRate': (100.0 * tasks_failed / number_of_tasks if number_of_tasks else 0.0, 'Percent'),
+        'StageDuration': ((termination_time - creation_time).total_seconds() if creation_time and termination_time else None, 'Seconds')
+    }, properties)
+
+
 def lambda_handler(event, context):
     logger.info(event)
     try:
@@ -104,6 +147,9 @@ def lambda_handler(event, context):
         logger.info(f'Number of Tasks: {number_of_tasks}')
         logger.info(f'Tasks_succeeded: {tasks_succeeded}')
         logger.info(f'Tasks_failed: {tasks_failed}')
+        # Copy job reports are only written by the copy jobs of the support tool
+        if job_operation == 'S3PutObjectCopy':
+            put_copy_metrics('CopyJob', number_of_tasks, tasks_succeeded, tasks_failed, my_job_details.get('CreationTime'), my_job_details.get('TerminationDate'), {'JobId': job_id, 'JobStatus': job_status})
 
         # Send a notification to the user if Batch Operations Job fails
         if job_status == 'Failed':
@@ -127,17 +173,13 @@ def lambda_handler(event, context):
                     if job_tag_key == 'job-created-by' and job_tag_value == 'aws-support-troubleshooting-tool-for-s3' and job_status == 'Complete':
                         my_sns_message = f'Copy Job {job_id} Completed: {tasks_failed} failed out of {number_of_tasks}. Please check the Batch Operations Job JobID {job_id} in the Amazon S3 Console for more details.'
                         logger.info(f"{my_sns_message}")
-                        # Start Athena Query Function Invoke
+                        # Start Parquet Conversion Function Invoke, it starts the Athena Query once the S3 events are converted
                         # Generate Payload for Invocation:
                         my_payload = {"my_etag": etag}
                         my_payload_json = json.dumps(my_payload)                                  
                         send_sns_message(my_sns_topic_arn, my_sns_message)
-                        # Send notification for Athena query start
-                        my_sns_message = f'Starting Athena Query'
-                        logger.info(f"{my_sns_message}")
-                        send_sns_message(my_sns_topic_arn, my_sns_message)
-                        invoke_query_funct = invoke_function(query_function_name, function_invocation_type, my_payload_json)
-                        logger.info(invoke_query_funct)                               
+                        invoke_conversion_funct = invoke_function(conversion_function_name, function_invocation_type, my_payload_json)
+                        logger.info(invoke_conversion_funct)                               
 
                     elif job_tag_key == 'job-created-by' and job_tag_value == 'aws-support-troubleshooting-tool-for-s3' and job_status == 'Failed':
                         my_sns_message = f'S3 Logs Copy Job {job_id} failed, please check the Batch Operations Job JobID {job_id} in the Amazon S3 Console for more details!'
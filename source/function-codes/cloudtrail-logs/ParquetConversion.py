@@ -0,0 +1,297 @@
+import json
+from botocore.exceptions import ClientError
+import logging
+import os
+import datetime
+import re
+import time
+import uuid
+import boto3
+
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel('INFO')
+
+# Enable Debug Logging
+# boto3.set_stream_logger("")
+
+
+# Define Environmental Variables
+my_region = str(os.environ['AWS_REGION'])
+my_glue_db = str(os.environ['glue_db'])
+my_glue_raw_tbl = str(os.environ['glue_raw_tbl'])
+my_glue_tbl = str(os.environ['glue_tbl'])
+my_workgroup_name = str(os.environ['etl_workgroup_name'])
+my_tool_bucket = str(os.environ['tool_bucket'])
+my_parquet_location = str(os.environ['parquet_location'])
+my_query_logs_before = str(os.environ['query_logs_before'])
+my_query_logs_after = str(os.environ['query_logs_after'])
+my_log_regions = [log_region.strip() for log_region in str(os.environ['log_regions']).split(',') if log_region.strip()]
+query_function_name = str(os.environ['query_function'])
+my_sns_topic_arn = str(os.environ['sns_topic_arn'])
+
+# Other Variables
+function_invocation_type_async = 'Event'
+# Athena INSERT INTO writes at most 100 partitions per query
+max_partitions_per_query = 100
+query_poll_interval_seconds = 5
+# Hand the remaining days over to a new invocation when less time than this is left
+continuation_margin_millis = 120000
+# Region folders of the CloudTrail key layout, other folders under the copied CloudTrail prefix are not read
+region_folder_pattern = re.compile(r'^[a-z]{2}(-[a-z]+)+-[0-9]+$')
+
+logger.info(f'my_query_logs_before is: {my_query_logs_before}')
+logger.info(f'my_query_logs_after is: {my_query_logs_after}')
+
+
+# Set Service Client
+athena_client = boto3.client('athena', region_name=my_region)
+s3Client = boto3.client('s3', region_name=my_region)
+glueClient = boto3.client('glue', region_name=my_region)
+lambdaClient = boto3.client('lambda', region_name=my_region)
+sns = boto3.client('sns', region_name=my_region)
+
+
+# SNS Message Function
+def send_sns_message(sns_topic_arn, sns_message):
+    logger.info("Sending SNS Notification Message......")
+    sns_subject = 'Notification from AWS Support Troubleshooting Tool'
+    try:
+        response = sns.publish(TopicArn=sns_topic_arn, Message=sns_message, Subject=sns_subject)
+    except ClientError as e:
+        logger.error(e)
+
+
+# Embedded Metrics Function, set metrics_file to write the records to a local file
+metrics_namespace = 'AWSSupportTroubleshootingToolForS3'
+my_metrics_file = os.environ.get('metrics_file')
+
+
+def put_metrics(dimensions, metrics, properties=None):
+    # metrics maps each metric name to a (value, unit) pair, metrics without a value are left out
+    metrics = {name: metric for name, metric in metrics.items() if metric[0] is not None}
+    emf_record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': metrics_namespace,
+                'Dimensions': [list(dimensions.keys())],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in metrics.items()]
+            }]
+        },
+        'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    }
+    emf_record.update(properties or {})
+    emf_record.update(dimensions)
+    emf_record.update({name: value for name, (value, unit) in metrics.items()})
+    emf_line = json.dumps(emf_record, default=str)
+    if my_metrics_file:
+        with open(my_metrics_file, 'a') as metrics_file:
+            metrics_file.write(f'{emf_line}\n')
+    else:
+        print(emf_line, flush=True)
+
+
+# Function to Invoke Lambda Functions
+def invoke_function(function_name, invocation_type, payload):
+    invoke_response = lambdaClient.invoke(
+        FunctionName=function_name,
+        InvocationType=invocation_type,
+        Payload=payload,
+
+    )
+    response_payload = invoke_response['Payload'].read().decode("utf-8")
+    return json.loads(response_payload) if response_payload else invoke_response.get('StatusCode')
+
+
+# Return the dt partition values (YYYY-MM-DD) of the query window
+def get_partition_days(query_logs_after, query_logs_before):
+    partition_days = []
+    partition_day = datetime.datetime.strptime(query_logs_after, '%Y-%m-%d')
+    last_day = datetime.datetime.strptime(query_logs_before, '%Y-%m-%d')
+    while partition_day < last_day:
+        partition_days.append(partition_day.strftime('%Y-%m-%d'))
+        partition_day = partition_day + datetime.timedelta(days=1)
+    return partition_days
+
+
+# Remove the Parquet data of the given days, so converting the same days again does not duplicate rows
+def delete_partitions(partition_days):
+    paginator = s3Client.get_paginator('list_objects_v2')
+    for partition_day in partition_days:
+        partition_prefix = f'{my_parquet_location}/dt={partition_day}/'
+        for page in paginator.paginate(Bucket=my_tool_bucket, Prefix=partition_prefix):
+            objects_to_delete = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if objects_to_delete:
+                s3Client.delete_objects(Bucket=my_tool_bucket, Delete={'Objects': objects_to_delete, 'Quiet': True})
+    # BatchDeletePartition accepts up to 25 partitions per call
+    for i in range(0, len(partition_days), 25):
+        response = glueClient.batch_delete_partition(
+            DatabaseName=my_glue_db,
+            TableName=my_glue_tbl,
+            PartitionsToDelete=[{'Values': [partition_day]} for partition_day in partition_days[i:i + 25]]
+        )
+        for error in response.get('Errors', []):
+            if error.get('ErrorDetail', {}).get('ErrorCode') != 'EntityNotFoundException':
+                logger.error(error)
+
+
+# Regions of the copied logs, the CloudTrailRegions parameter or else the Region folders under the copied CloudTrail
+# prefix, so a Region that is new or opted in later is read without being listed anywhere
+def get_log_regions():
+    if my_log_regions:
+        return my_log_regions
+    location_template = glueClient.get_table(DatabaseName=my_glue_db, Name=my_glue_raw_tbl)['Table']['Parameters']['storage.location.template']
+    location_bucket, location_key = location_template.replace('s3://', '', 1).split('/', 1)
+    region_prefix = location_key.split('${region}')[0]
+    log_regions = []
+    paginator = s3Client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=location_bucket, Prefix=region_prefix, Delimiter='/'):
+        for common_prefix in page.get('CommonPrefixes', []):
+            region_folder = common_prefix['Prefix'][len(region_prefix):].rstrip('/')
+            if region_folder_pattern.match(region_folder):
+                log_regions.append(region_folder)
+    logger.info(f'Regions of the copied logs under s3://{location_bucket}/{region_prefix}: {log_regions}')
+    return log_regions
+
+
+# Partition predicates of the raw table, the region and logdate partitions are projected from the CloudTrail key layout.
+# The region partition is injected, every query names the Regions it reads.
+# A log file can be delivered on the day after its last event, so the delivery day after the window is read as well.
+def build_partition_predicates(first_day, next_day, log_regions):
+    region_list = ', '.join(f"'{log_region}'" for log_region in log_regions)
+    return [
+        f"logdate BETWEEN '{first_day.strftime('%Y/%m/%d')}' AND '{next_day.strftime('%Y/%m/%d')}'",
+        f'region IN ({region_list})'
+    ]
+
+
+# Flatten the S3 events of the given days into the Parquet table. The bucket, key, identity and bytes
+# are extracted from the JSON fields once here, and eventtime is stored as a timestamp
+def build_insert_query(partition_days, log_regions):
+    first_day = datetime.datetime.strptime(partition_days[0], '%Y-%m-%d')
+    next_day = datetime.datetime.strptime(partition_days[-1], '%Y-%m-%d') + datetime.timedelta(days=1)
+    partition_predicates = build_partition_predicates(first_day, next_day, log_regions)
+    return f"""
+    INSERT INTO "{my_glue_db}"."{my_glue_tbl}"
+    SELECT eventtime, eventsource, eventname, awsregion, sourceipaddress, useragent, userarn, accountid, useridentitytype, errorcode, errormessage, bucketname, objectkey, bytestransferredout, requestid, eventid, readonly, requestparameters, additionaleventdata,
+    date_format(eventtime, '%Y-%m-%d') AS dt
+    FROM (
+        SELECT CAST(try(from_iso8601_timestamp(eventtime)) AT TIME ZONE 'UTC' AS timestamp) AS eventtime,
+        eventsource, eventname, awsregion, sourceipaddress, useragent,
+        useridentity.arn AS userarn,
+        useridentity.accountid AS accountid,
+        useridentity.type AS useridentitytype,
+        errorcode, errormessage,
+        json_extract_scalar(requestparameters, '$.bucketName') AS bucketname,
+        json_extract_scalar(requestparameters, '$.key') AS objectkey,
+        CAST(try_cast(json_extract_scalar(additionaleventdata, '$.bytesTransferredOut') AS double) AS bigint) AS bytestransferredout,
+        requestid, eventid, readonly, requestparameters, additionaleventdata
+        FROM "{my_glue_db}"."{my_glue_raw_tbl}"
+        WHERE {' AND '.join(partition_predicates)}
+        AND eventsource = 's3.amazonaws.com'
+        AND eventtime >= '{first_day.strftime('%Y-%m-%d')}T00:00:00Z'
+        AND eventtime < '{next_day.strftime('%Y-%m-%d')}T00:00:00Z'
+    )
+    WHERE eventtime IS NOT NULL ;
+    """
+
+
+# Start the conversion query of a chunk of days
+def start_conversion_query(partition_days, log_regions):
+    delete_partitions(partition_days)
+    # A new token per start, the days were just deleted so a repeated start has to rewrite them
+    return start_query_execution(build_insert_query(partition_days, log_regions), my_glue_db, my_workgroup_name, str(uuid.uuid4()))
+
+
+def start_query_execution(query_string, athena_db, workgroup_name, job_request_token):
+    logger.info(f'Starting Athena query...... with query string: {query_string}')
+    execute_query = athena_client.start_query_execution(
+        QueryString=query_string,
+        QueryExecutionContext={
+            'Database': athena_db
+        },
+        WorkGroup=workgroup_name,
+        ClientRequestToken=job_request_token,
+    )
+    logger.info(f'Query Started: {execute_query}')
+    return execute_query['QueryExecutionId']
+
+
+# Wait for an Athena query to finish and return its final state, or None when the invocation runs out of time
+def wait_for_query(query_execution_id, context):
+    while context.get_remaining_time_in_millis() > continuation_margin_millis:
+        query_execution = athena_client.get_query_execution(QueryExecutionId=query_execution_id).get('QueryExecution')
+        query_status = query_execution.get('Status')
+        if query_status.get('State') in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
+            logger.info(f'Query {query_execution_id} finished: {query_status}')
+            query_statistics = query_execution.get('Statistics', {})
+            put_metrics({'Stage': 'ParquetConversion'}, {
+                'DataScannedInBytes': (query_statistics.get('DataScannedInBytes'), 'Bytes'),
+                'EngineExecutionTime': (query_statistics.get('EngineExecutionTimeInMillis'), 'Milliseconds'),
+                'QueryQueueTime': (query_statistics.get('QueryQueueTimeInMillis'), 'Milliseconds')
+            }, {'QueryExecutionId': query_execution_id, 'State': query_status.get('State')})
+            return query_status.get('State'), query_status.get('StateChangeReason')
+        time.sleep(query_poll_interval_seconds)
+    return None, None
+
+
+# Continue the conversion in a new invocation with the days that are left
+def continue_conversion(context, request_token, partition_days, pending_query_id):
+    logger.info(f'Continuing conversion of {len(partition_days)} days in a new invocation')
+    my_payload = {"my_etag": request_token, "partition_days": partition_days, "pending_query_id": pending_query_id}
+    invoke_function(context.function_name, function_invocation_type_async, json.dumps(my_payload))
+    return {
+        'statusCode': 202,
+        'body': json.dumps('Conversion continued in a new invocation')
+    }
+
+
+def lambda_handler(event, context):
+    logger.info(event)
+    # Use Etag to prevent duplicate invocation
+    my_request_token = event.get('my_etag')
+    logger.info(f'Initiating Main Function...')
+
+    try:
+        # A continued invocation carries the days that are still to be converted
+        my_partition_days = event.get('partition_days')
+        if my_partition_days is None:
+            my_partition_days = get_partition_days(my_query_logs_after, my_query_logs_before)
+            send_sns_message(my_sns_topic_arn, f'Converting {len(my_partition_days)} days of copied CloudTrail S3 events to Parquet')
+
+        my_pending_query_id = event.get('pending_query_id')
+        my_query_regions = get_log_regions() if my_partition_days else []
+        if my_partition_days and not my_query_regions:
+            raise RuntimeError('No Region folders of copied CloudTrail logs were found, check the log prefix and the copy job report')
+        while my_partition_days:
+            my_chunk_days = my_partition_days[:max_partitions_per_query]
+            if my_pending_query_id is None:
+                if context.get_remaining_time_in_millis() < continuation_margin_millis:
+                    return continue_conversion(context, my_request_token, my_partition_days, None)
+                my_pending_query_id = start_conversion_query(my_chunk_days, my_query_regions)
+            my_query_state, my_state_reason = wait_for_query(my_pending_query_id, context)
+            if my_query_state is None:
+                return continue_conversion(context, my_request_token, my_partition_days, my_pending_query_id)
+            if my_query_state != 'SUCCEEDED':
+                raise RuntimeError(f'Conversion query {my_pending_query_id} {my_query_state}: {my_state_reason}')
+            put_metrics({'Stage': 'ParquetConversion'}, {'DaysConverted': (len(my_chunk_days), 'Count')}, {'RequestToken': my_request_token})
+            my_pending_query_id = None
+            my_partition_days = my_partition_days[max_partitions_per_query:]
+
+        # Conversion is complete, start the Athena analysis on the Parquet table
+        my_sns_message = f'Starting Athena Query'
+        logger.info(f"{my_sns_message}")
+        send_sns_message(my_sns_topic_arn, my_sns_message)
+        invoke_query_funct = invoke_function(query_function_name, function_invocation_type_async, json.dumps({"my_etag": my_request_token}))
+        logger.info(invoke_query_funct)
+    except Exception as e:
+        logger.error(e)
+        send_sns_message(my_sns_topic_arn, f'Parquet conversion of the copied logs failed: {e}')
+        raise
+    else:
+        return {
+            'statusCode': 200,
+            'body': json.dumps('Successful Invocation!')
+        }
@@ -1,8 +1,14 @@
+import csv
 import json
 from botocore.exceptions import ClientError
 import logging
 import os
+import time
 import datetime
+import hashlib
+import math
+import re
+import zlib
 import boto3
 from urllib import parse
 
@@ -19,8 +25,32 @@ logger.setLevel('INFO')
 my_region = str(os.environ['AWS_REGION'])
 my_sns_topic_arn = str(os.environ['sns_topic_arn'])
 
+# Other Variables
+# Runtime statistics reported for every query
+query_statistics_keys = ['EngineExecutionTimeInMillis', 'QueryQueueTimeInMillis', 'TotalExecutionTimeInMillis', 'DataScannedInBytes']
+# Preview queries read a sample of the logs, the sample percent is read from the query text
+preview_sample_pattern = re.compile(r'TABLESAMPLE SYSTEM \(([0-9.]+)\)')
+# Report columns summarized by the streaming summarizer, columns missing from a report are skipped
+summary_top_columns = ['eventname', 'errorcode', 'userarn', 'objectkey']
+summary_distinct_columns = ['userarn', 'sourceipaddress']
+summary_time_column = 'eventtime'
+# The report is read with ranged GETs of this size, memory use does not depend on the report size
+summary_chunk_bytes = 4 * 1024 * 1024
+# Counters kept per top column, values listed in the summary and in the notification
+summary_top_capacity = 100
+summary_top_values = 20
+notification_top_values = 5
+# HyperLogLog precision, 2^12 registers give a standard error of about 1.6%
+hll_precision = 12
+# Stop summarizing when less time than this is left, the summary is then marked as partial
+summary_margin_millis = 30000
+# Parquet and gzip JSON reports are written by UNLOAD, the query manifest listing the report files notifies this function
+unload_manifest_suffix = '-manifest.csv'
+
 # Set Service Client
 sns = boto3.client('sns', region_name=my_region)
+s3Client = boto3.client('s3', region_name=my_region)
+athena_client = boto3.client('athena', region_name=my_region)
 
 # SNS Message Function
 def send_sns_message(sns_topic_arn, sns_message):
@@ -32,6 +62,240 @@ def send_sns_message(sns_topic_arn, sns_message):
         logger.error(e)            
 
 
+# Embedded Metrics Function, set metrics_file to write the records to a local file
+metrics_namespace = 'AWSSupportTroubleshootingToolForS3'
+my_metrics_file = os.environ.get('metrics_file')
+
+
+def put_metrics(dimensions, metrics, properties=None):
+    # metrics maps each metric name to a (value, unit) pair, metrics without a value are left out
+    metrics = {name: metric for name, metric in metrics.items() if metric[0] is not None}
+    emf_record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': metrics_namespace,
+                'Dimensions': [list(dimensions.keys())],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in metrics.items()]
+            }]
+        },
+        'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    }
+    emf_record.update(properties or {})
+    emf_record.update(dimensions)
+    emf_record.update({name: value for name, (value, unit) in metrics.items()})
+    emf_line = json.dumps(emf_record, default=str)
+    if my_metrics_file:
+        with open(my_metrics_file, 'a') as metrics_file:
+            metrics_file.write(f'{emf_line}\n')
+    else:
+        print(emf_line, flush=True)
+
+
+# Return the state and statistics of the query that wrote a report. They are stored next to the report by the
+# Athena Query function once it sees the query finish, until then they are read from Athena.
+def get_query_statistics(s3Bucket, s3Key):
+    try:
+        stats_object = s3Client.get_object(Bucket=s3Bucket, Key=f'{s3Key}.stats.json')
+        return json.loads(stats_object['Body'].read())
+    except ClientError as e:
+        logger.info(f'No stored query statistics for {s3Key}: {e}')
+    # Athena names the report and the UNLOAD manifest after the query execution id
+    report_name = s3Key.rsplit('/', 1)[-1]
+    query_execution_id = report_name[:-len(unload_manifest_suffix)] if report_name.endswith(unload_manifest_suffix) else report_name.split('.')[0]
+    try:
+        query_execution = athena_client.get_query_execution(QueryExecutionId=query_execution_id).get('QueryExecution')
+    except ClientError as e:
+        logger.error(e)
+        return None
+    query_statistics = query_execution.get('Statistics', {})
+    preview_sample = preview_sample_pattern.search(query_execution.get('Query', ''))
+    return {
+        'query_execution_id': query_execution_id,
+        'state': query_execution.get('Status', {}).get('State'),
+        'statistics': {key: query_statistics.get(key) for key in query_statistics_keys},
+        'sample_percent': float(preview_sample.group(1)) if preview_sample else None
+    }
+
+
+# Query statistics line of the notification
+def format_query_statistics(query_statistics):
+    statistics = query_statistics.get('statistics') or {}
+    return (f"Query {query_statistics.get('query_execution_id')} {query_statistics.get('state')}: "
+            f"queued {statistics.get('QueryQueueTimeInMillis')} ms, "
+            f"engine execution {statistics.get('EngineExecutionTimeInMillis')} ms, "
+            f"total execution {statistics.get('TotalExecutionTimeInMillis')} ms, "
+            f"{statistics.get('DataScannedInBytes')} bytes scanned.")
+
+
+# Report Summarizer ##################################################
+# Streams the report files once and keeps a bounded summary: row count, time range, the most frequent values
+# of summary_top_columns (Misra-Gries counters) and the distinct values of summary_distinct_columns (HyperLogLog).
+# CSV reports and gzip JSON reports are summarized, Parquet reports are not.
+
+# Report files listed in an UNLOAD manifest, with their sizes
+def get_unload_report_objects(s3Bucket, s3Key):
+    manifest = s3Client.get_object(Bucket=s3Bucket, Key=s3Key)['Body'].read().decode('utf-8')
+    report_objects = []
+    for report_location in manifest.split():
+        report_url = parse.urlparse(report_location)
+        report_key = report_url.path.lstrip('/')
+        report_objects.append((report_key, s3Client.head_object(Bucket=report_url.netloc, Key=report_key)['ContentLength']))
+    return report_objects
+
+
+# Return the lines of the report files read with ranged GETs, stops early when the invocation runs short of time
+def stream_report_lines(s3Bucket, report_objects, context, progress):
+    for s3Key, object_size in report_objects:
+        # gzip report files are decompressed as they are read
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if s3Key.endswith('.gz') else None
+        pending_bytes = b''
+        for range_start in range(0, object_size, summary_chunk_bytes):
+            if context.get_remaining_time_in_millis() < summary_margin_millis:
+                logger.info(f'Stopping the summary of {s3Key} after {range_start} bytes')
+                return
+            range_end = min(range_start + summary_chunk_bytes, object_size) - 1
+            chunk = s3Client.get_object(Bucket=s3Bucket, Key=s3Key, Range=f'bytes={range_start}-{range_end}')['Body'].read()
+            progress['bytes_read'] += len(chunk)
+            if decompressor:
+                chunk = decompressor.decompress(chunk)
+            # A line can span two chunks, keep its start until the next chunk
+            chunk_lines = (pending_bytes + chunk).split(b'\n')
+            pending_bytes = chunk_lines.pop()
+            for line in chunk_lines:
+                yield line.decode('utf-8') + '\n'
+        if pending_bytes:
+            yield pending_bytes.decode('utf-8') + '\n'
+    progress['complete'] = True
+
+
+# Rows of JSON report lines, the header row holds the fields of the first record
+def read_json_report_rows(report_lines):
+    header = None
+    for line in report_lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if header is None:
+            header = list(record)
+            yield header
+        yield ['' if record.get(column) is None else str(record.get(column)) for column in header]
+
+
+# Count a value in Misra-Gries counters, returns the count subtracted from every counter when they are full
+def top_counter_add(counters, value):
+    counters[value] = counters.get(value, 0) + 1
+    if len(counters) <= 2 * summary_top_capacity:
+        return 0
+    # Subtract the count of the (capacity + 1)th value from every counter and drop the counters that reach zero
+    decrement = sorted(counters.values(), reverse=True)[summary_top_capacity]
+    for counted_value in list(counters):
+        counters[counted_value] -= decrement
+        if counters[counted_value] <= 0:
+            del counters[counted_value]
+    return decrement
+
+
+def hll_add(registers, value):
+    hashed_value = int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+    register_index = hashed_value >> (64 - hll_precision)
+    remaining_bits = hashed_value & ((1 << (64 - hll_precision)) - 1)
+    rank = (64 - hll_precision) - remaining_bits.bit_length() + 1
+    if rank > registers[register_index]:
+        registers[register_index] = rank
+
+
+def hll_estimate(registers):
+    register_count = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / register_count)
+    estimate = alpha * register_count * register_count / sum(2.0 ** -register for register in registers)
+    empty_registers = registers.count(0)
+    # Linear counting is more accurate for small cardinalities
+    if estimate <= 2.5 * register_count and empty_registers:
+        estimate = register_count * math.log(register_count / empty_registers)
+    return round(estimate)
+
+
+# Summarize a report in a single pass with bounded memory
+def summarize_report(s3Bucket, s3Key, report_objects, context):
+    progress = {'bytes_read': 0, 'complete': not any(object_size for report_key, object_size in report_objects)}
+    report_lines = stream_report_lines(s3Bucket, report_objects, context, progress)
+    if s3Key.endswith(unload_manifest_suffix):
+        report_rows = read_json_report_rows(report_lines)
+    else:
+        report_rows = csv.reader(report_lines)
+    # Athena writes the column names in lower case
+    header = [column.lower() for column in next(report_rows, [])]
+    top_columns = [(column, header.index(column)) for column in summary_top_columns if column in header]
+    distinct_columns = [(column, header.index(column)) for column in summary_distinct_columns if column in header]
+    time_index = header.index(summary_time_column) if summary_time_column in header else None
+    top_counters = {column: {} for column, index in top_columns}
+    top_errors = {column: 0 for column, index in top_columns}
+    distinct_registers = {column: bytearray(1 << hll_precision) for column, index in distinct_columns}
+    row_count = 0
+    first_time = last_time = None
+
+    for row in report_rows:
+        if len(row) != len(header):
+            continue
+        row_count += 1
+        for column, index in top_columns:
+            top_errors[column] += top_counter_add(top_counters[column], row[index])
+        for column, index in distinct_columns:
+            if row[index]:
+                hll_add(distinct_registers[column], row[index])
+        # Athena and CloudTrail timestamps sort as strings
+        if time_index is not None and row[time_index]:
+            first_time = min(first_time or row[time_index], row[time_index])
+            last_time = max(last_time or row[time_index], row[time_index])
+
+    return {
+        'report': f's3://{s3Bucket}/{s3Key}',
+        'complete': progress['complete'],
+        'bytes_read': progress['bytes_read'],
+        'rows': row_count,
+        'time_range': {'column': summary_time_column, 'first': first_time, 'last': last_time} if time_index is not None else None,
+        # Counts are lower bounds, at most top_count_error below the real count
+        'top_values': {column: sorted(counters.items(), key=lambda item: item[1], reverse=True)[:summary_top_values] for column, counters in top_counters.items()},
+        'top_count_error': top_errors,
+        'approximate_distinct': {column: hll_estimate(registers) for column, registers in distinct_registers.items()}
+    }
+
+
+# Return the summary of a report, computed once and stored next to the report as <report>.summary.json
+def get_report_summary(s3Bucket, s3Key, report_objects, context):
+    summary_key = f'{s3Key}.summary.json'
+    try:
+        summary_object = s3Client.get_object(Bucket=s3Bucket, Key=summary_key)
+        return json.loads(summary_object['Body'].read())
+    except ClientError as e:
+        logger.info(f'No stored summary for {s3Key}: {e}')
+    try:
+        report_summary = summarize_report(s3Bucket, s3Key, report_objects, context)
+        s3Client.put_object(Bucket=s3Bucket, Key=summary_key, Body=json.dumps(report_summary), ContentType='application/json')
+    except (ClientError, UnicodeDecodeError, ValueError, csv.Error, zlib.error) as e:
+        logger.error(e)
+        return None
+    return report_summary
+
+
+# Report summary lines of the notification
+# Counts of a preview report are also given scaled to the whole window
+def format_report_summary(report_summary, sample_percent=None):
+    scale = 100 / sample_percent if sample_percent else None
+    summary_lines = [f"Report summary: {report_summary['rows']} rows" + ('' if report_summary['complete'] else f" in the first {report_summary['bytes_read']} bytes")
+                     + (f", about {round(report_summary['rows'] * scale)} estimated for all logs" if scale else '')]
+    if report_summary.get('time_range') and report_summary['time_range']['first']:
+        summary_lines.append(f"{report_summary['time_range']['column']} from {report_summary['time_range']['first']} to {report_summary['time_range']['last']}")
+    for column, top_values in report_summary['top_values'].items():
+        summary_lines.append(f"Top {column}: " + ', '.join(f'{value} ({count}' + (f', about {round(count * scale)} estimated' if scale else '') + ')'
+                                                             for value, count in top_values[:notification_top_values]))
+    if report_summary['approximate_distinct']:
+        summary_lines.append('Approximate distinct ' + ', '.join(f'{column}: {count}' for column, count in report_summary['approximate_distinct'].items())
+                             + (' in the sample' if scale else ''))
+    return '\n'.join(summary_lines)
+
+
 def lambda_handler(event, context):
     logger.info(event)
     # Use Etag to prevent duplicate invocation
@@ -41,8 +305,43 @@ def lambda_handler(event, context):
     s3Key = parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
 
     try:
-      my_sns_message = f'Athena Query Completed Successfully, kindly retrieve your s3 troubleshooting report in the Amazon S3 bucket path s3://{s3Bucket}/{s3Key} .'
+      # The Athena Query function serves a previous report when no new logs were copied since it ran
+      if event.get('my_cached_result'):
+        my_sns_message = f'No new logs were copied since the same Athena Query last ran, kindly retrieve your s3 troubleshooting report in the Amazon S3 bucket path s3://{s3Bucket}/{s3Key} .'
+      else:
+        my_sns_message = f'Athena Query Completed Successfully, kindly retrieve your s3 troubleshooting report in the Amazon S3 bucket path s3://{s3Bucket}/{s3Key} .'
+      my_query_statistics = get_query_statistics(s3Bucket, s3Key)
+      logger.info(my_query_statistics)
+      my_sample_percent = (my_query_statistics or {}).get('sample_percent')
+      if my_sample_percent:
+        my_sns_message = (f'PREVIEW on a {my_sample_percent:g}% sample of the logs, the full Athena Query follows. Counts in the preview report cover the sample only, '
+                          f'estimates for all logs are scaled by {100 / my_sample_percent:g}. Kindly retrieve the preview report in the Amazon S3 bucket path s3://{s3Bucket}/{s3Key} .')
+      if my_query_statistics:
+        my_sns_message = f'{my_sns_message}\n\n{format_query_statistics(my_query_statistics)}'
+      if s3Key.endswith(unload_manifest_suffix):
+        my_report_objects = get_unload_report_objects(s3Bucket, s3Key)
+        my_result_size = sum(object_size for report_key, object_size in my_report_objects)
+        my_sns_message = (f"{my_sns_message}\nThe report is made of {len(my_report_objects)} files, {my_result_size} bytes"
+                          + (f", under s3://{s3Bucket}/{my_report_objects[0][0].rsplit('/', 1)[0]}/ ." if my_report_objects else ' .'))
+      else:
+        # Cached results are notified without the object size of an S3 event
+        my_result_size = event['Records'][0]['s3']['object'].get('size')
+        if my_result_size is None:
+          my_result_size = s3Client.head_object(Bucket=s3Bucket, Key=s3Key).get('ContentLength')
+        my_report_objects = [(s3Key, my_result_size)]
+      # Parquet reports are not summarized
+      if s3Key.endswith(unload_manifest_suffix) and not all(report_key.endswith('.gz') for report_key, object_size in my_report_objects):
+        my_report_summary = None
+      else:
+        my_report_summary = get_report_summary(s3Bucket, s3Key, my_report_objects, context)
+      if my_report_summary:
+        my_sns_message = f'{my_sns_message}\n\n{format_report_summary(my_report_summary, my_sample_percent)}'
       send_sns_message(my_sns_topic_arn, my_sns_message)
+      put_metrics({'Stage': 'ToolReport'}, {
+        'ResultObjectSize': (my_result_size, 'Bytes'),
+        'ResultsCached': (1 if event.get('my_cached_result') else 0, 'Count'),
+        'PreviewResults': (1 if my_sample_percent else 0, 'Count')
+      }, {'ResultKey': s3Key, 'AnalysisType': (my_query_statistics or {}).get('analysis_type')})
     except Exception as e:
       logger.error(e)
     else: 
@@ -3,7 +3,13 @@ from botocore.exceptions import ClientError
 import logging
 import os
 import datetime
+import hashlib
+import random
+import re
+import time
 import boto3
+from botocore.client import Config
+from concurrent.futures import ThreadPoolExecutor
 from urllib import parse
 
 
@@ -19,38 +25,753 @@ logger.setLevel('INFO')
 my_region = str(os.environ['AWS_REGION'])
 my_glue_db = str(os.environ['glue_db'])
 my_glue_tbl = str(os.environ['glue_tbl'])
+my_glue_rollup_tbl = str(os.environ['glue_rollup_tbl'])
+# Raw table on the log bucket, set when the logs are queried in place instead of being copied
+my_glue_in_place_tbl = str(os.environ['glue_in_place_tbl'])
 my_workgroup_name = str(os.environ['workgroup_name'])
 my_s3_bucket = str(os.environ['s3_bucket'])
-my_query_analysis_type = str(os.environ['query_analysis_type'])
+# Comma separated list of analysis types, their queries run concurrently
+my_query_analysis_types = [analysis_type.strip() for analysis_type in str(os.environ['query_analysis_type']).split(',') if analysis_type.strip()]
+my_max_concurrent_queries = int(os.environ['max_concurrent_queries'])
+# Percent of the logs read by the preview query of each analysis, 0 disables the previews
+my_preview_sample_percent = float(os.environ['preview_sample_percent'])
 my_query_logs_before = str(os.environ['query_logs_before'])
 my_query_logs_after = str(os.environ['query_logs_after'])
+my_tool_bucket = str(os.environ['tool_bucket'])
+my_copy_report_prefix = str(os.environ['batch_ops_report_prefix'])
+my_query_cache_prefix = str(os.environ['query_cache_prefix'])
+my_rollup_state_key = str(os.environ['rollup_state_key'])
+report_function_name = str(os.environ['report_function'])
+my_sns_topic_arn = str(os.environ['sns_topic_arn'])
+# Format of the analysis results, CSV results are written by the workgroup, the other formats with UNLOAD
+my_result_format = str(os.environ['result_format'])
+my_unload_prefix = str(os.environ['unload_prefix'])
+
+# Other Variables
+function_invocation_type_async = 'Event'
+# Cached results older than this are queried again
+query_cache_ttl_seconds = 86400
+# Athena errors retried with backoff, StartQueryExecution fails with these when the workgroup is at its concurrent query limit
+throttling_error_codes = ['TooManyRequestsException', 'ThrottlingException']
+max_start_attempts = 8
+backoff_base_seconds = 2
+backoff_max_seconds = 60
+# Query tracker polling, the interval doubles up to the maximum while a query runs
+query_poll_initial_seconds = 1
+query_poll_max_seconds = 15
+# Runtime statistics captured for every query
+query_statistics_keys = ['EngineExecutionTimeInMillis', 'QueryQueueTimeInMillis', 'TotalExecutionTimeInMillis', 'DataScannedInBytes']
+# Stop waiting for queries when less time than this is left, their reports are still notified by the Tool Report function
+completion_margin_millis = 30000
+# UNLOAD options of each result format
+unload_formats = {
+    'PARQUET': "format = 'PARQUET', compression = 'ZSTD'",
+    'JSON-GZIP': "format = 'JSON', compression = 'GZIP'",
+}
+# UNLOAD lists the files it writes in a manifest in the workgroup output location, it notifies the Tool Report function
+unload_manifest_suffix = '-manifest.csv'
+# Execution parameters of the analysis statements, written as :name in the statement text
+statement_parameter_pattern = re.compile(r':(s3_bucket|query_logs_after|query_logs_before)\b')
 
 
 my_current_date = datetime.datetime.now().date()
 
+# Query Builder ##################################################
+# Every analysis in the catalogue is described by:
+#   projection - the selected columns and expressions
+#   predicates - the analysis filters, combined with AND
+#   group_by, order_by, limit - optional grouping, ordering and row limit of the scan
+#   wrapper - optional outer query, {scan} is replaced with the generated scan
+#   rollup - optional projection, predicates and group_by that answer the analysis from the daily rollup table
+# build_analysis_statement puts the partition and bucket predicates before the analysis filters and
+# compares the time window as a range on the typed requestdatetime column, nothing is parsed per row.
+# The bucket and the window bounds are :s3_bucket, :query_logs_after and :query_logs_before parameters of the
+# statement, build_analysis_query binds them as literals.
+# The rollup table is only read when every day of the window is complete, it is filtered on days only.
+# sample_percent reads a sample of the table files with TABLESAMPLE SYSTEM, for the preview queries.
+
+# Columns returned by the request level analyses
+request_columns = ['requestdatetime', 'requester', 'remoteip', 'operation', 'httpstatus', 'bucket_name', 'key', 'versionid', 'useragent', 'authtype', 'aclrequired', 'requestid', 'hostid']
+
+analysis_catalogue = {
+    'ObjectAccess': {
+        'projection': request_columns,
+        'predicates': ["operation = 'REST.GET.OBJECT'"],
+    },
+    'ClientError-4xx': {
+        'projection': request_columns,
+        'predicates': ['httpstatus BETWEEN 400 AND 499'],
+    },
+    'ServiceError-5xx': {
+        'projection': request_columns,
+        'predicates': ['httpstatus BETWEEN 500 AND 599'],
+    },
+    'ObjectDeletion': {
+        'projection': request_columns,
+        'predicates': ["operation like '%DELETE%'"],
+    },
+    'LifecycleAction-Expiration': {
+        'projection': request_columns,
+        'predicates': ["operation = 'S3.EXPIRE.OBJECT'"],
+    },
+    'LifecycleAction-Transition': {
+        'projection': request_columns,
+        'predicates': ["operation like 'S3.TRANSITION%'"],
+    },
+    'Latency': {
+        'projection': ['requestdatetime', 'turnaroundtime', 'totaltime'] + request_columns[1:],
+        'predicates': ['turnaroundtime IS NOT NULL'],
+        'order_by': ['turnaroundtime DESC'],
+    },
+}
+
+# Latency analyses that aggregate instead of sorting every request
+latency_percentiles = [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999)]
+latency_time_bucket = 'hour'
+latency_slowest_requests = 1000
+latency_percentiles_array = f"ARRAY[{', '.join(str(percentile) for name, percentile in latency_percentiles)}]"
+
+
+# Outer query of the percentile analyses, one column per percentile of each latency column
+def latency_percentiles_wrapper(time_column):
+    return f"""
+SELECT {time_column}, operation, requester, request_count,
+{', '.join(f'turnaroundtime_percentiles[{position}] AS turnaroundtime_{name}' for position, (name, percentile) in enumerate(latency_percentiles, 1))},
+{', '.join(f'totaltime_percentiles[{position}] AS totaltime_{name}' for position, (name, percentile) in enumerate(latency_percentiles, 1))}
+FROM ({{scan}})
+ORDER BY {time_column}, operation, requester"""
+
+
+# Percentiles per operation, requester and time bucket, each column is summarized in one approx_percentile call
+analysis_catalogue['Latency-Percentiles'] = {
+    'projection': [
+        f"date_trunc('{latency_time_bucket}', requestdatetime) AS time_bucket", 'operation', 'requester', 'COUNT(*) AS request_count',
+        f'approx_percentile(turnaroundtime, {latency_percentiles_array}) AS turnaroundtime_percentiles',
+        f'approx_percentile(totaltime, {latency_percentiles_array}) AS totaltime_percentiles',
+    ],
+    'predicates': ['turnaroundtime IS NOT NULL'],
+    'group_by': [f"date_trunc('{latency_time_bucket}', requestdatetime)", 'operation', 'requester'],
+    'wrapper': latency_percentiles_wrapper('time_bucket'),
+}
+# Daily percentiles, the rollup table merges the latency digests of each day
+analysis_catalogue['Latency-Percentiles-Daily'] = {
+    'projection': [
+        'dt AS day', 'operation', 'requester', 'COUNT(*) AS request_count',
+        f'approx_percentile(turnaroundtime, {latency_percentiles_array}) AS turnaroundtime_percentiles',
+        f'approx_percentile(totaltime, {latency_percentiles_array}) AS totaltime_percentiles',
+    ],
+    'predicates': ['turnaroundtime IS NOT NULL'],
+    'group_by': ['dt', 'operation', 'requester'],
+    'wrapper': latency_percentiles_wrapper('day'),
+    'rollup': {
+        'projection': [
+            'dt AS day', 'operation', 'requester', 'SUM(latency_count) AS request_count',
+            f'values_at_quantiles(merge(CAST(turnaroundtime_digest AS qdigest(bigint))), {latency_percentiles_array}) AS turnaroundtime_percentiles',
+            f'values_at_quantiles(merge(CAST(totaltime_digest AS qdigest(bigint))), {latency_percentiles_array}) AS totaltime_percentiles',
+        ],
+        'predicates': ['latency_count > 0'],
+    },
+}
+# Only the slowest requests, a top-N instead of a sort of the whole window
+analysis_catalogue['Latency-SlowestRequests'] = dict(analysis_catalogue['Latency'], limit=latency_slowest_requests)
+
+# TopTroubleshootingQueries reads the rows of these analyses in a single scan and tags each row
+# with every analysis it matches
+troubleshooting_categories = ['ClientError-4xx', 'ServiceError-5xx', 'ObjectDeletion', 'LifecycleAction-Expiration', 'LifecycleAction-Transition']
+analysis_catalogue['TopTroubleshootingQueries'] = {
+    'projection': request_columns + [
+        'array_join(filter(ARRAY['
+        + ', '.join(f"IF({' AND '.join(analysis_catalogue[category]['predicates'])}, '{category}')" for category in troubleshooting_categories)
+        + "], category -> category IS NOT NULL), ';') AS categories"
+    ],
+    'predicates': ['(' + ' OR '.join(' AND '.join(analysis_catalogue[category]['predicates']) for category in troubleshooting_categories) + ')'],
+}
+
+# Lifecycle operations counted by LifecycleActionStatistics and the action reported for each
+lifecycle_actions = [
+    ('S3.CREATE.DELETEMARKER', 'object_delete_marker_created'),
+    ('S3.DELETE.UPLOAD', 'object_incomplete_multipart_aborted'),
+    ('S3.EXPIRE.OBJECT', 'object_permanently_deleted'),
+    ('S3.TRANSITION_INT.OBJECT', 'object_transitioned_to_INTELLIGENT_TIER'),
+    ('S3.TRANSITION_GIR.OBJECT', 'object_transitioned_to_GLACIER_INSTANT_RETRIEVAL'),
+    ('S3.TRANSITION_ZIA.OBJECT', 'object_transitioned_to_ONE_ZONE_IA'),
+    ('S3.TRANSITION_SIA.OBJECT', 'object_transitioned_to_STANDARD_IA'),
+    ('S3.TRANSITION.OBJECT', 'object_transitioned_to_GLACIER_FLEXIBLE_RETRIEVAL'),
+    ('S3.TRANSITION_GDA.OBJECT', 'object_transitioned_to_GLACIER_DEEP_ARCHIVE'),
+]
+lifecycle_actions_values = ', '.join(f"('{operation}', '{action}', {ordinal})" for ordinal, (operation, action) in enumerate(lifecycle_actions))
+
+# Single scan grouped by day and operation, the labels come from the lifecycle_actions lookup
+lifecycle_counts = {
+    'projection': ['dt', 'operation', 'COUNT(*) AS object_count'],
+    'predicates': ['operation IN (' + ', '.join(f"'{operation}'" for operation, action in lifecycle_actions) + ')'],
+    'group_by': ['dt', 'operation'],
+    'rollup': {'projection': ['dt', 'operation', 'SUM(request_count) AS object_count']},
+}
+analysis_catalogue['LifecycleActionStatistics'] = dict(lifecycle_counts, wrapper=f"""
+WITH lifecycle_actions (operation, action, ordinal) AS (VALUES {lifecycle_actions_values})
+SELECT lifecycle_actions.action, COALESCE(SUM(logs.object_count), 0) AS object_count
+FROM lifecycle_actions
+LEFT JOIN ({{scan}}) AS logs ON logs.operation = lifecycle_actions.operation
+GROUP BY lifecycle_actions.action, lifecycle_actions.ordinal
+ORDER BY lifecycle_actions.ordinal""")
+# Time series, one row per day and action including the days without lifecycle activity
+analysis_catalogue['LifecycleActionStatistics-Daily'] = dict(lifecycle_counts, wrapper=f"""
+WITH lifecycle_actions (operation, action, ordinal) AS (VALUES {lifecycle_actions_values})
+SELECT calendar.day, lifecycle_actions.action, COALESCE(logs.object_count, 0) AS object_count
+FROM lifecycle_actions
+CROSS JOIN UNNEST(sequence(CAST(:query_logs_after AS date), date_add('day', -1, CAST(:query_logs_before AS date)))) AS calendar (day)
+LEFT JOIN ({{scan}}) AS logs ON logs.operation = lifecycle_actions.operation AND CAST(logs.dt AS date) = calendar.day
+ORDER BY calendar.day, lifecycle_actions.ordinal""")
+
+# Requests and bytes per day, bucket, operation and status, the trend of errors and deletions over long windows
+analysis_catalogue['RequestStatistics-Daily'] = {
+    'projection': ['dt AS day', 'bucket_name', 'operation', 'httpstatus', 'COUNT(*) AS request_count', 'SUM(bytessent) AS bytes_sent'],
+    'predicates': [],
+    'group_by': ['dt', 'bucket_name', 'operation', 'httpstatus'],
+    'order_by': ['day', 'bucket_name', 'operation', 'httpstatus'],
+    'rollup': {'projection': ['dt AS day', 'bucket_name', 'operation', 'httpstatus', 'SUM(request_count) AS request_count', 'SUM(bytes_sent) AS bytes_sent']},
+}
+
+# Heavy hitters, the top values of each dimension by request count and by bytes sent
+# A first pass keeps bounded candidates per dimension, the most frequent values from approx_most_frequent and the
+# values of the largest single transfers. A second pass counts requests and bytes exactly for the candidates only, the other
+# values are grouped as NULL and dropped, so no pass aggregates the full cardinality of the keys or IP addresses.
+heavy_hitter_dimensions = ['requester', 'remoteip', 'key', 'useragent', 'operation']
+heavy_hitter_count = 25
+# Candidates kept per dimension by the frequency sketch and by the largest transfers, and the sketch capacity
+heavy_hitter_candidates = 4 * heavy_hitter_count
+heavy_hitter_capacity = 4096
+
+
+# Outer query of the heavy hitter analyses, one row per value in the top of its dimension by requests or by bytes
+def heavy_hitters_wrapper(dimensions):
+    return f"""
+WITH scanned AS (
+{{scan}}
+), candidates AS (
+SELECT {', '.join(f'array_distinct(map_keys(approx_most_frequent({heavy_hitter_candidates}, {dimension}, {heavy_hitter_capacity})) || max_by({dimension}, bytes_sent, {heavy_hitter_candidates})) AS {dimension}' for dimension in dimensions)}
+FROM scanned
+), hitters AS (
+SELECT CASE {' '.join(f"WHEN grouping({dimension}) = 0 THEN '{dimension}'" for dimension in dimensions)} END AS dimension,
+CASE {' '.join(f'WHEN grouping({dimension}) = 0 THEN {dimension}' for dimension in dimensions)} END AS value,
+COUNT(*) AS request_count, SUM(bytes_sent) AS bytes_sent
+FROM (
+SELECT {', '.join(f'CASE WHEN contains(candidates.{dimension}, scanned.{dimension}) THEN scanned.{dimension} END AS {dimension}' for dimension in dimensions)}, scanned.bytes_sent
+FROM scanned CROSS JOIN candidates
+)
+GROUP BY GROUPING SETS ({', '.join(f'({dimension})' for dimension in dimensions)})
+), ranked AS (
+SELECT dimension, value, request_count, bytes_sent,
+row_number() OVER (PARTITION BY dimension ORDER BY request_count DESC, value) AS request_rank,
+row_number() OVER (PARTITION BY dimension ORDER BY COALESCE(bytes_sent, 0) DESC, value) AS bytes_rank
+FROM hitters
+WHERE value IS NOT NULL
+)
+SELECT dimension, value, request_count, bytes_sent, request_rank, bytes_rank
+FROM ranked
+WHERE request_rank <= {heavy_hitter_count} OR bytes_rank <= {heavy_hitter_count}
+ORDER BY dimension, request_rank"""
+
+
+analysis_catalogue['HeavyHitters'] = {
+    'projection': heavy_hitter_dimensions + ['bytessent AS bytes_sent'],
+    'predicates': [],
+    'wrapper': heavy_hitters_wrapper(heavy_hitter_dimensions),
+}
+
+
+# Logs Queried In Place ##########################################
+# Without a copy, the analyses read the raw table on the log bucket instead of the Parquet table. The raw table is
+# partitioned by the day in the keys of date-based partitioned logs (logdate=YYYY/MM/DD), its columns are typed
+# here like the Parquet table.
+
+# Relation the analyses read from a table, the typed raw table in place of the Parquet table when it is set
+def get_log_relation(glue_tbl, sample_clause):
+    if glue_tbl != my_glue_tbl or not my_glue_in_place_tbl:
+        return f'"{my_glue_db}"."{glue_tbl}"{sample_clause}'
+    return f"""(
+    SELECT bucketowner, bucket_name, requestdatetime, remoteip, requester, requestid, operation, key, request_uri, httpstatus, errorcode, bytessent, objectsize, totaltime, turnaroundtime, referrer, useragent, versionid, hostid, sigv, ciphersuite, authtype, endpoint, tlsversion, accesspointarn, aclrequired,
+    date_format(requestdatetime, '%Y-%m-%d') AS dt
+    FROM (
+        SELECT bucketowner, bucket_name,
+        CAST(try(parse_datetime(requestdatetime, 'dd/MMM/yyyy:HH:mm:ss Z')) AT TIME ZONE 'UTC' AS timestamp) AS requestdatetime,
+        remoteip, requester, requestid, operation, key, request_uri,
+        try_cast(httpstatus AS integer) AS httpstatus,
+        errorcode, bytessent, objectsize,
+        try_cast(totaltime AS integer) AS totaltime,
+        try_cast(turnaroundtime AS integer) AS turnaroundtime,
+        referrer, useragent, versionid, hostid, sigv, ciphersuite, authtype, endpoint, tlsversion, accesspointarn, aclrequired
+        FROM "{my_glue_db}"."{my_glue_in_place_tbl}"{sample_clause}
+        WHERE logdate BETWEEN date_format(CAST(:query_logs_after AS date), '%Y/%m/%d') AND date_format(CAST(:query_logs_before AS date), '%Y/%m/%d')
+    )
+) AS logs"""
+
+
+# Generate the statement of an analysis, returns None for an unknown analysis
+# filter_bucket adds the :s3_bucket predicate, use_rollup reads the rollup table instead of the Parquet table
+# for the analyses that support it
+def build_analysis_statement(analysis_type, filter_bucket, use_rollup=False, sample_percent=None):
+    analysis = analysis_catalogue.get(analysis_type)
+    if analysis is None:
+        return None
+    glue_tbl = my_glue_tbl
+    if use_rollup and analysis.get('rollup'):
+        analysis = dict(analysis, **analysis['rollup'])
+        glue_tbl = my_glue_rollup_tbl
+    # The Parquet and rollup tables are partitioned by request day (dt=YYYY-MM-DD), the window excludes the before day
+    predicates = ['dt >= :query_logs_after AND dt < :query_logs_before']
+    if filter_bucket:
+        predicates.append('bucket_name = :s3_bucket')
+    predicates.extend(analysis['predicates'])
+    if glue_tbl != my_glue_rollup_tbl:
+        predicates.append('requestdatetime >= CAST(:query_logs_after AS timestamp) AND requestdatetime < CAST(:query_logs_before AS timestamp)')
+
+    query_string = f"""
+SELECT {', '.join(analysis['projection'])}
+FROM {get_log_relation(glue_tbl, f' TABLESAMPLE SYSTEM ({sample_percent:g})' if sample_percent else '')}
+WHERE """ + '\nAND '.join(predicates)
+    if analysis.get('group_by'):
+        query_string += '\nGROUP BY ' + ', '.join(analysis['group_by'])
+    if analysis.get('order_by'):
+        query_string += '\nORDER BY ' + ', '.join(analysis['order_by'])
+    if analysis.get('limit'):
+        query_string += f"\nLIMIT {analysis['limit']}"
+    if analysis.get('wrapper'):
+        query_string = analysis['wrapper'].format(scan=query_string)
+    return query_string + ' ;'
+
+
+# Quote a string as an SQL literal
+def to_sql_literal(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+# Values of the statement parameters for a bucket and time window
+def get_statement_values(s3_bucket, query_logs_after, query_logs_before):
+    return {'s3_bucket': s3_bucket, 'query_logs_after': query_logs_after, 'query_logs_before': query_logs_before}
+
+
+# Generate the query of an analysis for a bucket and time window with the parameters bound as literals,
+# returns None for an unknown analysis
+def build_analysis_query(analysis_type, s3_bucket, query_logs_after, query_logs_before, use_rollup=False, sample_percent=None):
+    statement = build_analysis_statement(analysis_type, bool(s3_bucket), use_rollup, sample_percent)
+    if statement is None:
+        return None
+    statement_values = get_statement_values(s3_bucket, query_logs_after, query_logs_before)
+    return statement_parameter_pattern.sub(lambda parameter: to_sql_literal(statement_values[parameter.group(1)]), statement)
+
+
 logger.info(f'my_query_logs_before is: {my_query_logs_before}')
 logger.info(f'my_query_logs_after is: {my_query_logs_after}')
 
 
+# Set SDK paramters
+config = Config(retries = {'max_attempts': 10, 'mode': 'adaptive'})
+
 # Set Service Client
-athena_client = boto3.client('athena', region_name=my_region)
+athena_client = boto3.client('athena', config=config, region_name=my_region)
+s3Client = boto3.client('s3', region_name=my_region)
+lambdaClient = boto3.client('lambda', region_name=my_region)
+sns = boto3.client('sns', region_name=my_region)
+
+
+# SNS Message Function
+def send_sns_message(sns_topic_arn, sns_message):
+    logger.info("Sending SNS Notification Message......")
+    sns_subject = 'Notification from AWS Support Troubleshooting Tool'
+    try:
+        response = sns.publish(TopicArn=sns_topic_arn, Message=sns_message, Subject=sns_subject)
+    except ClientError as e:
+        logger.error(e)
+
+
+# Embedded Metrics Function, set metrics_file to write the records to a local file
+metrics_namespace = 'AWSSupportTroubleshootingToolForS3'
+my_metrics_file = os.environ.get('metrics_file')
+
+
+def put_metrics(dimensions, metrics, properties=None):
+    # metrics maps each metric name to a (value, unit) pair, metrics without a value are left out
+    metrics = {name: metric for name, metric in metrics.items() if metric[0] is not None}
+    emf_record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': metrics_namespace,
+                'Dimensions': [list(dimensions.keys())],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in metrics.items()]
+            }]
+        },
+        'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    }
+    emf_record.update(properties or {})
+    emf_record.update(dimensions)
+    emf_record.update({name: value for name, (value, unit) in metrics.items()})
+    emf_line = json.dumps(emf_record, default=str)
+    if my_metrics_file:
+        with open(my_metrics_file, 'a') as metrics_file:
+            metrics_file.write(f'{emf_line}\n')
+    else:
+        print(emf_line, flush=True)
+
+
+# Function to Invoke Lambda Functions
+def invoke_function(function_name, invocation_type, payload):
+    invoke_response = lambdaClient.invoke(
+        FunctionName=function_name,
+        InvocationType=invocation_type,
+        Payload=payload,
+
+    )
+    response_payload = invoke_response['Payload'].read().decode("utf-8")
+    return json.loads(response_payload) if response_payload else invoke_response.get('StatusCode')
+
+
+# Query Result Cache ##################################################
+# A cache entry maps the normalized query text and a fingerprint of the copied logs to the query execution
+# that answered it. Copying new logs writes new copy job reports, which changes the fingerprint, so the
+# entries of older copies are never served again. The S3 lifecycle rule on the cache prefix removes them.
+
+# Fingerprint of the copied logs, built from the copy job completion reports in the tool bucket
+def get_input_fingerprint():
+    input_fingerprint = hashlib.sha256()
+    paginator = s3Client.get_paginator('list_objects_v2')
+    # Keys are listed in lexicographic order, so the same reports always give the same fingerprint
+    for page in paginator.paginate(Bucket=my_tool_bucket, Prefix=my_copy_report_prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.json'):
+                input_fingerprint.update(f"{obj['Key']}:{obj['ETag']}\n".encode('utf-8'))
+    return input_fingerprint.hexdigest()
+
+
+# Cache key of a query, whitespace is normalized so formatting changes do not miss the cache
+# The result format is part of the key, a result is only served in the format it was written in
+def get_query_cache_key(query_string, input_fingerprint):
+    normalized_query = ' '.join(query_string.split())
+    return hashlib.sha256(f'{normalized_query}\n{my_result_format}\n{input_fingerprint}'.encode('utf-8')).hexdigest()
+
+
+# Return the result location of a cached query that succeeded within the TTL, or None
+def get_cached_result(cache_key):
+    try:
+        cache_entry = s3Client.get_object(Bucket=my_tool_bucket, Key=f'{my_query_cache_prefix}{cache_key}.json')
+    except ClientError as e:
+        logger.info(f'No cached result for {cache_key}: {e}')
+        return None
+    cache_age = datetime.datetime.now(datetime.timezone.utc) - cache_entry['LastModified']
+    if cache_age.total_seconds() > query_cache_ttl_seconds:
+        logger.info(f'Cached result for {cache_key} expired')
+        return None
+    cached_query_id = json.loads(cache_entry['Body'].read()).get('query_execution_id')
+    query_execution = athena_client.get_query_execution(QueryExecutionId=cached_query_id).get('QueryExecution')
+    if query_execution.get('Status', {}).get('State') != 'SUCCEEDED':
+        logger.info(f'Cached query {cached_query_id} did not succeed')
+        return None
+    return get_result_location(query_execution)
+
 
+# Record the query execution answering a query
+def put_cache_entry(cache_key, query_execution_id):
+    try:
+        s3Client.put_object(
+            Bucket=my_tool_bucket,
+            Key=f'{my_query_cache_prefix}{cache_key}.json',
+            Body=json.dumps({'query_execution_id': query_execution_id}),
+            ContentType='application/json'
+        )
+    except ClientError as e:
+        logger.error(e)
+
+
+# Notify the Tool Report function of a cached result with the same event as a new result
+def notify_cached_result(output_location):
+    output_url = parse.urlparse(output_location)
+    my_payload = {
+        'my_cached_result': True,
+        'Records': [{'s3': {'bucket': {'name': output_url.netloc}, 'object': {'key': parse.quote_plus(output_url.path.lstrip('/'))}}}]
+    }
+    invoke_function(report_function_name, function_invocation_type_async, json.dumps(my_payload))
+
+
+# Return the cache key of a query and the result location when the same query already ran over the same copied logs
+# Logs queried in place have no copy reports to fingerprint and keep changing, their results are not cached
+def lookup_cached_result(query_string):
+    if my_glue_in_place_tbl:
+        return None, None
+    try:
+        cache_key = get_query_cache_key(query_string, get_input_fingerprint())
+        return cache_key, get_cached_result(cache_key)
+    except ClientError as e:
+        logger.error(e)
+        return None, None
+
+
+# Submit a query, returns the state of the analysis. The query execution is recorded under cache_key when given
+# execution_parameters are the values of the ? parameters of the query, in order
+def start_query_execution(query_string, athena_db, workgroup_name, job_request_token, cache_key=None, execution_parameters=None):
+    logger.info(f'Starting Athena query...... with query string: {query_string} and parameters: {execution_parameters}')
+    my_request_kwargs = {}
+    if execution_parameters:
+        my_request_kwargs['ExecutionParameters'] = execution_parameters
+    for attempt in range(max_start_attempts):
+        try:
+            execute_query = athena_client.start_query_execution(
+                QueryString=query_string,
+                QueryExecutionContext={
+                    'Database': athena_db
+                },
+                WorkGroup=workgroup_name,
+                ClientRequestToken= job_request_token,
+                **my_request_kwargs
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] not in throttling_error_codes or attempt == max_start_attempts - 1:
+                logger.error(e)
+                return {'state': 'FAILED', 'reason': str(e)}
+            # Exponential backoff with full jitter, so concurrent analyses do not retry together
+            backoff_seconds = random.uniform(0, min(backoff_max_seconds, backoff_base_seconds * 2 ** attempt))
+            logger.info(f'Athena is throttling, retrying in {backoff_seconds:.1f} seconds: {e}')
+            time.sleep(backoff_seconds)
+        else:
+            logger.info(f'Query Successful: {execute_query}')
+            if cache_key:
+                put_cache_entry(cache_key, execute_query['QueryExecutionId'])
+            return {'state': 'QUEUED', 'query_execution_id': execute_query['QueryExecutionId']}
 
-def start_query_execution(query_string, athena_db, workgroup_name, job_request_token):
-    logger.info(f'Starting Athena query...... with query string: {query_string}')
+
+# Prepared Statements ############################################
+# The analysis statements are registered once in the workgroup as prepared statements and executed with
+# the bucket and window bounds as execution parameters, so the query text of an analysis is the same for
+# every bucket and window and the values are never part of the SQL text. The statement name ends with a
+# hash of the statement text, a catalogue change registers a new version next to the previous one.
+# Preview and UNLOAD queries run their statement text with the same execution parameters, the sample
+# percent stays visible to the Tool Report function and each UNLOAD writes to its own prefix.
+
+# Replace the :name parameters of a statement with ?, returns the query and the parameter names in order
+def to_parameterized_query(statement):
+    parameter_names = [parameter.group(1) for parameter in statement_parameter_pattern.finditer(statement)]
+    return statement_parameter_pattern.sub('?', statement), parameter_names
+
+
+# Execution parameters of a query, each value is passed as an SQL literal
+def get_execution_parameters(parameter_names):
+    statement_values = get_statement_values(my_s3_bucket, my_query_logs_after, my_query_logs_before)
+    return [to_sql_literal(statement_values[parameter_name]) for parameter_name in parameter_names]
+
+
+# Name of the prepared statement of an analysis, versioned by the statement text
+def get_statement_name(analysis_type, parameterized_query):
+    statement_version = hashlib.sha256(' '.join(parameterized_query.split()).encode('utf-8')).hexdigest()[:16]
+    return f"{re.sub('[^A-Za-z0-9]+', '_', analysis_type).strip('_').lower()}_{statement_version}"
+
+
+# Register a prepared statement in the workgroup unless this version is already registered
+def register_prepared_statement(statement_name, parameterized_query):
+    try:
+        athena_client.get_prepared_statement(StatementName=statement_name, WorkGroup=my_workgroup_name)
+        return
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
     try:
-        execute_query = athena_client.start_query_execution(
-            QueryString=query_string,
-            QueryExecutionContext={
-                'Database': athena_db
-            },
-            WorkGroup=workgroup_name,
-            ClientRequestToken= job_request_token,
+        athena_client.create_prepared_statement(
+            StatementName=statement_name,
+            WorkGroup=my_workgroup_name,
+            QueryStatement=parameterized_query.rstrip(' ;'),
+            Description='AWS Support Troubleshooting Tool analysis'
         )
+        logger.info(f'Registered prepared statement {statement_name}')
     except ClientError as e:
-        logger.info(e)
+        # Another invocation registered the same version in the meantime
+        if e.response['Error']['Code'] != 'InvalidRequestException':
+            raise
+        athena_client.get_prepared_statement(StatementName=statement_name, WorkGroup=my_workgroup_name)
+
+
+# Query string and execution parameters of a statement, the EXECUTE of its prepared statement when prepare is set
+# A statement that cannot be registered runs as a parameterized query
+def build_statement_execution(analysis_type, statement, prepare):
+    parameterized_query, parameter_names = to_parameterized_query(statement)
+    execution_parameters = get_execution_parameters(parameter_names)
+    if prepare:
+        statement_name = get_statement_name(analysis_type, parameterized_query)
+        try:
+            register_prepared_statement(statement_name, parameterized_query)
+            return f'EXECUTE {statement_name}', execution_parameters
+        except ClientError as e:
+            logger.error(f'Prepared statement {statement_name} not registered: {e}')
+    return parameterized_query, execution_parameters
+
+
+# Daily Rollup ###################################################
+# The Parquet Conversion function keeps the complete days of the rollup table in the rollup state object.
+
+# True when every day of the query window is complete in the rollup table
+def is_rollup_complete(query_logs_after, query_logs_before):
+    try:
+        rollup_state = json.loads(s3Client.get_object(Bucket=my_tool_bucket, Key=my_rollup_state_key)['Body'].read())
+    except ClientError as e:
+        logger.info(f'No rollup state: {e}')
+        return False
+    completed_days = set(rollup_state.get('completed_days', []))
+    window_day = datetime.datetime.strptime(query_logs_after, '%Y-%m-%d')
+    last_day = datetime.datetime.strptime(query_logs_before, '%Y-%m-%d')
+    while window_day < last_day:
+        if window_day.strftime('%Y-%m-%d') not in completed_days:
+            return False
+        window_day = window_day + datetime.timedelta(days=1)
+    logger.info(f"Rollup complete up to {rollup_state.get('watermark')}")
+    return True
+
+
+# Result Formats #################################################
+# CSV results are written by the workgroup as <query id>.csv. Parquet and gzip JSON results are written
+# by an UNLOAD of the analysis query to a new prefix under the unload prefix, and the result location of
+# the query is then its <query id>-manifest.csv, which lists the result files.
+
+# Wrap an analysis query in an UNLOAD to the given prefix of the tool bucket, CSV queries are returned unchanged
+def build_unload_query(query_string, unload_key_prefix):
+    if my_result_format not in unload_formats:
+        return query_string
+    return (f"UNLOAD ({query_string.rstrip(' ;')}\n)\nTO 's3://{my_tool_bucket}/{my_unload_prefix}{unload_key_prefix}/'\n"
+            f"WITH ({unload_formats[my_result_format]}) ;")
+
+
+# Result location of a query execution, the manifest of an UNLOAD query
+def get_result_location(query_execution):
+    output_location = query_execution.get('ResultConfiguration', {}).get('OutputLocation')
+    if output_location and query_execution.get('Query', '').lstrip().upper().startswith('UNLOAD'):
+        return f"{output_location.rsplit('/', 1)[0]}/{query_execution['QueryExecutionId']}{unload_manifest_suffix}"
+    return output_location
+
+
+# Query Tracker ##################################################
+# Follows a query until it finishes and keeps its final state and runtime statistics in a
+# <result>.stats.json object next to the query result, the Tool Report function adds them to its notification.
+
+# Follow a query until it finishes, returns its final state or RUNNING when the invocation runs out of time
+def track_query_execution(query_execution_id, context):
+    poll_seconds = query_poll_initial_seconds
+    while context.get_remaining_time_in_millis() > completion_margin_millis:
+        query_execution = athena_client.get_query_execution(QueryExecutionId=query_execution_id).get('QueryExecution')
+        query_status = query_execution.get('Status')
+        if query_status.get('State') in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
+            logger.info(f'Query {query_execution_id} finished: {query_status}')
+            query_statistics = query_execution.get('Statistics', {})
+            return {
+                'state': query_status.get('State'),
+                'reason': query_status.get('StateChangeReason'),
+                'output_location': get_result_location(query_execution),
+                'statistics': {key: query_statistics.get(key) for key in query_statistics_keys}
+            }
+        time.sleep(poll_seconds)
+        poll_seconds = min(query_poll_max_seconds, poll_seconds * 2)
+    return {'state': 'RUNNING'}
+
+
+# Store the state and statistics of a finished query next to its result
+def put_query_statistics(analysis_result):
+    output_url = parse.urlparse(analysis_result['output_location'])
+    try:
+        s3Client.put_object(
+            Bucket=output_url.netloc,
+            Key=f"{output_url.path.lstrip('/')}.stats.json",
+            Body=json.dumps({key: analysis_result.get(key) for key in ['analysis_type', 'query_execution_id', 'state', 'reason', 'statistics', 'sample_percent']}),
+            ContentType='application/json'
+        )
+    except ClientError as e:
+        logger.error(e)
+
+
+# Preview Queries ################################################
+# With a preview sample percent, every analysis first runs on a sample of the logs. The preview report is
+# notified by the Tool Report function as a preview, with the row counts scaled to the whole window,
+# before the full query of the analysis starts.
+
+# Run the preview query of an analysis and wait for it to finish
+def run_preview(analysis_type, analysis_request_token, context):
+    preview_statement = build_analysis_statement(analysis_type, bool(my_s3_bucket), sample_percent=my_preview_sample_percent)
+    preview_query_string, preview_parameters = build_statement_execution(analysis_type, preview_statement, prepare=False)
+    preview_request_token = hashlib.sha256(f'{analysis_request_token}:preview'.encode('utf-8')).hexdigest()
+    preview_result = start_query_execution(preview_query_string, my_glue_db, my_workgroup_name, preview_request_token, execution_parameters=preview_parameters)
+    preview_result.update({'analysis_type': analysis_type, 'sample_percent': my_preview_sample_percent})
+    if preview_result.get('query_execution_id'):
+        preview_result.update(track_query_execution(preview_result['query_execution_id'], context))
+        if preview_result.get('output_location'):
+            put_query_statistics(preview_result)
+    # A failed preview does not stop the full query
+    if preview_result['state'] != 'SUCCEEDED':
+        logger.error(f'Preview query for {analysis_type} {preview_result["state"]}: {preview_result.get("reason")}')
+    return preview_result
+
+
+# Run one analysis, submit its query and wait for it to finish
+def run_analysis(analysis_type, job_request_token, context, use_rollup=False):
+    logger.info(analysis_type)
+    statement = build_analysis_statement(analysis_type, bool(my_s3_bucket), use_rollup)
+    if not statement:
+        logger.info(f"Nothing to do for {analysis_type}!")
+        return {'analysis_type': analysis_type, 'state': 'SKIPPED'}
+    # Request token of this analysis, derived from the invocation token
+    analysis_request_token = hashlib.sha256(f'{job_request_token}:{analysis_type}'.encode('utf-8')).hexdigest()
+    preview_result = {}
+    # Serve the previous result when the same query already ran over the same copied logs
+    # The cache is keyed on the query with its parameters bound, it covers the bucket and window
+    query_string = build_analysis_query(analysis_type, my_s3_bucket, my_query_logs_after, my_query_logs_before, use_rollup)
+    my_cache_key, my_cached_location = lookup_cached_result(query_string)
+    if my_cached_location:
+        logger.info(f'Serving cached query result {my_cached_location}')
+        notify_cached_result(my_cached_location)
+        analysis_result = {'state': 'CACHED', 'output_location': my_cached_location}
     else:
-        logger.info(f'Query Successful: {execute_query}')
+        try:
+            if my_preview_sample_percent and not (use_rollup and analysis_catalogue[analysis_type].get('rollup')):
+                preview_result = run_preview(analysis_type, analysis_request_token, context)
+            my_unload = my_result_format in unload_formats
+            analysis_query_string, analysis_parameters = build_statement_execution(analysis_type, statement, prepare=not my_unload)
+            # The request token names the UNLOAD prefix, a retried invocation writes to the same prefix as its query
+            analysis_result = start_query_execution(build_unload_query(analysis_query_string, f'{analysis_type}/{analysis_request_token}'),
+                                                    my_glue_db, my_workgroup_name, analysis_request_token, my_cache_key, analysis_parameters)
+        except Exception as e:
+            # A query that cannot be submitted fails this analysis only, it is notified and reported with the others
+            logger.error(e)
+            analysis_result = {'state': 'FAILED', 'reason': f'Query submission failed: {e}'}
+    analysis_result['analysis_type'] = analysis_type
+    if analysis_result.get('query_execution_id'):
+        analysis_result.update(track_query_execution(analysis_result['query_execution_id'], context))
+        if analysis_result.get('output_location'):
+            put_query_statistics(analysis_result)
+    if analysis_result['state'] in ['FAILED', 'CANCELLED']:
+        send_sns_message(my_sns_topic_arn, f"Athena Query for {analysis_type} {analysis_result['state']}: {analysis_result.get('reason')}")
+    analysis_statistics = analysis_result.get('statistics') or {}
+    put_metrics({'Stage': 'AthenaQuery', 'AnalysisType': analysis_type}, {
+        'QueriesCached': (1 if analysis_result['state'] == 'CACHED' else 0, 'Count'),
+        'QueriesFromRollup': (1 if use_rollup and analysis_catalogue.get(analysis_type, {}).get('rollup') else 0, 'Count'),
+        'QueriesFailed': (1 if analysis_result['state'] in ['FAILED', 'CANCELLED'] else 0, 'Count'),
+        'DataScannedInBytes': (analysis_statistics.get('DataScannedInBytes'), 'Bytes'),
+        'EngineExecutionTime': (analysis_statistics.get('EngineExecutionTimeInMillis'), 'Milliseconds'),
+        'QueryQueueTime': (analysis_statistics.get('QueryQueueTimeInMillis'), 'Milliseconds'),
+        'TotalExecutionTime': (analysis_statistics.get('TotalExecutionTimeInMillis'), 'Milliseconds'),
+        'PreviewDataScannedInBytes': ((preview_result.get('statistics') or {}).get('DataScannedInBytes'), 'Bytes'),
+        'PreviewTotalExecutionTime': ((preview_result.get('statistics') or {}).get('TotalExecutionTimeInMillis'), 'Milliseconds')
+    }, {'QueryExecutionId': analysis_result.get('query_execution_id'), 'State': analysis_result['state']})
+    return analysis_result
+
+
+# Summary of the analyses of an invocation, one line per analysis
+def format_analysis_summary(analysis_results):
+    summary_lines = [f'Athena Queries for logs from {my_query_logs_after} to {my_query_logs_before}:']
+    for analysis_result in analysis_results:
+        summary_line = f"{analysis_result['analysis_type']}: {analysis_result['state']}"
+        if analysis_result.get('output_location'):
+            summary_line += f" {analysis_result['output_location']}"
+        if analysis_result.get('reason'):
+            summary_line += f" ({analysis_result['reason']})"
+        if analysis_result.get('statistics'):
+            summary_line += f", {analysis_result['statistics']['DataScannedInBytes']} bytes scanned in {analysis_result['statistics']['EngineExecutionTimeInMillis']} ms"
+        summary_lines.append(summary_line)
+    return '\n'.join(summary_lines)
 
 
 def lambda_handler(event, context):
@@ -58,436 +779,26 @@ def lambda_handler(event, context):
     # Use Etag to prevent duplicate invocation
     my_request_token = event.get('my_etag')
     logger.info(f'Initiating Main Function...')
-
-    # Specify the Athena Query #
-
-    match my_query_analysis_type:
-        case "ObjectAccess":
-            logger.info("ObjectAccess")
-            if my_s3_bucket:  
-                my_query_string = f"""
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid 
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE bucket_name = '{my_s3_bucket}'
-                AND
-                operation='REST.GET.OBJECT'
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd') ;
-                """  
-            else:
-                my_query_string = f"""
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid 
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE operation='REST.GET.OBJECT'
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd') ;                            
-                """                                                      
-
-        case "ClientError-4xx":
-            logger.info("ClientError-4xx")
-            if my_s3_bucket:  
-                my_query_string = f"""
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid 
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE bucket_name = '{my_s3_bucket}'
-                AND
-                httpstatus like '4%' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd') ;
-                """  
-            else:
-                my_query_string = f"""
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid 
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE httpstatus like '4%' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd') ;                            
-                """                                                      
-
-        case "ServiceError-5xx":
-            logger.info("ServiceError-5xx")
-            if my_s3_bucket: 
-                my_query_string = f"""
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid 
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE bucket_name = '{my_s3_bucket}'
-                AND
-                httpstatus like '5%' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd') ;                            
-                """  
-            else:
-                my_query_string = f"""
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid 
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE httpstatus like '5%' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd') ;                            
-                """                                                      
-
-        case "ObjectDeletion":
-            logger.info("ObjectDeletion")
-            if my_s3_bucket:  
-                my_query_string = f"""
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid 
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE bucket_name = '{my_s3_bucket}'
-                AND
-                operation like '%DELETE%' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd') ;                            
-                """    
-            else:  
-                my_query_string = f"""
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid 
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE operation like '%DELETE%' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd') ;                            
-                """     
-
-        case "LifecycleActionStatistics":
-            logger.info("LifecycleActionStatistics")
-            if my_s3_bucket:
-                my_query_string = f"""
-                SELECT 'object_delete_marker_created' AS action, COUNT(*) as object_count
-                FROM "{my_glue_db}"."{my_glue_tbl}" WHERE bucket_name = '{my_s3_bucket}' AND operation = 'S3.CREATE.DELETEMARKER' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT 'object_incomplete_multipart_aborted' AS action, COUNT(*) as object_count 
-                FROM "{my_glue_db}"."{my_glue_tbl}" WHERE bucket_name = '{my_s3_bucket}' AND operation = 'S3.DELETE.UPLOAD' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT 'object_permanently_deleted' AS action, COUNT(*) as object_count 
-                FROM "{my_glue_db}"."{my_glue_tbl}" WHERE bucket_name = '{my_s3_bucket}' AND operation = 'S3.EXPIRE.OBJECT' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT 'object_transitioned_to_INTELLIGENT_TIER' AS action, COUNT(*) as object_count 
-                FROM "{my_glue_db}"."{my_glue_tbl}" WHERE bucket_name = '{my_s3_bucket}' AND operation = 'S3.TRANSITION_INT.OBJECT' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT 'object_transitioned_to_GLACIER_INSTANT_RETRIEVAL' AS action, COUNT(*) as object_count 
-                FROM "{my_glue_db}"."{my_glue_tbl}" WHERE bucket_name = '{my_s3_bucket}' AND operation = 'S3.TRANSITION_GIR.OBJECT' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT 'object_transitioned_to_ONE_ZONE_IA' AS action, COUNT(*) as object_count 
-                FROM "{my_glue_db}"."{my_glue_tbl}" WHERE bucket_name = '{my_s3_bucket}' AND operation = 'S3.TRANSITION_ZIA.OBJECT' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT 'object_transitioned_to_STANDARD_IA' AS action, COUNT(*) as object_count 
-                FROM "{my_glue_db}"."{my_glue_tbl}" WHERE bucket_name = '{my_s3_bucket}' AND operation = 'S3.TRANSITION_SIA.OBJECT' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT 'object_transitioned_to_GLACIER_FLEXIBLE_RETRIEVAL' AS action, COUNT(*) as object_count 
-                FROM "{my_glue_db}"."{my_glue_tbl}" WHERE bucket_name = '{my_s3_bucket}' AND operation = 'S3.TRANSITION.OBJECT' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT 'object_transitioned_to_GLACIER_DEEP_ARCHIVE' AS action, COUNT(*) as object_count 
-                FROM "{my_glue_db}"."{my_glue_tbl}" WHERE bucket_name = '{my_s3_bucket}' AND operation = 'S3.TRANSITION_GDA.OBJECT'
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd') ;
-
-                """ 
-            else:    
-                my_query_string = f"""
-                SELECT 'object_delete_marker_created' AS action, COUNT(*) as object_count
-                FROM "{my_glue_db}"."{my_glue_tbl}" WHERE operation = 'S3.CREATE.DELETEMARKER' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT 'object_incomplete_multipart_aborted' AS action, COUNT(*) as object_count 
-                FROM "{my_glue_db}"."{my_glue_tbl}" WHERE operation = 'S3.DELETE.UPLOAD' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT 'object_permanently_deleted' AS action, COUNT(*) as object_count 
-                FROM "{my_glue_db}"."{my_glue_tbl}" WHERE operation = 'S3.EXPIRE.OBJECT' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT 'object_transitioned_to_INTELLIGENT_TIER' AS action, COUNT(*) as object_count 
-                FROM "{my_glue_db}"."{my_glue_tbl}" WHERE operation = 'S3.TRANSITION_INT.OBJECT' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT 'object_transitioned_to_GLACIER_INSTANT_RETRIEVAL' AS action, COUNT(*) as object_count 
-                FROM "{my_glue_db}"."{my_glue_tbl}" WHERE operation = 'S3.TRANSITION_GIR.OBJECT' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT 'object_transitioned_to_ONE_ZONE_IA' AS action, COUNT(*) as object_count 
-                FROM "{my_glue_db}"."{my_glue_tbl}" WHERE operation = 'S3.TRANSITION_ZIA.OBJECT' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT 'object_transitioned_to_STANDARD_IA' AS action, COUNT(*) as object_count 
-                FROM "{my_glue_db}"."{my_glue_tbl}" WHERE operation = 'S3.TRANSITION_SIA.OBJECT' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT 'object_transitioned_to_GLACIER_FLEXIBLE_RETRIEVAL' AS action, COUNT(*) as object_count 
-                FROM "{my_glue_db}"."{my_glue_tbl}" WHERE operation = 'S3.TRANSITION.OBJECT' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT 'object_transitioned_to_GLACIER_DEEP_ARCHIVE' AS action, COUNT(*) as object_count 
-                FROM "{my_glue_db}"."{my_glue_tbl}" WHERE operation = 'S3.TRANSITION_GDA.OBJECT'
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd') ;
-
-                """ 
-
-        
-        case "LifecycleAction-Expiration":
-            logger.info("LifecycleAction-Expiration")
-            if my_s3_bucket: 
-                my_query_string = f"""
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid 
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE bucket_name = '{my_s3_bucket}'
-                AND
-                operation = 'S3.EXPIRE.OBJECT'
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd') ;                            
-                """    
-            else:
-                my_query_string = f"""
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid 
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE operation = 'S3.EXPIRE.OBJECT' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd') ;                            
-                """                                                         
-
-        case "LifecycleAction-Transition":
-            logger.info("LifecycleAction-Transition")
-            if my_s3_bucket: 
-                my_query_string = f"""
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid 
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE bucket_name = '{my_s3_bucket}'
-                AND
-                operation like 'S3.TRANSITION%'
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd') ;                            
-                """
-            else:
-                my_query_string = f"""
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid 
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE operation like 'S3.TRANSITION%'
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd') ;                            
-                """                                
-
-        case "Latency":
-            logger.info("Latency")
-            if my_s3_bucket: 
-                my_query_string = f"""
-                SELECT requestdatetime, turnaroundtime, totaltime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid 
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE bucket_name = '{my_s3_bucket}'
-                AND
-                turnaroundtime != '-' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                ORDER BY CAST(turnaroundtime AS INT) DESC ;
-                """  
-            else:
-                my_query_string = f"""
-                SELECT requestdatetime, turnaroundtime, totaltime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid 
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE turnaroundtime != '-' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                ORDER BY CAST(turnaroundtime AS INT) DESC;
-                """                              
-
-        case "TopTroubleshootingQueries":
-            logger.info("TopTroubleshootingQueries")
-            if my_s3_bucket:
-                my_query_string = f"""
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid 
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE bucket_name = '{my_s3_bucket}'
-                AND
-                httpstatus like '4%' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                            
-                UNION ALL
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid 
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE bucket_name = '{my_s3_bucket}'
-                AND
-                httpstatus like '5%'
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL   
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE bucket_name = '{my_s3_bucket}'
-                AND
-                operation like '%DELETE%'
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL                                             
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE bucket_name = '{my_s3_bucket}'
-                AND
-                operation = 'S3.EXPIRE.OBJECT'
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE bucket_name = '{my_s3_bucket}'
-                AND
-                operation like 'S3.TRANSITION%' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd') ;                 
-                
-                """ 
-            else:    
-                my_query_string = f"""
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid 
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE bucket_name = '{my_s3_bucket}'
-                AND
-                httpstatus like '4%' 
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid 
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE httpstatus like '5%'
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL   
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE operation like '%DELETE%'
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL                                             
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE operation = 'S3.EXPIRE.OBJECT'
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd')                             
-                UNION ALL
-                SELECT requestdatetime, requester, remoteip, operation, httpstatus, bucket_name, key, versionid, useragent, authtype , aclrequired, requestid, hostid
-                FROM "{my_glue_db}"."{my_glue_tbl}"
-                WHERE operation like 'S3.TRANSITION%'
-                AND
-                parse_datetime(requestdatetime,'dd/MMM/yyyy:HH:mm:ss Z')
-                BETWEEN parse_datetime('{my_query_logs_after}','yyyy-MM-dd')
-                AND parse_datetime('{my_query_logs_before}','yyyy-MM-dd') ;                            
-                """ 
-
-        case _:
-            my_query_string = None
-
+    my_stage_start = time.monotonic()
 
     try:
-        if my_query_string: 
-            start_query_execution(my_query_string, my_glue_db, my_workgroup_name, my_request_token)
-        else:
-            logger.info("Nothing to do!")
+        # Aggregate analyses read the rollup table when it covers the whole window, logs queried in place have no rollup
+        my_use_rollup = not my_glue_in_place_tbl and is_rollup_complete(my_query_logs_after, my_query_logs_before)
+        # At most my_max_concurrent_queries queries of this invocation run in the workgroup at a time
+        with ThreadPoolExecutor(max_workers=my_max_concurrent_queries) as executor:
+            my_analysis_results = list(executor.map(lambda analysis_type: run_analysis(analysis_type, my_request_token, context, my_use_rollup), my_query_analysis_types))
+        logger.info(my_analysis_results)
+        put_metrics({'Stage': 'AthenaQuery'}, {
+            'AnalysesRun': (len(my_analysis_results), 'Count'),
+            'StageDuration': ((time.monotonic() - my_stage_start) * 1000, 'Milliseconds')
+        }, {'RequestToken': my_request_token})
+        # A single analysis is notified by the Tool Report function alone
+        if len(my_analysis_results) > 1:
+            send_sns_message(my_sns_topic_arn, format_analysis_summary(my_analysis_results))
     except Exception as e:
         logger.error(e)
     else:    
         return {
             'statusCode': 200,
-            'body': json.dumps('Successful Invocation!')
-        }        
+            'body': json.dumps(my_analysis_results)
+        }
@@ -11,6 +11,7 @@ from botocore.client import Config
 import datetime
 from dateutil.tz import tzlocal
 from datetime import datetime
+from datetime import timedelta
 
 # Enable debugging for troubleshooting
 # boto3.set_stream_logger("")
@@ -27,11 +28,15 @@ report_bucket_name = str(os.environ['batch_ops_report_bucket'])
 accountId = str(os.environ['my_account_id'])
 my_s3_access_log_copy_location = str(os.environ['s3_access_log_copy_location'])
 my_cloudtrail_log_copy_location = str(os.environ['cloudtrail_log_copy_location'])
+my_parsed_location = str(os.environ['parsed_location'])
 query_function_name = str(os.environ['query_function'])
 my_sns_topic_arn = str(os.environ['sns_topic_arn'])     
 
 # Other Variables
-function_invocation_type = 'RequestResponse'            
+# The query function waits for its queries, it is invoked asynchronously
+function_invocation_type = 'Event'            
+# Remaining time under which the copy jobs left are created by a new invocation, before the function times out
+continuation_margin_millis = 60000
 
 
 # Specify variables #############################
@@ -45,6 +50,12 @@ report_prefix = str(os.environ['batch_ops_report_prefix'])
 report_format = 'Report_CSV_20180820'
 report_scope = 'AllTasks'
 
+# Job Tags ############################
+job_tag_key = 'job-created-by'
+job_tag_value = 'aws-support-troubleshooting-tool-for-s3'
+job_run_id_tag_key = 'job-run-id'
+job_run_size_tag_key = 'job-run-size'
+
 
 # Construct ARNs
 
@@ -56,8 +67,12 @@ manifest_gen_filter_storage_class_list = ['STANDARD', 'ONEZONE_IA', 'STANDARD_IA
 # Specify checksum algorithm
 my_checksum_algorithm = 'SHA256'  # 'CRC32'|'CRC32C'|'SHA1'|'SHA256'
 
+# Set SDK paramters
+config = Config(retries = {'max_attempts': 10, 'mode': 'adaptive'})
+
 # Initiate Service Clients ###################
-s3ControlClient = boto3.client('s3control', region_name=my_region)
+s3ControlClient = boto3.client('s3control', config=config, region_name=my_region)
+s3Client = boto3.client('s3', config=config, region_name=my_region)
 lambdaClient = boto3.client('lambda', region_name=my_region)
 sns = boto3.client('sns', region_name=my_region)
 
@@ -72,6 +87,36 @@ def send_sns_message(sns_topic_arn, sns_message):
         logger.error(e)
 
 
+# Embedded Metrics Function, set metrics_file to write the records to a local file
+metrics_namespace = 'AWSSupportTroubleshootingToolForS3'
+my_metrics_file = os.environ.get('metrics_file')
+
+
+def put_metrics(dimensions, metrics, properties=None):
+    # metrics maps each metric name to a (value, unit) pair, metrics without a value are left out
+    metrics = {name: metric for name, metric in metrics.items() if metric[0] is not None}
+    emf_record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': metrics_namespace,
+                'Dimensions': [list(dimensions.keys())],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in metrics.items()]
+            }]
+        },
+        'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    }
+    emf_record.update(properties or {})
+    emf_record.update(dimensions)
+    emf_record.update({name: value for name, (value, unit) in metrics.items()})
+    emf_line = json.dumps(emf_record, default=str)
+    if my_metrics_file:
+        with open(my_metrics_file, 'a') as metrics_file:
+            metrics_file.write(f'{emf_line}\n')
+    else:
+        print(emf_line, flush=True)
+
+
 # Function to Invoke Copy Function Worker
 def invoke_function(function_name, invocation_type, payload):
     invoke_response = lambdaClient.invoke(
@@ -80,92 +125,197 @@ def invoke_function(function_name, invocation_type, payload):
         Payload=payload,
 
     )
-    response_payload = json.loads(invoke_response['Payload'].read().decode("utf-8"))
-    return response_payload                 
+    response_payload = invoke_response['Payload'].read().decode("utf-8")
+    return json.loads(response_payload) if response_payload else invoke_response.get('StatusCode')                 
 
 
 
-# S3 Batch Copy Function
+# Return the days covered by the requested log window, one entry per day
+def get_log_days(obj_created_after, obj_created_before):
+    log_days = []
+    log_day = obj_created_after
+    while log_day < obj_created_before:
+        log_days.append(log_day)
+        log_day = log_day + timedelta(days=1)
+    return log_days
+
+
+# Log prefixes to copy from, separated by commas
+def get_log_prefixes(log_prefixes_string):
+    return [log_prefix.strip() for log_prefix in (log_prefixes_string or '').split(',') if log_prefix.strip()]
+
+
+# Key prefixes of the logs delivered on a day under each log prefix. S3 server access log keys are either
+# <prefix>YYYY-MM-DD-HH-MM-SS-<unique>, or <prefix>YYYY/MM/DD/YYYY-MM-DD-HH-MM-SS-<unique> with date-based partitioning
+# where the prefix ends with <source account>/<source Region>/<source bucket>/
+def get_day_key_prefixes(log_prefixes, log_day):
+    day_key_prefixes = []
+    for log_prefix in log_prefixes:
+        day_key_prefixes.append(f"{log_prefix}{log_day.strftime('%Y-%m-%d')}-")
+        day_key_prefixes.append(f"{log_prefix}{log_day.strftime('%Y/%m/%d')}/")
+    return day_key_prefixes
+
+
+# Remove the parsed rows of an earlier copy of the given days. The copied logs are parsed again as they are copied,
+# and the rows an earlier run parsed into other objects would otherwise be read twice. The other days are kept.
+def delete_parsed_logs(log_days):
+    paginator = s3Client.get_paginator('list_objects_v2')
+    for log_day in log_days:
+        for page in paginator.paginate(Bucket=report_bucket_name, Prefix=f"{my_parsed_location}/dt={log_day.strftime('%Y-%m-%d')}/"):
+            objects_to_delete = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if objects_to_delete:
+                s3Client.delete_objects(Bucket=report_bucket_name, Delete={'Objects': objects_to_delete, 'Quiet': True})
 
-def s3_batch_ops_copy_manifest_generator(target_key_prefix, source_bucket_arn, source_bucket_prefix, obj_created_before_string, obj_created_after_string):
+
+# S3 Batch Copy Function
+# One Batch Operations job is created per day in the window, the day is matched on the timestamp
+# in the log object key (<prefix>YYYY-MM-DD-HH-MM-SS-<unique>) and copied to <copy location>/YYYY/MM/DD
+# so the Glue table can prune the copied logs with partition projection.
+# With log prefixes, the manifest of a day only lists the keys that start with a prefix and the date of the day.
+# Without a prefix, every key of the bucket with the date of the day is copied.
+# All jobs of a run share the job-run-id tag, the Job Tracker waits for the whole run before querying.
+# The jobs of a long window are created by as many invocations as needed, from the day at log_day_index onwards.
+
+def s3_batch_ops_copy_manifest_generator(context, target_key_prefix, source_bucket_arn, source_bucket_prefixes, obj_created_before_string, obj_created_after_string, run_id=None, log_day_index=0):
     # Convert input date to datetime format
     debug_start_days = datetime.strptime(obj_created_after_string, '%Y-%m-%d')
-    # Initiate Batch Operations Request parameters
-    my_request_kwargs = {
-        'AccountId': accountId,
-        'ConfirmationRequired': False,
-        'Operation': {
-            'S3PutObjectCopy': {
-                'TargetResource': target_resource_arn,
-                'CannedAccessControlList': 'private',
-                'MetadataDirective': 'COPY',
-                'TargetKeyPrefix': target_key_prefix,
-                'ChecksumAlgorithm': my_checksum_algorithm
-            }
-        },
-        'Report': {
-            'Bucket': report_bucket_arn,
-            'Format': report_format,
-            'Enabled': True,
-            'Prefix': report_prefix,
-            'ReportScope': 'AllTasks'
-        },
-        'ManifestGenerator': {
-            'S3JobManifestGenerator': {
-                'SourceBucket': source_bucket_arn,
-                'ManifestOutputLocation': {
-                    'Bucket': report_bucket_arn,
-                    'ManifestPrefix': job_manifest_prefix,
-                    'ManifestEncryption': {
-                        'SSES3': {},
+    # Include Created before time if specified, otherwise copy up to the current day
+    # Convert date string to date time:
+    if obj_created_before_string:
+        obj_created_before = datetime.strptime(obj_created_before_string, '%Y-%m-%d')
+    else:
+        obj_created_before = datetime.combine(datetime.utcnow().date() + timedelta(days=1), datetime.min.time())
+
+    my_log_days = get_log_days(debug_start_days, obj_created_before)
+    my_log_prefixes = get_log_prefixes(source_bucket_prefixes)
+    if not my_log_days:
+        raise ValueError(f"No logs to copy, the created after date {obj_created_after_string} must be earlier than the created before date {obj_created_before_string}")
+
+    my_stage_start = time.monotonic()
+    if run_id is None and target_key_prefix == my_s3_access_log_copy_location:
+        delete_parsed_logs(my_log_days)
+    my_run_id = run_id or str(uuid.uuid4())
+    logger.info(f"Creating {len(my_log_days) - log_day_index} of {len(my_log_days)} copy jobs for run {my_run_id}")
+    my_job_ids = []
+    for my_log_day_index in range(log_day_index, len(my_log_days)):
+        if context.get_remaining_time_in_millis() < continuation_margin_millis:
+            continue_copy(context, target_key_prefix, source_bucket_arn, source_bucket_prefixes, obj_created_before.strftime('%Y-%m-%d'), obj_created_after_string, my_run_id, my_log_day_index)
+            break
+        my_log_day = my_log_days[my_log_day_index]
+        # Initiate Batch Operations Request parameters
+        my_request_kwargs = {
+            'AccountId': accountId,
+            'ConfirmationRequired': False,
+            'Description': f"{my_run_id}:{my_log_day.strftime('%Y-%m-%d')}",
+            'Operation': {
+                'S3PutObjectCopy': {
+                    'TargetResource': target_resource_arn,
+                    'CannedAccessControlList': 'private',
+                    'MetadataDirective': 'COPY',
+                    'TargetKeyPrefix': f"{target_key_prefix}/{my_log_day.strftime('%Y/%m/%d')}",
+                    'ChecksumAlgorithm': my_checksum_algorithm
+                }
+            },
+            'Report': {
+                'Bucket': report_bucket_arn,
+                'Format': report_format,
+                'Enabled': True,
+                'Prefix': report_prefix,
+                'ReportScope': 'AllTasks'
+            },
+            'ManifestGenerator': {
+                'S3JobManifestGenerator': {
+                    'SourceBucket': source_bucket_arn,
+                    'ManifestOutputLocation': {
+                        'Bucket': report_bucket_arn,
+                        'ManifestPrefix': job_manifest_prefix,
+                        'ManifestEncryption': {
+                            'SSES3': {},
+                        },
+                        'ManifestFormat': job_manifest_format
                     },
-                    'ManifestFormat': job_manifest_format
+                    'Filter': {
+                        'CreatedAfter': debug_start_days,
+                        'CreatedBefore': obj_created_before,
+                        'KeyNameConstraint': {
+                            'MatchAnyPrefix': get_day_key_prefixes(my_log_prefixes, my_log_day)
+                        } if my_log_prefixes else {
+                            'MatchAnySubstring': [my_log_day.strftime('%Y-%m-%d-'), ]
+                        },
+                        'MatchAnyStorageClass': manifest_gen_filter_storage_class_list
+                    },
+                    'EnableManifestOutput': True
+                }
+            },
+            'Priority': 10,
+            'RoleArn': my_role_arn,
+            'Tags': [
+                {
+                    'Key': job_tag_key,
+                    'Value': job_tag_value
                 },
-                'Filter': {
-                    'CreatedAfter': debug_start_days,
-                    'MatchAnyStorageClass': manifest_gen_filter_storage_class_list
+                {
+                    'Key': job_run_id_tag_key,
+                    'Value': my_run_id
                 },
-                'EnableManifestOutput': True
-            }
-        },
-        'Priority': 10,
-        'RoleArn': my_role_arn,
-        'Tags': [
-            {
-                'Key': 'job-created-by',
-                'Value': 'aws-support-troubleshooting-tool-for-s3'
-            },
-        ]
-    }
+                {
+                    'Key': job_run_size_tag_key,
+                    'Value': str(len(my_log_days))
+                },
+            ]
+        }
 
-    logger.info(my_request_kwargs)
-    # Include Source Bucket Prefix if specified
-    if source_bucket_prefix:
-        my_request_kwargs['ManifestGenerator']['S3JobManifestGenerator']['Filter']['KeyNameConstraint'] = {
-            'MatchAnyPrefix': [source_bucket_prefix, ]}
-        logger.info(f"Source Prefix is present, modified request kwargs to: {my_request_kwargs}")
+        try:
+            logger.info(f"Submitting kwargs to S3 Batch Operations: {my_request_kwargs}")
+            response = s3ControlClient.create_job(**my_request_kwargs)
+            logger.info(f"JobID is: {response['JobId']}")
+            logger.info(f"S3 RequestID is: {response['ResponseMetadata']['RequestId']}")
+            logger.info(f"S3 Extended RequestID is:{response['ResponseMetadata']['HostId']}")
+            my_job_ids.append(response['JobId'])
+        except ClientError as e:
+            logger.error(e)
+            raise e
 
-    # Include Created before time if specified
-    # Convert date string to date time:
-    if obj_created_before_string:
-        obj_created_before = datetime.strptime(obj_created_before_string, '%Y-%m-%d')
-        my_request_kwargs['ManifestGenerator']['S3JobManifestGenerator']['Filter']['CreatedBefore'] = obj_created_before
+    put_metrics({'Stage': 'BatchCopy'}, {
+        'CopyJobsCreated': (len(my_job_ids), 'Count'),
+        'StageDuration': ((time.monotonic() - my_stage_start) * 1000, 'Milliseconds')
+    }, {'RunId': my_run_id})
+    return my_job_ids
 
 
-    try:
-        logger.info(f"Submitting kwargs to S3 Batch Operations: {my_request_kwargs}")
-        response = s3ControlClient.create_job(**my_request_kwargs)
-        logger.info(f"JobID is: {response['JobId']}")
-        logger.info(f"S3 RequestID is: {response['ResponseMetadata']['RequestId']}")
-        logger.info(f"S3 Extended RequestID is:{response['ResponseMetadata']['HostId']}")
-        return response['JobId']
-    except ClientError as e:
-        logger.error(e)
-        raise e
+# Create the copy jobs left in a new invocation, the CloudFormation response is sent without waiting for them
+def continue_copy(context, target_key_prefix, source_bucket_arn, source_bucket_prefixes, obj_created_before_string, obj_created_after_string, run_id, log_day_index):
+    logger.info(f'Continuing copy run {run_id} from day {log_day_index} in a new invocation')
+    my_payload = {"copy_run": {
+        "target_key_prefix": target_key_prefix,
+        "source_bucket_arn": source_bucket_arn,
+        "source_bucket_prefixes": source_bucket_prefixes,
+        "log_created_before": obj_created_before_string,
+        "log_created_after": obj_created_after_string,
+        "run_id": run_id,
+        "log_day_index": log_day_index,
+    }}
+    invoke_function(context.function_name, function_invocation_type, json.dumps(my_payload))
+
+
+# The window is [created after, created before), it must hold at least one day for the copy and the analyses
+def check_log_window(log_created_after, log_created_before):
+    if log_created_before and log_created_before <= log_created_after:
+        raise ValueError(f"LogObjectCreatedBefore ({log_created_before}) must be later than LogObjectCreatedAfter ({log_created_after})")
 
 
 def lambda_handler(event, context):
     logger.info(f'Event detail is: {event}')
+    # Continuation of a copy run, CloudFormation already has its response so errors are notified by SNS
+    if event.get('copy_run'):
+        my_copy_run = event['copy_run']
+        try:
+            s3_batch_ops_copy_manifest_generator(context, my_copy_run['target_key_prefix'], my_copy_run['source_bucket_arn'], my_copy_run['source_bucket_prefixes'],
+                                                 my_copy_run['log_created_before'], my_copy_run['log_created_after'], my_copy_run['run_id'], my_copy_run['log_day_index'])
+        except Exception as e:
+            logger.error(e)
+            send_sns_message(my_sns_topic_arn, f"The copy jobs of run {my_copy_run['run_id']} could not all be created, the Athena query will not start: {e}")
+        return
     my_copy_destination = None
     # Retrieve Invocation Variables
     my_logs_bucket = event.get('ResourceProperties').get('your_s3_logs_bucket')
@@ -173,7 +323,19 @@ def lambda_handler(event, context):
     my_log_type = event.get('ResourceProperties').get('your_log_type')
     my_log_created_before = event.get('ResourceProperties').get('log_created_before')
     my_log_created_after = event.get('ResourceProperties').get('log_created_after')              
+    # InPlace: the logs are queried where they are, nothing is copied
+    my_log_access_mode = event.get('ResourceProperties').get('log_access_mode', 'Copy')
     logger.info(f"my_log_prefix is {my_log_prefix}")            
+    # Reject an empty window before anything is copied or queried
+    if event.get('RequestType') in ['Create', 'Update']:
+        try:
+            check_log_window(my_log_created_after, my_log_created_before)
+        except ValueError as e:
+            logger.error(e)
+            responseData = {}
+            responseData['message'] = str(e)
+            cfnresponse.send(event, context, cfnresponse.FAILED, responseData, reason=str(e))
+            return
     
     # Set Copy destination depending on Log Type
     if my_log_type == 'CloudTrail':
@@ -186,7 +348,36 @@ def lambda_handler(event, context):
     # my_manifest_bucket_arn = 'arn:aws:s3:::' + manifest_bucket
 
     # Initiate Custom lambda Invocation based on Stack Request Type
-    if event.get('RequestType') == 'Create':
+    if event.get('RequestType') in ['Create', 'Update'] and my_log_access_mode == 'InPlace':
+        # The query function reads the log bucket directly, so it is started without waiting for a copy
+        try:
+            logger.info("Stack event is Create or Update and logs are queried in place, Starting Athena Query Workflow...")
+            # The in place table joins the first prefix to the date folders of the logs
+            my_in_place_prefix = (get_log_prefixes(my_log_prefix) or [''])[0]
+            if not my_in_place_prefix.endswith('/'):
+                raise ValueError(f"InPlace needs the date-based partitioned log prefix ending with /, for example logs/111122223333/us-east-1/amzn-s3-demo-bucket/, got '{my_in_place_prefix}'")
+            my_sns_message = f'Starting Athena Query on the logs in s3://{my_logs_bucket}/{my_log_prefix or ""}'
+            logger.info(f"{my_sns_message}")
+            # Generate Payload for Invocation:
+            my_payload = {"my_etag": str(uuid.uuid4())}
+            my_payload_json = json.dumps(my_payload)
+            send_sns_message(my_sns_topic_arn, my_sns_message)
+            # Start Athena Query Function Invoke
+            invoke_query_funct = invoke_function(query_function_name, function_invocation_type, my_payload_json)
+            logger.info(invoke_query_funct)
+            responseData = {}
+            responseData['message'] = "Successful"
+            logger.info(f"Sending Invocation Response {responseData['message']} to Cloudformation Service")
+            cfnresponse.send(event, context, cfnresponse.SUCCESS, responseData)
+        except Exception as e:
+            logger.error(e)
+            responseData = {}
+            responseData['message'] = str(e)
+            failure_reason = str(e)
+            logger.info(f"Sending Invocation Response {responseData['message']} to Cloudformation Service")
+            cfnresponse.send(event, context, cfnresponse.FAILED, responseData, reason=failure_reason)
+
+    elif event.get('RequestType') == 'Create':
         # logger.info(event)
         try:
             logger.info("Stack event is Create or Update. Initiating Logs copy to SupportToolBucket...")
@@ -194,7 +385,7 @@ def lambda_handler(event, context):
             # sleep is included intentionally
             # nosemgrep: arbitrary-sleep
             time.sleep(150)  # nosemgrep: arbitrary-sleep
-            s3_batch_ops_copy_manifest_generator(my_copy_destination, my_logs_bucket_arn, my_log_prefix, my_log_created_before, my_log_created_after)
+            s3_batch_ops_copy_manifest_generator(context, my_copy_destination, my_logs_bucket_arn, my_log_prefix, my_log_created_before, my_log_created_after)
             responseData = {}
             responseData['message'] = "Successful"
             logger.info(f"Sending Invocation Response {responseData['message']} to Cloudformation Service")
@@ -212,6 +403,7 @@ def lambda_handler(event, context):
         # Get details of the previous parameter values
         previous_my_logs_bucket = event.get('OldResourceProperties').get('your_s3_logs_bucket')
         previous_my_log_prefix = event.get('OldResourceProperties').get('your_s3_log_prefix')        
+        previous_my_log_access_mode = event.get('OldResourceProperties').get('log_access_mode', 'Copy')
         previous_my_log_created_after = event.get('OldResourceProperties').get('log_created_after')
         previous_my_log_created_before = event.get('OldResourceProperties').get('log_created_before')
         logger.info(f"previous_my_log_created_after is: {previous_my_log_created_after}")
@@ -222,12 +414,12 @@ def lambda_handler(event, context):
         old_after_date = datetime.strptime(previous_my_log_created_after, '%Y-%m-%d')
         old_before_date = datetime.strptime(previous_my_log_created_before, '%Y-%m-%d')
         # Initiate Batch Operations copy only if the logs files are not already included in previous copy
-        if current_after_date < old_after_date or current_before_date > old_before_date or my_logs_bucket != previous_my_logs_bucket or my_log_prefix != previous_my_log_prefix :
-            # Initiate Batch Operations copy
-            logger.info(f"The current CreatedAfterDate Or CreatedBeforeDate or  S3 Logs Bucket or S3 Logs Prefix has been modified. Now Initiate BOPs Job...")
+        if current_after_date < old_after_date or current_before_date > old_before_date or my_logs_bucket != previous_my_logs_bucket or my_log_prefix != previous_my_log_prefix or my_log_access_mode != previous_my_log_access_mode :
+            # Initiate Batch Operations copy, logs queried in place before were never copied
+            logger.info(f"The current CreatedAfterDate Or CreatedBeforeDate or  S3 Logs Bucket or S3 Logs Prefix or Log Access Mode has been modified. Now Initiate BOPs Job...")
             try:
                 logger.info("Stack event is Create or Update. Initiating Logs copy to SupportToolBucket...")
-                s3_batch_ops_copy_manifest_generator(my_copy_destination, my_logs_bucket_arn, my_log_prefix, my_log_created_before, my_log_created_after)
+                s3_batch_ops_copy_manifest_generator(context, my_copy_destination, my_logs_bucket_arn, my_log_prefix, my_log_created_before, my_log_created_after)
                 responseData = {}
                 responseData['message'] = "Successful"
                 logger.info(f"Sending Invocation Response {responseData['message']} to Cloudformation Service")
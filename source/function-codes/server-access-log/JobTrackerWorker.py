@@ -2,6 +2,7 @@ import json
 import boto3
 import botocore
 import os
+import time
 import logging
 import datetime
 import uuid
@@ -17,11 +18,21 @@ logger.setLevel('INFO')
 # Lambda Environment Variables
 accountId = str(os.environ['my_account_id'])
 my_region = str(os.environ['AWS_REGION'])
-query_function_name = str(os.environ['query_function'])
+conversion_function_name = str(os.environ['conversion_function'])
+my_tool_bucket = str(os.environ['tool_bucket'])
+my_run_marker_prefix = str(os.environ['run_marker_prefix'])
 my_sns_topic_arn = str(os.environ['sns_topic_arn'])     
 
 # Other Variables
 function_invocation_type = 'RequestResponse'          
+function_invocation_type_async = 'Event'
+job_tag_key = 'job-created-by'
+job_tag_value = 'aws-support-troubleshooting-tool-for-s3'
+job_run_id_tag_key = 'job-run-id'
+job_run_size_tag_key = 'job-run-size'
+job_terminal_statuses = ['Complete', 'Failed', 'Cancelled']
+# Errors of a conditional write when the object already exists or is being written
+claimed_error_codes = ['PreconditionFailed', 'ConditionalRequestConflict']
 
 # Create Service Clients
 s3ControlClient = boto3.client('s3control', region_name=my_region)
@@ -49,6 +60,36 @@ def send_sns_message(sns_topic_arn, sns_message):
         logger.error(e)
 
 
+# Embedded Metrics Function, set metrics_file to write the records to a local file
+metrics_namespace = 'AWSSupportTroubleshootingToolForS3'
+my_metrics_file = os.environ.get('metrics_file')
+
+
+def put_metrics(dimensions, metrics, properties=None):
+    # metrics maps each metric name to a (value, unit) pair, metrics without a value are left out
+    metrics = {name: metric for name, metric in metrics.items() if metric[0] is not None}
+    emf_record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': metrics_namespace,
+                'Dimensions': [list(dimensions.keys())],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in metrics.items()]
+            }]
+        },
+        'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    }
+    emf_record.update(properties or {})
+    emf_record.update(dimensions)
+    emf_record.update({name: value for name, (value, unit) in metrics.items()})
+    emf_line = json.dumps(emf_record, default=str)
+    if my_metrics_file:
+        with open(my_metrics_file, 'a') as metrics_file:
+            metrics_file.write(f'{emf_line}\n')
+    else:
+        print(emf_line, flush=True)
+
+
 # Function to Invoke Copy Function Worker
 def invoke_function(function_name, invocation_type, payload):
     invoke_response = lambdaClient.invoke(
@@ -57,11 +98,11 @@ def invoke_function(function_name, invocation_type, payload):
         Payload=payload,
 
     )
-    response_payload = json.loads(invoke_response['Payload'].read().decode("utf-8"))
-    return response_payload        
+    response_payload = invoke_response['Payload'].read().decode("utf-8")
+    return json.loads(response_payload) if response_payload else invoke_response.get('StatusCode')
 
 
-# Get S3 Batch Operations Tag
+# Get S3 Batch Operations Tags
 def get_job_tagging(bops_job_id):
     logger.info("Initiate GetJob Tagging")
     try:
@@ -71,11 +112,45 @@ def get_job_tagging(bops_job_id):
         )
     except ClientError as e:
         logger.error(e)
+        return {}
     else:
         logger.info("Successfully retrieved Job Tags")
-        tag_key = get_job_tag_response.get('Tags')[0].get('Key')
-        tag_value = get_job_tag_response.get('Tags')[0].get('Value')
-        return tag_key, tag_value
+        return {tag.get('Key'): tag.get('Value') for tag in get_job_tag_response.get('Tags')}
+
+
+# List the finished copy jobs of a run, jobs of a run are described as <run id>:<log day>
+def list_run_jobs(run_id):
+    run_jobs = []
+    paginator = s3ControlClient.get_paginator('list_jobs')
+    for page in paginator.paginate(AccountId=accountId, JobStatuses=job_terminal_statuses):
+        for job in page.get('Jobs', []):
+            if str(job.get('Description', '')).startswith(f'{run_id}:'):
+                run_jobs.append(job)
+    return run_jobs
+
+
+# Claim the completion of a run, returns False when another invocation has already claimed it
+# The last jobs of a run can finish together, every worker that sees the whole run finished tries the same
+# conditional write and only one of them succeeds
+def claim_run_completion(run_id):
+    try:
+        s3Client.put_object(Bucket=my_tool_bucket, Key=f'{my_run_marker_prefix}{run_id}.done', Body=b'', IfNoneMatch='*')
+    except ClientError as e:
+        if e.response['Error']['Code'] in claimed_error_codes:
+            return False
+        raise
+    return True
+
+
+# Copy Job Metrics, task counts, failure rate and duration of a copy job or of a run of copy jobs
+def put_copy_metrics(stage, number_of_tasks, tasks_succeeded, tasks_failed, creation_time, termination_time, properties):
+    put_metrics({'Stage': stage}, {
+        'TasksTotal': (number_of_tasks, 'Count'),
+        'TasksSucceeded': (tasks_succeeded, 'Count'),
+        'TasksFailed': (tasks_failed, 'Count'),
+        'TaskFailureRate': (100.0 * tasks_failed / number_of_tasks if number_of_tasks else 0.0, 'Percent'),
+        'StageDuration': ((termination_time - creation_time).total_seconds() if creation_time and termination_time else None, 'Seconds')
+    }, properties)
 
 
 def lambda_handler(event, context):
@@ -84,12 +159,18 @@ def lambda_handler(event, context):
         # s3Bucket = str(event['detail']['bucket']['name'])
         # s3Key = parse.unquote_plus(event['detail']['object']['key'], encoding='utf-8')
         # etag = str(event['detail']['object']['etag'])                  
-        s3Bucket = str(event['Records'][0]['s3']['bucket']['name'])
-        s3Key = parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
-        etag = str(event['Records'][0]['s3']['object']['eTag'])
-        logger.info(f"S3 Key is: {s3Key}")
-        retrieve_job_id = s3Key.split('/')[-2]
-        job_id = retrieve_job_id.replace('job-', '', 1)
+        if event.get('detail-type'):
+            # Failed and cancelled jobs can end without a completion report, for example a day without logs
+            # has an empty manifest, their status change comes from EventBridge
+            job_id = str(event['detail']['serviceEventDetails']['jobId'])
+            etag = job_id
+        else:
+            s3Bucket = str(event['Records'][0]['s3']['bucket']['name'])
+            s3Key = parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+            etag = str(event['Records'][0]['s3']['object']['eTag'])
+            logger.info(f"S3 Key is: {s3Key}")
+            retrieve_job_id = s3Key.split('/')[-2]
+            job_id = retrieve_job_id.replace('job-', '', 1)
         my_job_details = s3_batch_describe_job(job_id)
         logger.info(f"Batch Operation Job details: {my_job_details}")
         job_operation = list(my_job_details.get('Operation').keys())[0]
@@ -97,14 +178,52 @@ def lambda_handler(event, context):
         job_arn = my_job_details.get('JobArn')
         job_creation_datetime = str(my_job_details.get('CreationTime'))
         job_completion_datetime = str(my_job_details.get('TerminationDate'))
-        number_of_tasks = my_job_details.get('ProgressSummary').get('TotalNumberOfTasks')
+        number_of_tasks = my_job_details.get('ProgressSummary', {}).get('TotalNumberOfTasks', 0)
         # number_of_fields = str(len(my_job_details.get('Manifest').get('Spec').get('Fields')))
-        tasks_succeeded = my_job_details.get('ProgressSummary').get('NumberOfTasksSucceeded')
-        tasks_failed = my_job_details.get('ProgressSummary').get('NumberOfTasksFailed')
+        tasks_succeeded = my_job_details.get('ProgressSummary', {}).get('NumberOfTasksSucceeded', 0)
+        tasks_failed = my_job_details.get('ProgressSummary', {}).get('NumberOfTasksFailed', 0)
         logger.info(f'Number of Tasks: {number_of_tasks}')
         logger.info(f'Tasks_succeeded: {tasks_succeeded}')
         logger.info(f'Tasks_failed: {tasks_failed}')
 
+        # Only work on Tagged Jobs
+        job_tags = get_job_tagging(job_id)
+        if job_tags.get(job_tag_key) != job_tag_value or job_operation != 'S3PutObjectCopy':
+            logger.info(f"Job {job_id} was not created by the support tool, nothing to do!")
+            return
+        put_copy_metrics('CopyJob', number_of_tasks, tasks_succeeded, tasks_failed, my_job_details.get('CreationTime'), my_job_details.get('TerminationDate'), {'JobId': job_id, 'JobStatus': job_status})
+
+        # Copy jobs are created one per log day, wait until every job of the run has finished
+        job_run_id = job_tags.get(job_run_id_tag_key)
+        if job_run_id:
+            job_run_size = int(job_tags.get(job_run_size_tag_key, 1))
+            run_jobs = list_run_jobs(job_run_id)
+            logger.info(f'Run {job_run_id}: {len(run_jobs)} of {job_run_size} copy jobs finished')
+            if len(run_jobs) < job_run_size:
+                return
+            if not claim_run_completion(job_run_id):
+                logger.info(f'Run {job_run_id} completion already claimed, nothing to do!')
+                return
+            job_status = 'Complete' if any(job.get('Status') == 'Complete' for job in run_jobs) else 'Failed'
+            number_of_tasks = sum(job.get('ProgressSummary', {}).get('TotalNumberOfTasks', 0) for job in run_jobs)
+            tasks_succeeded = sum(job.get('ProgressSummary', {}).get('NumberOfTasksSucceeded', 0) for job in run_jobs)
+            tasks_failed = sum(job.get('ProgressSummary', {}).get('NumberOfTasksFailed', 0) for job in run_jobs)
+            # The run id is the request token of the rest of the workflow
+            etag = job_run_id
+            job_id = ', '.join(job.get('JobId') for job in run_jobs)
+            logger.info(f'Run Number of Tasks: {number_of_tasks}')
+            logger.info(f'Run Tasks_succeeded: {tasks_succeeded}')
+            logger.info(f'Run Tasks_failed: {tasks_failed}')
+            put_copy_metrics('CopyRun', number_of_tasks, tasks_succeeded, tasks_failed,
+                             min((job['CreationTime'] for job in run_jobs if job.get('CreationTime')), default=None),
+                             max((job['TerminationDate'] for job in run_jobs if job.get('TerminationDate')), default=None),
+                             {'RunId': job_run_id, 'JobStatus': job_status})
+            # Days without logs end as failed jobs with an empty manifest, the days are reported with the run
+            failed_run_days = sorted(str(job.get('Description', '')).split(':', 1)[-1] for job in run_jobs if job.get('Status') != 'Complete')
+            if failed_run_days:
+                send_sns_message(my_sns_topic_arn, f"{len(failed_run_days)} of {job_run_size} copy jobs of run {job_run_id} failed or were cancelled, "
+                                                   f"the logs of these days are missing from the analyses: {', '.join(failed_run_days)}. Days without logs have an empty manifest and fail.")
+
         # Send a notification to the user if Batch Operations Job fails
         if job_status == 'Failed':
             my_sns_message = f'Batch Operations Copy Job Failed! Please check the Batch Operations Job JobID {job_id} Completion Report in the Amazon S3 Console for more details.'
@@ -118,31 +237,16 @@ def lambda_handler(event, context):
                 logger.info(f"{my_sns_message}")
                 send_sns_message(my_sns_topic_arn, my_sns_message)
             else:
-                job_details = str(my_job_details)
-                # Only work on Tagged Jobs
-                job_tag_key, job_tag_value = get_job_tagging(job_id)
                 # Trigger next workflow for a Successfully Completed Copy Job
-                if job_operation == 'S3PutObjectCopy':
-                    # Starting Condition
-                    if job_tag_key == 'job-created-by' and job_tag_value == 'aws-support-troubleshooting-tool-for-s3' and job_status == 'Complete':
-                        my_sns_message = f'Copy Job {job_id} Completed: {tasks_failed} failed out of {number_of_tasks}. Please check the Batch Operations Job JobID {job_id} in the Amazon S3 Console for more details.'
-                        logger.info(f"{my_sns_message}")
-                        # Start Athena Query Function Invoke
-                        # Generate Payload for Invocation:
-                        my_payload = {"my_etag": etag}
-                        my_payload_json = json.dumps(my_payload)                                  
-                        send_sns_message(my_sns_topic_arn, my_sns_message)
-                        # Send notification for Athena query start
-                        my_sns_message = f'Starting Athena Query'
-                        logger.info(f"{my_sns_message}")
-                        send_sns_message(my_sns_topic_arn, my_sns_message)
-                        invoke_query_funct = invoke_function(query_function_name, function_invocation_type, my_payload_json)
-                        logger.info(invoke_query_funct)                               
-
-                    elif job_tag_key == 'job-created-by' and job_tag_value == 'aws-support-troubleshooting-tool-for-s3' and job_status == 'Failed':
-                        my_sns_message = f'S3 Logs Copy Job {job_id} failed, please check the Batch Operations Job JobID {job_id} in the Amazon S3 Console for more details!'
-                        logger.info(f"{my_sns_message}")
-                        send_sns_message(my_sns_topic_arn, my_sns_message)
+                my_sns_message = f'Copy Job {job_id} Completed: {tasks_failed} failed out of {number_of_tasks}. Please check the Batch Operations Job JobID {job_id} in the Amazon S3 Console for more details.'
+                logger.info(f"{my_sns_message}")
+                # Start Parquet Conversion Function Invoke, it waits for the copied logs to be parsed, then the Athena Query follows
+                # Generate Payload for Invocation:
+                my_payload = {"my_etag": etag}
+                my_payload_json = json.dumps(my_payload)                                  
+                send_sns_message(my_sns_topic_arn, my_sns_message)
+                invoke_conversion_funct = invoke_function(conversion_function_name, function_invocation_type_async, my_payload_json)
+                logger.info(invoke_conversion_funct)                               
 
     except Exception as e:
         logger.error(e)
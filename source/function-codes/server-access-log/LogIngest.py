@@ -0,0 +1,213 @@
+import json
+from botocore.exceptions import ClientError
+import logging
+import os
+import datetime
+import hashlib
+import io
+import re
+import time
+import boto3
+import pyarrow
+import pyarrow.parquet
+from urllib import parse
+
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel('INFO')
+
+# Enable Debug Logging
+# boto3.set_stream_logger("")
+
+
+# Define Environmental Variables
+my_region = str(os.environ['AWS_REGION'])
+my_tool_bucket = str(os.environ['tool_bucket'])
+my_parsed_location = str(os.environ['parsed_location'])
+
+# Other Variables
+# S3 server access log line, the same expression as the RegexSerDe of the raw Glue table
+access_log_pattern = re.compile(r'([^ ]*) ([^ ]*) \[(.*?)\] ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ("[^"]*"|-) (-|[0-9]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ("[^"]*"|-) ([^ ]*)(?: ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*))?.*$')
+access_log_columns = ['bucketowner', 'bucket_name', 'requestdatetime', 'remoteip', 'requester', 'requestid', 'operation', 'key', 'request_uri', 'httpstatus', 'errorcode', 'bytessent', 'objectsize', 'totaltime', 'turnaroundtime', 'referrer', 'useragent', 'versionid', 'hostid', 'sigv', 'ciphersuite', 'authtype', 'endpoint', 'tlsversion', 'accesspointarn', 'aclrequired']
+# Typed like the Parquet table, values that are not numbers such as - are null
+numeric_columns = ['httpstatus', 'bytessent', 'objectsize', 'totaltime', 'turnaroundtime']
+# Schema of the parsed Parquet parts, the columns and types of the Glue parsed table
+parsed_schema = pyarrow.schema([
+    (column, pyarrow.timestamp('ms') if column == 'requestdatetime' else pyarrow.int32() if column in ['httpstatus', 'totaltime', 'turnaroundtime'] else pyarrow.int64() if column in numeric_columns else pyarrow.string())
+    for column in access_log_columns
+])
+# Rows of a day are written to a new part once this many bytes of log lines of a batch are buffered
+max_part_bytes = 32 * 1024 * 1024
+# Log objects are read in chunks of this size
+read_chunk_bytes = 1024 * 1024
+# Stop starting new log objects when less time than this is left, the rest of the batch is retried
+completion_margin_millis = 30000
+
+
+# Set Service Client
+s3Client = boto3.client('s3', region_name=my_region)
+
+
+# Embedded Metrics Function, set metrics_file to write the records to a local file
+metrics_namespace = 'AWSSupportTroubleshootingToolForS3'
+my_metrics_file = os.environ.get('metrics_file')
+
+
+def put_metrics(dimensions, metrics, properties=None):
+    # metrics maps each metric name to a (value, unit) pair, metrics without a value are left out
+    metrics = {name: metric for name, metric in metrics.items() if metric[0] is not None}
+    emf_record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': metrics_namespace,
+                'Dimensions': [list(dimensions.keys())],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in metrics.items()]
+            }]
+        },
+        'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    }
+    emf_record.update(properties or {})
+    emf_record.update(dimensions)
+    emf_record.update({name: value for name, (value, unit) in metrics.items()})
+    emf_line = json.dumps(emf_record, default=str)
+    if my_metrics_file:
+        with open(my_metrics_file, 'a') as metrics_file:
+            metrics_file.write(f'{emf_line}\n')
+    else:
+        print(emf_line, flush=True)
+
+
+# Log Parser #####################################################
+# Each log line is parsed once here, as the copy job writes the log object. The rows are typed like the
+# Parquet table: the request time in UTC and the numbers as integers, the other fields are kept as logged.
+
+# Parse a log line into a row, returns None for a line that does not match or has no valid request time
+def parse_log_line(log_line):
+    log_match = access_log_pattern.match(log_line)
+    if not log_match:
+        return None
+    log_row = dict(zip(access_log_columns, log_match.groups()))
+    try:
+        log_row['requestdatetime'] = datetime.datetime.strptime(log_row['requestdatetime'], '%d/%b/%Y:%H:%M:%S %z').astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return None
+    for column in numeric_columns:
+        log_row[column] = int(log_row[column]) if log_row[column] and log_row[column].isdigit() else None
+    return log_row
+
+
+# Parsed Row Writer ##############################################
+# The rows of the log objects of a batch are buffered per request day, as columns, and written as Parquet parts under
+# <parsed location>/dt=YYYY-MM-DD/ with the pyarrow library of the AWS SDK for pandas layer. A day part is uploaded once
+# it holds max_part_bytes of log lines and the rest at the end of the batch, so a batch writes one object per day
+# instead of one per log object. A part holds whole log objects and is named after them, the same log objects ingested
+# again overwrite their own part.
+
+# Open a new part of a day writer, the rows are buffered as columns until it is flushed
+def open_day_part(day_writer):
+    day_writer['part_columns'] = {column: [] for column in access_log_columns}
+    day_writer['part_bytes'] = 0
+    day_writer['source_names'] = []
+
+
+# Writer of the rows of one request day
+def new_day_writer(log_day):
+    day_writer = {'day_prefix': f'{my_parsed_location}/dt={log_day}/', 'parts_written': 0, 'rows_written': 0}
+    open_day_part(day_writer)
+    return day_writer
+
+
+# Upload the current part of a day writer as a Parquet object, named after the log objects it holds
+def flush_day_part(day_writer):
+    if day_writer['part_bytes']:
+        part_name = hashlib.sha256('\n'.join(sorted(day_writer['source_names'])).encode('utf-8')).hexdigest()
+        part_buffer = io.BytesIO()
+        pyarrow.parquet.write_table(pyarrow.table(day_writer['part_columns'], schema=parsed_schema), part_buffer, compression='snappy')
+        s3Client.put_object(Bucket=my_tool_bucket, Key=f"{day_writer['day_prefix']}{part_name}.parquet",
+                            Body=part_buffer.getvalue(), ContentType='application/vnd.apache.parquet')
+        day_writer['parts_written'] += 1
+
+
+# Append the rows of a log object to a day writer, the part is flushed and a new one opened once it reaches max_part_bytes
+def write_day_rows(day_writer, source_name, log_rows, rows_bytes):
+    for column, values in day_writer['part_columns'].items():
+        values.extend(log_row[column] for log_row in log_rows)
+    day_writer['part_bytes'] += rows_bytes
+    day_writer['rows_written'] += len(log_rows)
+    day_writer['source_names'].append(source_name)
+    if day_writer['part_bytes'] >= max_part_bytes:
+        flush_day_part(day_writer)
+        open_day_part(day_writer)
+
+
+# Parse a copied log object, returns the number of lines read, its rows per request day and their bytes of log lines
+def parse_log_object(s3Bucket, s3Key):
+    day_rows = {}
+    day_bytes = {}
+    lines_read = 0
+    log_object = s3Client.get_object(Bucket=s3Bucket, Key=s3Key)
+    for log_line in log_object['Body'].iter_lines(chunk_size=read_chunk_bytes):
+        if not log_line:
+            continue
+        lines_read += 1
+        log_row = parse_log_line(log_line.decode('utf-8', errors='replace'))
+        if log_row is None:
+            continue
+        log_day = log_row['requestdatetime'].strftime('%Y-%m-%d')
+        day_rows.setdefault(log_day, []).append(log_row)
+        day_bytes[log_day] = day_bytes.get(log_day, 0) + len(log_line)
+    return lines_read, day_rows, day_bytes
+
+
+# Copied log objects of an SQS message, the message body is an S3 event notification
+def get_log_objects(sqs_record):
+    s3_event = json.loads(sqs_record['body'])
+    # The test event sent when the notification is configured has no records
+    return [(str(s3_record['s3']['bucket']['name']), parse.unquote_plus(s3_record['s3']['object']['key'], encoding='utf-8'))
+            for s3_record in s3_event.get('Records', [])]
+
+
+def lambda_handler(event, context):
+    my_stage_start = time.monotonic()
+    my_failed_message_ids = []
+    my_day_writers = {}
+    my_objects_ingested = 0
+    my_lines_read = 0
+    for sqs_record in event.get('Records', []):
+        # Messages that are not started in time are returned to the queue with the failed ones
+        if context.get_remaining_time_in_millis() < completion_margin_millis:
+            my_failed_message_ids.append(sqs_record['messageId'])
+            continue
+        try:
+            # The rows of a message are only buffered once all its log objects are parsed
+            my_message_objects = []
+            for s3Bucket, s3Key in get_log_objects(sqs_record):
+                lines_read, day_rows, day_bytes = parse_log_object(s3Bucket, s3Key)
+                logger.info(f'Parsed s3://{s3Bucket}/{s3Key}: {sum(len(log_rows) for log_rows in day_rows.values())} rows of {lines_read} lines')
+                my_message_objects.append((hashlib.sha256(f'{s3Bucket}/{s3Key}'.encode('utf-8')).hexdigest(), lines_read, day_rows, day_bytes))
+        except (ClientError, ValueError, KeyError) as e:
+            logger.error(f"Failed to ingest message {sqs_record['messageId']}: {e}")
+            my_failed_message_ids.append(sqs_record['messageId'])
+            continue
+        for source_name, lines_read, day_rows, day_bytes in my_message_objects:
+            for log_day, log_rows in day_rows.items():
+                if log_day not in my_day_writers:
+                    my_day_writers[log_day] = new_day_writer(log_day)
+                write_day_rows(my_day_writers[log_day], source_name, log_rows, day_bytes[log_day])
+            my_objects_ingested += 1
+            my_lines_read += lines_read
+    for day_writer in my_day_writers.values():
+        flush_day_part(day_writer)
+    my_rows_written = sum(day_writer['rows_written'] for day_writer in my_day_writers.values())
+    put_metrics({'Stage': 'LogIngest'}, {
+        'ObjectsIngested': (my_objects_ingested, 'Count'),
+        'LinesRead': (my_lines_read, 'Count'),
+        'LinesSkipped': (my_lines_read - my_rows_written, 'Count'),
+        'PartsWritten': (sum(day_writer['parts_written'] for day_writer in my_day_writers.values()), 'Count'),
+        'MessagesRetried': (len(my_failed_message_ids), 'Count'),
+        'StageDuration': ((time.monotonic() - my_stage_start) * 1000, 'Milliseconds')
+    })
+    # Partial batch response, only the failed and the unstarted messages return to the queue
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in my_failed_message_ids]}
@@ -0,0 +1,374 @@
+import json
+from botocore.exceptions import ClientError
+import logging
+import os
+import datetime
+import time
+import uuid
+import boto3
+
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel('INFO')
+
+# Enable Debug Logging
+# boto3.set_stream_logger("")
+
+
+# Define Environmental Variables
+my_region = str(os.environ['AWS_REGION'])
+my_glue_db = str(os.environ['glue_db'])
+my_glue_parsed_tbl = str(os.environ['glue_parsed_tbl'])
+my_glue_tbl = str(os.environ['glue_tbl'])
+my_workgroup_name = str(os.environ['etl_workgroup_name'])
+my_tool_bucket = str(os.environ['tool_bucket'])
+my_parquet_location = str(os.environ['parquet_location'])
+my_glue_rollup_tbl = str(os.environ['glue_rollup_tbl'])
+my_rollup_location = str(os.environ['rollup_location'])
+my_rollup_state_key = str(os.environ['rollup_state_key'])
+my_run_marker_prefix = str(os.environ['run_marker_prefix'])
+my_ingest_queue_url = str(os.environ['ingest_queue_url'])
+my_ingest_dead_letter_queue_url = str(os.environ['ingest_dead_letter_queue_url'])
+my_query_logs_before = str(os.environ['query_logs_before'])
+my_query_logs_after = str(os.environ['query_logs_after'])
+query_function_name = str(os.environ['query_function'])
+my_sns_topic_arn = str(os.environ['sns_topic_arn'])
+
+# Other Variables
+function_invocation_type_async = 'Event'
+# Athena INSERT INTO writes at most 100 partitions per query
+max_partitions_per_query = 100
+query_poll_interval_seconds = 5
+# Hand the remaining days over to a new invocation when less time than this is left
+continuation_margin_millis = 120000
+# The copied logs are parsed once the ingest queue has stayed empty this long
+ingest_quiet_seconds = 60
+ingest_poll_interval_seconds = 15
+# Number of dead-letter messages already notified
+dead_letter_state_name = 'ingest-dead-letter.json'
+# Queries run for every chunk of days, the rollup summarizes the days the conversion has just written
+conversion_steps = ['ParquetConversion', 'Rollup']
+
+logger.info(f'my_query_logs_before is: {my_query_logs_before}')
+logger.info(f'my_query_logs_after is: {my_query_logs_after}')
+
+
+# Set Service Client
+athena_client = boto3.client('athena', region_name=my_region)
+s3Client = boto3.client('s3', region_name=my_region)
+glueClient = boto3.client('glue', region_name=my_region)
+lambdaClient = boto3.client('lambda', region_name=my_region)
+sqsClient = boto3.client('sqs', region_name=my_region)
+sns = boto3.client('sns', region_name=my_region)
+
+
+# SNS Message Function
+def send_sns_message(sns_topic_arn, sns_message):
+    logger.info("Sending SNS Notification Message......")
+    sns_subject = 'Notification from AWS Support Troubleshooting Tool'
+    try:
+        response = sns.publish(TopicArn=sns_topic_arn, Message=sns_message, Subject=sns_subject)
+    except ClientError as e:
+        logger.error(e)
+
+
+# Embedded Metrics Function, set metrics_file to write the records to a local file
+metrics_namespace = 'AWSSupportTroubleshootingToolForS3'
+my_metrics_file = os.environ.get('metrics_file')
+
+
+def put_metrics(dimensions, metrics, properties=None):
+    # metrics maps each metric name to a (value, unit) pair, metrics without a value are left out
+    metrics = {name: metric for name, metric in metrics.items() if metric[0] is not None}
+    emf_record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': metrics_namespace,
+                'Dimensions': [list(dimensions.keys())],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in metrics.items()]
+            }]
+        },
+        'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    }
+    emf_record.update(properties or {})
+    emf_record.update(dimensions)
+    emf_record.update({name: value for name, (value, unit) in metrics.items()})
+    emf_line = json.dumps(emf_record, default=str)
+    if my_metrics_file:
+        with open(my_metrics_file, 'a') as metrics_file:
+            metrics_file.write(f'{emf_line}\n')
+    else:
+        print(emf_line, flush=True)
+
+
+# Function to Invoke Lambda Functions
+def invoke_function(function_name, invocation_type, payload):
+    invoke_response = lambdaClient.invoke(
+        FunctionName=function_name,
+        InvocationType=invocation_type,
+        Payload=payload,
+
+    )
+    response_payload = invoke_response['Payload'].read().decode("utf-8")
+    return json.loads(response_payload) if response_payload else invoke_response.get('StatusCode')
+
+
+# Return the dt partition values (YYYY-MM-DD) of the query window
+def get_partition_days(query_logs_after, query_logs_before):
+    partition_days = []
+    partition_day = datetime.datetime.strptime(query_logs_after, '%Y-%m-%d')
+    last_day = datetime.datetime.strptime(query_logs_before, '%Y-%m-%d')
+    while partition_day < last_day:
+        partition_days.append(partition_day.strftime('%Y-%m-%d'))
+        partition_day = partition_day + datetime.timedelta(days=1)
+    return partition_days
+
+
+# Log Ingest #####################################################
+# The copied log objects are parsed by the log ingest function as they arrive, through the ingest queue.
+# The conversion starts once every copied object is parsed, when the queue has stayed empty for the quiet period.
+
+# Number of messages in a queue, visible, in flight and delayed
+def get_queue_messages(queue_url):
+    queue_attributes = sqsClient.get_queue_attributes(
+        QueueUrl=queue_url,
+        AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible', 'ApproximateNumberOfMessagesDelayed']
+    ).get('Attributes', {})
+    return sum(int(message_count) for message_count in queue_attributes.values())
+
+
+# Number of dead-letter messages already notified, kept next to the run manifests
+def get_reported_dead_letter_messages():
+    try:
+        return json.loads(s3Client.get_object(Bucket=my_tool_bucket, Key=f'{my_run_marker_prefix}{dead_letter_state_name}')['Body'].read()).get('reported_messages', 0)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        return 0
+
+
+def put_reported_dead_letter_messages(reported_messages):
+    s3Client.put_object(Bucket=my_tool_bucket, Key=f'{my_run_marker_prefix}{dead_letter_state_name}',
+                        Body=json.dumps({'reported_messages': reported_messages}), ContentType='application/json')
+
+
+# Wait for the ingest queue to drain, returns False when the invocation runs out of time
+def wait_for_ingest(context):
+    my_quiet_since = None
+    while context.get_remaining_time_in_millis() > continuation_margin_millis:
+        if get_queue_messages(my_ingest_queue_url):
+            my_quiet_since = None
+        elif my_quiet_since is None:
+            my_quiet_since = time.monotonic()
+        elif time.monotonic() - my_quiet_since >= ingest_quiet_seconds:
+            break
+        time.sleep(ingest_poll_interval_seconds)
+    else:
+        return False
+    # Log objects that failed to parse are left in the dead-letter queue, their rows are missing from the analyses
+    # Only the messages added since the last notification are reported, the older ones belong to earlier runs
+    my_dead_letter_messages = get_queue_messages(my_ingest_dead_letter_queue_url)
+    my_failed_messages = max(0, my_dead_letter_messages - get_reported_dead_letter_messages())
+    put_metrics({'Stage': 'LogIngest'}, {'MessagesFailed': (my_failed_messages, 'Count')})
+    if my_failed_messages:
+        send_sns_message(my_sns_topic_arn, f'{my_failed_messages} copied log notifications could not be parsed and are kept in the ingest dead-letter queue, the logs they name are missing from the analyses.')
+    put_reported_dead_letter_messages(my_dead_letter_messages)
+    return True
+
+
+# Remove the Parquet data of the given days, so converting the same days again does not duplicate rows
+def delete_partitions(glue_tbl, location, partition_days):
+    paginator = s3Client.get_paginator('list_objects_v2')
+    for partition_day in partition_days:
+        partition_prefix = f'{location}/dt={partition_day}/'
+        for page in paginator.paginate(Bucket=my_tool_bucket, Prefix=partition_prefix):
+            objects_to_delete = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if objects_to_delete:
+                s3Client.delete_objects(Bucket=my_tool_bucket, Delete={'Objects': objects_to_delete, 'Quiet': True})
+    # BatchDeletePartition accepts up to 25 partitions per call
+    for i in range(0, len(partition_days), 25):
+        response = glueClient.batch_delete_partition(
+            DatabaseName=my_glue_db,
+            TableName=glue_tbl,
+            PartitionsToDelete=[{'Values': [partition_day]} for partition_day in partition_days[i:i + 25]]
+        )
+        for error in response.get('Errors', []):
+            if error.get('ErrorDetail', {}).get('ErrorCode') != 'EntityNotFoundException':
+                logger.error(error)
+
+
+# Convert the parsed logs of the given days into the Parquet table
+# The ingest function has already parsed and typed the rows by request day and written them as Parquet, nothing is
+# parsed or cast here. The parsed parts are small, one per day of every ingest batch, they are read once by this query
+# and Athena writes the Parquet table in large files
+def build_insert_query(partition_days):
+    return f"""
+    INSERT INTO "{my_glue_db}"."{my_glue_tbl}"
+    SELECT bucketowner, bucket_name, requestdatetime, remoteip, requester, requestid, operation, key, request_uri, httpstatus, errorcode, bytessent, objectsize, totaltime, turnaroundtime, referrer, useragent, versionid, hostid, sigv, ciphersuite, authtype, endpoint, tlsversion, accesspointarn, aclrequired,
+    dt
+    FROM "{my_glue_db}"."{my_glue_parsed_tbl}"
+    WHERE dt BETWEEN '{partition_days[0]}' AND '{partition_days[-1]}' ;
+    """
+
+
+# Daily Rollup ###################################################
+# The rollup table keeps counts, bytes and latency digests per day, bucket, operation, status and requester.
+# A day is complete once it is rolled up from the Parquet rows of the latest conversion. It is no longer complete while
+# a conversion rewrites its Parquet rows, until it is rolled up again. Complete days are kept in the rollup state object
+# with the watermark, the latest complete day. The Athena Query function answers aggregate analyses from the rollup
+# table when every day of the query window is complete.
+
+# Return the complete days of the rollup table
+def get_rollup_completed_days():
+    try:
+        rollup_state = json.loads(s3Client.get_object(Bucket=my_tool_bucket, Key=my_rollup_state_key)['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        return []
+    return rollup_state.get('completed_days', [])
+
+
+# Add the rolled up days to the rollup state and remove the days being converted again
+def put_rollup_completed_days(rolled_up_days=(), converted_days=()):
+    completed_days = (set(get_rollup_completed_days()) - set(converted_days)) | set(rolled_up_days)
+    rollup_state = {'completed_days': sorted(completed_days), 'watermark': max(completed_days, default=None)}
+    s3Client.put_object(Bucket=my_tool_bucket, Key=my_rollup_state_key, Body=json.dumps(rollup_state), ContentType='application/json')
+    return rollup_state
+
+
+# Aggregate the converted days into the rollup table, latency digests are stored as varbinary and merged at query time
+def build_rollup_query(partition_days):
+    return f"""
+    INSERT INTO "{my_glue_db}"."{my_glue_rollup_tbl}"
+    SELECT bucket_name, operation, httpstatus, requester,
+    COUNT(*) AS request_count,
+    SUM(bytessent) AS bytes_sent,
+    SUM(objectsize) AS object_bytes,
+    COUNT(turnaroundtime) AS latency_count,
+    CAST(qdigest_agg(CAST(turnaroundtime AS bigint)) AS varbinary) AS turnaroundtime_digest,
+    CAST(qdigest_agg(CAST(totaltime AS bigint)) AS varbinary) AS totaltime_digest,
+    dt
+    FROM "{my_glue_db}"."{my_glue_tbl}"
+    WHERE dt IN ({', '.join(f"'{partition_day}'" for partition_day in partition_days)})
+    GROUP BY dt, bucket_name, operation, httpstatus, requester ;
+    """
+
+
+# Start the query of a step for a chunk of days
+def start_step_query(step, partition_days):
+    if step == 'Rollup':
+        delete_partitions(my_glue_rollup_tbl, my_rollup_location, partition_days)
+        query_string = build_rollup_query(partition_days)
+    else:
+        # The rollup of the days no longer matches their Parquet rows once they are rewritten
+        put_rollup_completed_days(converted_days=partition_days)
+        delete_partitions(my_glue_tbl, my_parquet_location, partition_days)
+        query_string = build_insert_query(partition_days)
+    # A new token per start, the days were just deleted so a repeated start has to rewrite them
+    return start_query_execution(query_string, my_glue_db, my_workgroup_name, str(uuid.uuid4()))
+
+
+def start_query_execution(query_string, athena_db, workgroup_name, job_request_token):
+    logger.info(f'Starting Athena query...... with query string: {query_string}')
+    execute_query = athena_client.start_query_execution(
+        QueryString=query_string,
+        QueryExecutionContext={
+            'Database': athena_db
+        },
+        WorkGroup=workgroup_name,
+        ClientRequestToken=job_request_token,
+    )
+    logger.info(f'Query Started: {execute_query}')
+    return execute_query['QueryExecutionId']
+
+
+# Wait for an Athena query to finish and return its final state, or None when the invocation runs out of time
+def wait_for_query(query_execution_id, context, step):
+    while context.get_remaining_time_in_millis() > continuation_margin_millis:
+        query_execution = athena_client.get_query_execution(QueryExecutionId=query_execution_id).get('QueryExecution')
+        query_status = query_execution.get('Status')
+        if query_status.get('State') in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
+            logger.info(f'Query {query_execution_id} finished: {query_status}')
+            query_statistics = query_execution.get('Statistics', {})
+            put_metrics({'Stage': step}, {
+                'DataScannedInBytes': (query_statistics.get('DataScannedInBytes'), 'Bytes'),
+                'EngineExecutionTime': (query_statistics.get('EngineExecutionTimeInMillis'), 'Milliseconds'),
+                'QueryQueueTime': (query_statistics.get('QueryQueueTimeInMillis'), 'Milliseconds')
+            }, {'QueryExecutionId': query_execution_id, 'State': query_status.get('State')})
+            return query_status.get('State'), query_status.get('StateChangeReason')
+        time.sleep(query_poll_interval_seconds)
+    return None, None
+
+
+# Continue the conversion in a new invocation with the days that are left
+def continue_conversion(context, request_token, partition_days, pending_step, pending_query_id, ingest_complete=True):
+    logger.info(f'Continuing conversion of {len(partition_days)} days in a new invocation')
+    my_payload = {"my_etag": request_token, "partition_days": partition_days, "pending_step": pending_step, "pending_query_id": pending_query_id,
+                  "ingest_complete": ingest_complete}
+    invoke_function(context.function_name, function_invocation_type_async, json.dumps(my_payload))
+    return {
+        'statusCode': 202,
+        'body': json.dumps('Conversion continued in a new invocation')
+    }
+
+
+def lambda_handler(event, context):
+    logger.info(event)
+    # Use Etag to prevent duplicate invocation
+    my_request_token = event.get('my_etag')
+    logger.info(f'Initiating Main Function...')
+
+    try:
+        # A continued invocation carries the days that are still to be converted
+        my_partition_days = event.get('partition_days')
+        if my_partition_days is None:
+            my_partition_days = get_partition_days(my_query_logs_after, my_query_logs_before)
+            send_sns_message(my_sns_topic_arn, f'Converting {len(my_partition_days)} days of copied logs to Parquet')
+        if not event.get('ingest_complete') and not wait_for_ingest(context):
+            return continue_conversion(context, my_request_token, my_partition_days, None, None, False)
+
+        my_pending_step = event.get('pending_step') or conversion_steps[0]
+        my_pending_query_id = event.get('pending_query_id')
+        while my_partition_days:
+            my_chunk_days = my_partition_days[:max_partitions_per_query]
+            if my_pending_query_id is None:
+                if context.get_remaining_time_in_millis() < continuation_margin_millis:
+                    return continue_conversion(context, my_request_token, my_partition_days, my_pending_step, None)
+                my_pending_query_id = start_step_query(my_pending_step, my_chunk_days)
+            my_query_state, my_state_reason = wait_for_query(my_pending_query_id, context, my_pending_step)
+            if my_query_state is None:
+                return continue_conversion(context, my_request_token, my_partition_days, my_pending_step, my_pending_query_id)
+            if my_query_state != 'SUCCEEDED':
+                raise RuntimeError(f'{my_pending_step} query {my_pending_query_id} {my_query_state}: {my_state_reason}')
+            if my_pending_step == 'Rollup':
+                my_rollup_state = put_rollup_completed_days(rolled_up_days=my_chunk_days)
+                put_metrics({'Stage': 'Rollup'}, {'CompletedDays': (len(my_rollup_state['completed_days']), 'Count')},
+                            {'RequestToken': my_request_token, 'Watermark': my_rollup_state['watermark']})
+            else:
+                put_metrics({'Stage': 'ParquetConversion'}, {'DaysConverted': (len(my_chunk_days), 'Count')}, {'RequestToken': my_request_token})
+            my_pending_query_id = None
+            # Move to the next step, or to the next chunk of days after the last step
+            if my_pending_step == conversion_steps[-1]:
+                my_pending_step = conversion_steps[0]
+                my_partition_days = my_partition_days[max_partitions_per_query:]
+            else:
+                my_pending_step = conversion_steps[conversion_steps.index(my_pending_step) + 1]
+
+        # Conversion is complete, start the Athena analysis on the Parquet table
+        my_sns_message = f'Starting Athena Query'
+        logger.info(f"{my_sns_message}")
+        send_sns_message(my_sns_topic_arn, my_sns_message)
+        invoke_query_funct = invoke_function(query_function_name, function_invocation_type_async, json.dumps({"my_etag": my_request_token}))
+        logger.info(invoke_query_funct)
+    except Exception as e:
+        logger.error(e)
+        send_sns_message(my_sns_topic_arn, f'Parquet conversion of the copied logs failed: {e}')
+        raise
+    else:
+        return {
+            'statusCode': 200,
+            'body': json.dumps('Successful Invocation!')
+        }
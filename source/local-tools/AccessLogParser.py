@@ -0,0 +1,231 @@
+import argparse
+import datetime
+import glob
+import gzip
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import time
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+# Parse S3 server access log files into columns, with the same semantics as the RegexSerDe of the raw Glue table
+# Log files are read in chunks of whole lines, through mmap or a streaming gzip reader, and each chunk is parsed
+# with one regular expression scan. The rows of a chunk are returned as a batch of columns, typed like the Parquet
+# table: requestdatetime as a UTC datetime, the numbers as integers and the other fields as logged. Lines that do not
+# match the expression are skipped. Batches are converted to Arrow record batches when pyarrow is installed.
+#
+# Usage:
+#   python3 AccessLogParser.py --logs 'logs/*' --workers 4
+#
+# As a library:
+#   for columns, lines_read in AccessLogParser.parse_file('logs/2024-01-01-00-00-00-0000000000000000'):
+#       print(len(columns['requestid']), 'rows of', lines_read, 'lines')
+
+
+# Set up logging
+logging.basicConfig(format='%(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel('INFO')
+
+# S3 server access log line, the same expression as the RegexSerDe of the raw Glue table
+access_log_regex = r'([^ ]*) ([^ ]*) \[(.*?)\] ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ("[^"]*"|-) (-|[0-9]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ("[^"]*"|-) ([^ ]*)(?: ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*))?.*$'
+access_log_columns = ['bucketowner', 'bucket_name', 'requestdatetime', 'remoteip', 'requester', 'requestid', 'operation', 'key', 'request_uri', 'httpstatus', 'errorcode', 'bytessent', 'objectsize', 'totaltime', 'turnaroundtime', 'referrer', 'useragent', 'versionid', 'hostid', 'sigv', 'ciphersuite', 'authtype', 'endpoint', 'tlsversion', 'accesspointarn', 'aclrequired']
+# Fields of the optional group at the end of the expression, null when a line ends before them
+optional_columns = access_log_columns[18:]
+numeric_columns = ['httpstatus', 'bytessent', 'objectsize', 'totaltime', 'turnaroundtime']
+
+# The expression above runs on one line at a time. To scan a chunk of lines at once, it is anchored at the line
+# starts, its fields do not cross a line end, and the optional group is captured whole to tell a missing group
+# from empty fields.
+chunk_log_pattern = re.compile('^' + access_log_regex
+                               .replace('[^ ]*', '[^ \\n]*')
+                               .replace('"[^"]*"', '"[^"\\n]*"')
+                               .replace('(?: ', '( ', 1), re.MULTILINE)
+optional_group_index = len(access_log_columns) - len(optional_columns)
+
+# Log files are parsed in chunks of about this many bytes
+default_chunk_bytes = 16 * 1024 ** 2
+request_time_months = {month: index for index, month in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1)}
+
+# Arrow types of the columns, the same as the Parquet table
+arrow_column_types = {'requestdatetime': 'timestamp', 'httpstatus': 'int32', 'bytessent': 'int64', 'objectsize': 'int64', 'totaltime': 'int32', 'turnaroundtime': 'int32'}
+
+
+# Field Types ####################################################
+
+# Request time of a log line, [06/Feb/2019:00:00:38 +0000], as a UTC datetime, or None when it is not valid
+def parse_request_time(value):
+    try:
+        request_time = datetime.datetime(int(value[7:11]), request_time_months[value[3:6]], int(value[0:2]), int(value[12:14]), int(value[15:17]), int(value[18:20]))
+        if value[21:] == '+0000' and len(value) == 26:
+            return request_time
+        # Other offsets and unusual layouts are left to strptime
+        return datetime.datetime.strptime(value, '%d/%b/%Y:%H:%M:%S %z').astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    except (KeyError, ValueError):
+        return None
+
+
+def parse_number(value):
+    return int(value) if value.isascii() and value.isdigit() else None
+
+
+# Type the values of a column, each distinct value is converted once
+def convert_column(values, convert):
+    converted = {value: convert(value) for value in set(values)}
+    return [converted[value] for value in values]
+
+
+# Log Parser #####################################################
+
+# Parse a buffer of whole log lines, returns the columns of the matching lines and the number of lines read
+def parse_buffer(buffer):
+    text = buffer.decode('utf-8', errors='replace') if isinstance(buffer, (bytes, bytearray, memoryview)) else buffer
+    lines_read = text.count('\n') + (1 if text and not text.endswith('\n') else 0)
+    matches = chunk_log_pattern.findall(text)
+    if not matches:
+        return {column: [] for column in access_log_columns}, lines_read
+    fields = list(zip(*matches))
+    optional_group = fields.pop(optional_group_index)
+    columns = dict(zip(access_log_columns, fields))
+    if not all(optional_group):
+        for column in optional_columns:
+            columns[column] = [value if group else None for value, group in zip(columns[column], optional_group)]
+    columns['requestdatetime'] = convert_column(columns['requestdatetime'], parse_request_time)
+    for column in numeric_columns:
+        columns[column] = convert_column(columns[column], parse_number)
+    return {column: list(values) for column, values in columns.items()}, lines_read
+
+
+# Chunks of whole lines of a plain log file, read through mmap
+def read_mapped_chunks(log_file, chunk_bytes):
+    if os.fstat(log_file.fileno()).st_size == 0:
+        return
+    with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+        chunk_start = 0
+        while chunk_start < len(mapped_file):
+            if chunk_start + chunk_bytes >= len(mapped_file):
+                chunk_end = len(mapped_file)
+            else:
+                chunk_end = mapped_file.rfind(b'\n', chunk_start, chunk_start + chunk_bytes) + 1
+                if chunk_end <= chunk_start:
+                    # A line longer than a chunk, the chunk ends with the line
+                    chunk_end = mapped_file.find(b'\n', chunk_start + chunk_bytes) + 1 or len(mapped_file)
+            yield mapped_file[chunk_start:chunk_end]
+            chunk_start = chunk_end
+
+
+# Chunks of whole lines of a gzip log file, decompressed as it is read
+def read_gzip_chunks(log_file, chunk_bytes):
+    remainder = b''
+    with gzip.GzipFile(fileobj=log_file) as gzip_file:
+        while True:
+            chunk = gzip_file.read(chunk_bytes)
+            if not chunk:
+                break
+            chunk = remainder + chunk
+            chunk_end = chunk.rfind(b'\n') + 1
+            remainder = chunk[chunk_end:]
+            if chunk_end:
+                yield chunk[:chunk_end]
+    if remainder:
+        yield remainder
+
+
+def read_chunks(log_file_path, chunk_bytes=default_chunk_bytes):
+    with open(log_file_path, 'rb') as log_file:
+        # Gzip files are recognized by their magic number, copied logs keep the name of the source object
+        is_gzip = log_file.read(2) == b'\x1f\x8b'
+        log_file.seek(0)
+        yield from (read_gzip_chunks if is_gzip else read_mapped_chunks)(log_file, chunk_bytes)
+
+
+# Parse a log file, yields the columns and the number of lines read of every chunk
+def parse_file(log_file_path, chunk_bytes=default_chunk_bytes, arrow=False):
+    for chunk in read_chunks(log_file_path, chunk_bytes):
+        columns, lines_read = parse_buffer(chunk)
+        yield (to_record_batch(columns) if arrow else columns), lines_read
+
+
+# Arrow record batch of parsed columns
+def to_record_batch(columns):
+    if pyarrow is None:
+        raise ImportError('Arrow record batches need pyarrow, install it with pip install pyarrow')
+    arrow_types = {'timestamp': pyarrow.timestamp('ms'), 'int32': pyarrow.int32(), 'int64': pyarrow.int64()}
+    schema = pyarrow.schema([(column, arrow_types[arrow_column_types[column]] if column in arrow_column_types else pyarrow.string()) for column in access_log_columns])
+    return pyarrow.RecordBatch.from_arrays([pyarrow.array(columns[column], type=schema.field(column).type) for column in access_log_columns], schema=schema)
+
+
+# Parallel Parsing ###############################################
+
+# Parse a whole log file in a worker process, returns its batches with the lines read and the CPU seconds spent
+def parse_file_batches(parse_task):
+    log_file_path, chunk_bytes, arrow, keep_batches = parse_task
+    cpu_start = time.process_time()
+    batches = []
+    lines_read = 0
+    rows_parsed = 0
+    for batch, chunk_lines in parse_file(log_file_path, chunk_bytes, arrow):
+        lines_read += chunk_lines
+        rows_parsed += batch.num_rows if arrow else len(batch['requestid'])
+        if keep_batches:
+            batches.append(batch)
+    return {'path': log_file_path, 'batches': batches, 'lines_read': lines_read, 'rows_parsed': rows_parsed,
+            'bytes_read': os.path.getsize(log_file_path), 'cpu_seconds': time.process_time() - cpu_start}
+
+
+# Parse log files in a pool of processes, one file per task, yields the result of every file as it finishes
+# Set keep_batches to False to only count the rows, the batches are not sent back from the workers
+def parse_files(log_file_paths, workers=None, chunk_bytes=default_chunk_bytes, arrow=False, keep_batches=True):
+    with multiprocessing.Pool(workers or os.cpu_count()) as pool:
+        yield from pool.imap(parse_file_batches, [(log_file_path, chunk_bytes, arrow, keep_batches) for log_file_path in log_file_paths])
+
+
+# Parse the log files and report the throughput, lines per second of wall time and per second of CPU time of one core
+def run_benchmark(log_file_paths, workers, chunk_bytes, arrow):
+    wall_start = time.perf_counter()
+    file_results = list(parse_files(log_file_paths, workers, chunk_bytes, arrow, keep_batches=False))
+    wall_seconds = time.perf_counter() - wall_start
+    benchmark = {
+        'files': len(file_results),
+        'workers': workers or os.cpu_count(),
+        'lines_read': sum(file_result['lines_read'] for file_result in file_results),
+        'rows_parsed': sum(file_result['rows_parsed'] for file_result in file_results),
+        'bytes_read': sum(file_result['bytes_read'] for file_result in file_results),
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': sum(file_result['cpu_seconds'] for file_result in file_results),
+    }
+    benchmark['lines_per_second'] = benchmark['lines_read'] / wall_seconds if wall_seconds else None
+    benchmark['lines_per_core_second'] = benchmark['lines_read'] / benchmark['cpu_seconds'] if benchmark['cpu_seconds'] else None
+    return benchmark
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parse S3 server access log files and report the parsing throughput')
+    parser.add_argument('--logs', required=True, action='append', help='Log files or glob patterns, can be repeated')
+    parser.add_argument('--workers', type=int, help='Number of parsing processes, default the number of CPUs')
+    parser.add_argument('--chunk-size', type=int, default=default_chunk_bytes, help=f'Bytes of log lines parsed at once, default {default_chunk_bytes}')
+    parser.add_argument('--arrow', action='store_true', help='Build Arrow record batches, needs pyarrow')
+    args = parser.parse_args()
+
+    log_files = sorted({log_file for pattern in args.logs for log_file in glob.glob(pattern, recursive=True) if os.path.isfile(log_file)})
+    if not log_files:
+        parser.error(f'No log files match {args.logs}')
+    if args.arrow and pyarrow is None:
+        parser.error('--arrow needs pyarrow, install it with pip install pyarrow')
+    logger.info(f'Parsing {len(log_files)} log files')
+
+    benchmark = run_benchmark(log_files, args.workers, args.chunk_size, args.arrow)
+    logger.info(
+        f"{benchmark['rows_parsed']} rows of {benchmark['lines_read']} lines, {benchmark['bytes_read'] // 1024 ** 2} MiB "
+        f"in {benchmark['wall_seconds']:.2f}s with {benchmark['workers']} workers: "
+        f"{benchmark['lines_per_second']:,.0f} lines/s, {benchmark['lines_per_core_second']:,.0f} lines/s per core")
+
+
+if __name__ == '__main__':
+    main()
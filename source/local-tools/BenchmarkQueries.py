@@ -0,0 +1,164 @@
+import argparse
+import csv
+import datetime
+import logging
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import duckdb
+import GenerateLogs
+import LocalQuery
+
+
+# Benchmark every analysis of the AthenaQuery functions on generated datasets of increasing size
+# Datasets are generated once per log type and size with GenerateLogs, then every analysis runs with the
+# LocalQuery backend in its own process, so the peak memory of one analysis does not include the others.
+# Results are appended to a CSV file with a label, the git commit by default, to compare versions.
+#
+# Usage:
+#   python3 BenchmarkQueries.py --sizes 1GB,10GB,100GB --data datasets
+#   python3 BenchmarkQueries.py --sizes 1GB --log-types S3AccessLogs --analysis Latency,Latency-Percentiles --baseline 1a2b3c4
+
+
+# Set up logging
+logging.basicConfig(format='%(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel('INFO')
+
+default_sizes = '1GB,10GB,100GB'
+result_columns = ['label', 'run_time', 'log_type', 'dataset_size', 'dataset_bytes', 'dataset_records', 'analysis', 'wall_seconds', 'result_rows', 'bytes_read', 'peak_memory_bytes', 'duckdb_version']
+
+
+# Bytes read by the current process, from /proc on Linux
+def get_bytes_read():
+    try:
+        with open('/proc/self/io') as io_file:
+            for line in io_file:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def get_peak_memory():
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak_memory if sys.platform == 'darwin' else peak_memory * 1024
+
+
+# Run one analysis in a new process and return its measurements
+def run_benchmark(log_type, log_files, analysis_type, s3_bucket, query_logs_after, query_logs_before):
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(measure_analysis, (log_type, log_files, analysis_type, s3_bucket, query_logs_after, query_logs_before))
+
+
+def measure_analysis(log_type, log_files, analysis_type, s3_bucket, query_logs_after, query_logs_before):
+    query_function = LocalQuery.load_query_function(log_type, query_logs_after, query_logs_before, s3_bucket)
+    connection = duckdb.connect()
+    connection.execute('SET enable_progress_bar = false')
+    LocalQuery.create_log_view(connection, log_type, log_files)
+    with tempfile.TemporaryDirectory() as result_directory:
+        bytes_read_before = get_bytes_read()
+        start_time = time.perf_counter()
+        result_rows = LocalQuery.run_local_analysis(connection, query_function, analysis_type, s3_bucket, query_logs_after, query_logs_before,
+                                                    os.path.join(result_directory, 'result.csv'))
+        wall_seconds = time.perf_counter() - start_time
+        bytes_read_after = get_bytes_read()
+    if bytes_read_before is None or bytes_read_after is None:
+        # Without /proc every log file is read once, there is no partition pruning on local files
+        bytes_read = sum(os.path.getsize(log_file) for log_file in log_files)
+    else:
+        bytes_read = bytes_read_after - bytes_read_before
+    return {'wall_seconds': round(wall_seconds, 3), 'result_rows': result_rows, 'bytes_read': bytes_read, 'peak_memory_bytes': get_peak_memory()}
+
+
+# Label of the results, the current git commit when available
+def get_default_label():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'local'
+
+
+# Latest result of each log type, size and analysis recorded with the given label
+def read_baseline(results_path, label):
+    baseline = {}
+    if not os.path.exists(results_path):
+        return baseline
+    with open(results_path, newline='') as results_file:
+        for row in csv.DictReader(results_file):
+            if row['label'] == label:
+                baseline[(row['log_type'], row['dataset_size'], row['analysis'])] = row
+    return baseline
+
+
+def format_comparison(result, baseline_result, name):
+    if not baseline_result or not baseline_result.get(name) or not float(baseline_result[name]):
+        return ''
+    return f' ({float(result[name]) / float(baseline_result[name]):.2f}x)'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the support tool analyses on generated datasets with DuckDB')
+    parser.add_argument('--sizes', default=default_sizes, help=f'Dataset sizes separated by commas, default {default_sizes}')
+    parser.add_argument('--log-types', default='S3AccessLogs,CloudTrail', help='Log types separated by commas, default both')
+    parser.add_argument('--analysis', help='Analysis types separated by commas, default every analysis of the log type')
+    parser.add_argument('--data', default='datasets', help='Directory of the generated datasets, default datasets')
+    parser.add_argument('--results', default='benchmark-results.csv', help='CSV file the results are appended to, default benchmark-results.csv')
+    parser.add_argument('--label', help='Label of this run in the results, default the git commit')
+    parser.add_argument('--baseline', help='Label of earlier results to compare with')
+    GenerateLogs.add_generator_arguments(parser)
+    args = parser.parse_args()
+
+    overrides = GenerateLogs.generator_overrides(args)
+    label = args.label or get_default_label()
+    baseline = read_baseline(args.results, args.baseline) if args.baseline else {}
+    run_time = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    write_header = not os.path.exists(args.results)
+
+    with open(args.results, 'a', newline='') as results_file:
+        results_writer = csv.DictWriter(results_file, fieldnames=result_columns)
+        if write_header:
+            results_writer.writeheader()
+        for log_type in [log_type.strip() for log_type in args.log_types.split(',') if log_type.strip()]:
+            for dataset_size in [size.strip() for size in args.sizes.split(',') if size.strip()]:
+                size_bytes = GenerateLogs.parse_size(dataset_size)
+                dataset_path = os.path.join(args.data, f'{log_type}-{GenerateLogs.format_size(size_bytes)}')
+                dataset = GenerateLogs.read_dataset(dataset_path, log_type, size_bytes, **overrides)
+                if dataset is None:
+                    dataset = GenerateLogs.generate_dataset(log_type, size_bytes, dataset_path, **overrides)
+                log_files = sorted(os.path.join(root, file_name) for root, dirs, files in os.walk(dataset_path)
+                                   for file_name in files if file_name != GenerateLogs.dataset_file_name)
+
+                query_logs_after = dataset['start_date']
+                query_logs_before = (datetime.datetime.strptime(dataset['start_date'], '%Y-%m-%d') + datetime.timedelta(days=dataset['days'])).strftime('%Y-%m-%d')
+                query_function = LocalQuery.load_query_function(log_type, query_logs_after, query_logs_before, dataset['bucket'])
+                analysis_types = [analysis_type.strip() for analysis_type in args.analysis.split(',')] if args.analysis else list(query_function.analysis_catalogue)
+
+                for analysis_type in analysis_types:
+                    if analysis_type not in query_function.analysis_catalogue:
+                        logger.error(f'Unknown {log_type} analysis type {analysis_type}')
+                        continue
+                    result = run_benchmark(log_type, log_files, analysis_type, dataset['bucket'], query_logs_after, query_logs_before)
+                    result.update({
+                        'label': label, 'run_time': run_time, 'log_type': log_type, 'dataset_size': GenerateLogs.format_size(size_bytes),
+                        'dataset_bytes': dataset['bytes'], 'dataset_records': dataset['records'], 'analysis': analysis_type,
+                        'duckdb_version': duckdb.__version__,
+                    })
+                    results_writer.writerow(result)
+                    results_file.flush()
+                    baseline_result = baseline.get((log_type, result['dataset_size'], analysis_type))
+                    logger.info(
+                        f"{log_type} {result['dataset_size']} {analysis_type}: "
+                        f"{result['wall_seconds']}s{format_comparison(result, baseline_result, 'wall_seconds')}, "
+                        f"{result['result_rows']} rows, {result['bytes_read']} bytes read, "
+                        f"{result['peak_memory_bytes'] // 1024 ** 2} MiB peak memory{format_comparison(result, baseline_result, 'peak_memory_bytes')}")
+
+
+if __name__ == '__main__':
+    main()
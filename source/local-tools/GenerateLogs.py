@@ -0,0 +1,350 @@
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import uuid
+
+
+# Generate synthetic S3 server access log files or CloudTrail log files for local testing and benchmarks
+# The volume is set in bytes of log files written, the skew with the hot key, error, delete and lifecycle options.
+# Every file is generated from its own seed, so the same options always generate the same dataset.
+#
+# Usage:
+#   python3 GenerateLogs.py --log-type S3AccessLogs --size 1GB --output datasets/S3AccessLogs-1GB
+#   python3 GenerateLogs.py --log-type CloudTrail --size 1GB --output datasets/CloudTrail-1GB --client-error-rate 0.2
+
+
+# Set up logging
+logging.basicConfig(format='%(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel('INFO')
+
+# Description of a generated dataset, written next to the log files
+dataset_file_name = 'dataset.json'
+size_units = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+
+default_options = {
+    'start_date': '2024-01-01',
+    'days': 7,
+    'bucket': 'amzn-s3-demo-bucket',
+    'account_id': '111122223333',
+    'region': 'us-east-1',
+    'file_size': 64 * 1024 ** 2,
+    'keys': 100000,
+    'hot_keys': 0.01,
+    'hot_key_share': 0.8,
+    'client_error_rate': 0.05,
+    'server_error_rate': 0.01,
+    'delete_rate': 0.03,
+    'lifecycle_rate': 0.02,
+    'anonymous_rate': 0.01,
+    'seed': 1,
+}
+
+# Request operations, weighted
+access_log_operations = [('REST.GET.OBJECT', 70), ('REST.PUT.OBJECT', 15), ('REST.HEAD.OBJECT', 10), ('REST.GET.BUCKET', 4), ('REST.COPY.OBJECT', 1)]
+access_log_delete_operations = [('REST.DELETE.OBJECT', 80), ('REST.POST.MULTI_OBJECT_DELETE', 15), ('BATCH.DELETE.OBJECT', 5)]
+access_log_lifecycle_operations = [
+    ('S3.EXPIRE.OBJECT', 40), ('S3.CREATE.DELETEMARKER', 10), ('S3.DELETE.UPLOAD', 5),
+    ('S3.TRANSITION_SIA.OBJECT', 15), ('S3.TRANSITION_INT.OBJECT', 10), ('S3.TRANSITION_GIR.OBJECT', 5),
+    ('S3.TRANSITION_ZIA.OBJECT', 5), ('S3.TRANSITION.OBJECT', 5), ('S3.TRANSITION_GDA.OBJECT', 5),
+]
+access_log_methods = {'GET': 'GET', 'PUT': 'PUT', 'HEAD': 'HEAD', 'COPY': 'PUT', 'DELETE': 'DELETE', 'POST': 'POST'}
+client_errors = [(403, 'AccessDenied', 50), (404, 'NoSuchKey', 40), (400, 'InvalidRequest', 10)]
+server_errors = [(503, 'SlowDown', 70), (500, 'InternalError', 30)]
+
+# CloudTrail data and management events, weighted
+cloudtrail_object_events = [('GetObject', 70), ('PutObject', 15), ('HeadObject', 10), ('CopyObject', 5)]
+cloudtrail_delete_events = [('DeleteObject', 80), ('DeleteObjects', 20)]
+cloudtrail_bucket_events = [
+    ('ListObjects', 40), ('PutBucketPolicy', 10), ('PutBucketAcl', 10), ('PutBucketLifecycle', 15), ('DeleteBucketLifecycle', 5),
+    ('GetBucketAcl', 10), ('CreateBucket', 4), ('DeleteBucket', 2), ('DeleteBucketPolicy', 4),
+]
+cloudtrail_principals = 20
+# CloudTrail delivers small files every few minutes, the file size is capped for CloudTrail datasets
+cloudtrail_max_file_size = 1024 ** 2
+# Seconds between the latest record of a file and its delivery, which names the file
+access_log_delivery_delay = (60, 3600)
+cloudtrail_delivery_delay = (60, 300)
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    for unit, multiplier in size_units.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * multiplier)
+    return int(size)
+
+
+def format_size(size_bytes):
+    for unit, multiplier in reversed(list(size_units.items())):
+        if size_bytes >= multiplier and size_bytes % multiplier == 0:
+            return f'{size_bytes // multiplier}{unit}'
+    return str(size_bytes)
+
+
+def weighted_choice(rng, choices):
+    return rng.choices([choice[:-1] if len(choice) > 2 else choice[0] for choice in choices], weights=[choice[-1] for choice in choices])[0]
+
+
+# Pick an object key, the hot keys get hot_key_share of the requests
+def choose_key(rng, options):
+    hot_key_count = max(1, int(options['keys'] * options['hot_keys']))
+    if rng.random() < options['hot_key_share']:
+        key_index = rng.randrange(hot_key_count)
+    else:
+        key_index = rng.randrange(options['keys'])
+    return f'data/part-{key_index % 100:02d}/object-{key_index:08d}.bin'
+
+
+# Status code and error code of a request
+def choose_status(rng, options, success_status=200):
+    draw = rng.random()
+    if draw < options['client_error_rate']:
+        return weighted_choice(rng, client_errors)
+    if draw < options['client_error_rate'] + options['server_error_rate']:
+        return weighted_choice(rng, server_errors)
+    return success_status, None
+
+
+# S3 Server Access Logs ##########################################
+
+def access_log_line(rng, options, request_time):
+    requester = f"arn:aws:iam::{options['account_id']}:user/user-{rng.randrange(cloudtrail_principals):02d}"
+    remoteip = f'10.{rng.randrange(4)}.{rng.randrange(256)}.{rng.randrange(256)}'
+    if rng.random() < options['anonymous_rate']:
+        requester = '-'
+    draw = rng.random()
+    if draw < options['lifecycle_rate']:
+        operation = weighted_choice(rng, access_log_lifecycle_operations)
+        key = choose_key(rng, options)
+        # Lifecycle actions are performed by S3, they have no request, client or timing
+        return ' '.join([
+            options['bucketowner'], options['bucket'], f"[{request_time.strftime('%d/%b/%Y:%H:%M:%S')} +0000]",
+            '-', 'AmazonS3', uuid_hex(rng, 16), operation, key, '-', '-', '-', '-', str(rng.randrange(1, 10 ** 7)), '-', '-', '"-"', '"-"', '-',
+            host_id(rng), '-', '-', '-', '-', '-', '-', '-',
+        ])
+    if draw < options['lifecycle_rate'] + options['delete_rate']:
+        operation = weighted_choice(rng, access_log_delete_operations)
+        httpstatus, errorcode = choose_status(rng, options, 204)
+    else:
+        operation = weighted_choice(rng, access_log_operations)
+        httpstatus, errorcode = choose_status(rng, options)
+    key = '-' if operation.endswith('.BUCKET') or operation.endswith('MULTI_OBJECT_DELETE') else choose_key(rng, options)
+    method = access_log_methods[operation.split('.')[1]]
+    objectsize = rng.randrange(1, 10 ** 7)
+    bytessent = objectsize if operation == 'REST.GET.OBJECT' and httpstatus == 200 else 0
+    turnaroundtime = max(1, int(rng.lognormvariate(math.log(15), 1.0)))
+    totaltime = turnaroundtime + int(bytessent / 50000) + rng.randrange(5)
+    return ' '.join([
+        options['bucketowner'], options['bucket'], f"[{request_time.strftime('%d/%b/%Y:%H:%M:%S')} +0000]",
+        remoteip, requester, uuid_hex(rng, 16), operation, key,
+        f'"{method} /{options["bucket"]}/{key if key != "-" else ""} HTTP/1.1"', str(httpstatus), errorcode or '-',
+        str(bytessent) if bytessent else '-', str(objectsize) if key != '-' else '-', str(totaltime), str(turnaroundtime),
+        '"-"', '"aws-cli/2.15.0 Python/3.11.6 Linux/6.1 botocore/2.0"', '-', host_id(rng),
+        'SigV4', 'TLS_AES_128_GCM_SHA256', 'AuthHeader', f"{options['bucket']}.s3.{options['region']}.amazonaws.com", 'TLSv1.3', '-', '-',
+    ])
+
+
+def uuid_hex(rng, length):
+    return f'{rng.getrandbits(length * 4):0{length}X}'
+
+
+def host_id(rng):
+    return f'{rng.getrandbits(384):096x}='
+
+
+# CloudTrail Logs ################################################
+
+def cloudtrail_record(rng, options, event_time):
+    principal = rng.randrange(cloudtrail_principals)
+    user_identity = {
+        'type': 'IAMUser',
+        'principalId': f'AIDA{principal:016d}',
+        'arn': f"arn:aws:iam::{options['account_id']}:user/user-{principal:02d}",
+        'accountId': options['account_id'],
+        'accessKeyId': f'AKIA{principal:016d}',
+        'userName': f'user-{principal:02d}',
+    }
+    if rng.random() < options['anonymous_rate']:
+        user_identity = {'type': 'AWSAccount', 'principalId': '', 'accountId': 'anonymous'}
+    draw = rng.random()
+    if draw < options['lifecycle_rate']:
+        event_name = weighted_choice(rng, cloudtrail_bucket_events)
+    elif draw < options['lifecycle_rate'] + options['delete_rate']:
+        event_name = weighted_choice(rng, cloudtrail_delete_events)
+    else:
+        event_name = weighted_choice(rng, cloudtrail_object_events)
+    request_parameters = {'bucketName': options['bucket'], 'Host': f"{options['bucket']}.s3.{options['region']}.amazonaws.com"}
+    resources = [{'type': 'AWS::S3::Bucket', 'ARN': f"arn:aws:s3:::{options['bucket']}"}]
+    if event_name in [event for event, weight in cloudtrail_object_events] or event_name == 'DeleteObject':
+        request_parameters['key'] = choose_key(rng, options)
+        resources.insert(0, {'type': 'AWS::S3::Object', 'ARN': f"arn:aws:s3:::{options['bucket']}/{request_parameters['key']}"})
+    httpstatus, errorcode = choose_status(rng, options)
+    record = {
+        'eventVersion': '1.09',
+        'userIdentity': user_identity,
+        'eventTime': event_time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'eventSource': 's3.amazonaws.com',
+        'eventName': event_name,
+        'awsRegion': options['region'],
+        'sourceIPAddress': f'10.{rng.randrange(4)}.{rng.randrange(256)}.{rng.randrange(256)}',
+        'userAgent': '[aws-cli/2.15.0 Python/3.11.6 Linux/6.1 botocore/2.0]',
+        'requestParameters': request_parameters,
+        'responseElements': None,
+        'additionalEventData': {
+            'SignatureVersion': 'SigV4',
+            'CipherSuite': 'TLS_AES_128_GCM_SHA256',
+            'bytesTransferredIn': 0,
+            'bytesTransferredOut': rng.randrange(10 ** 7) if event_name == 'GetObject' and errorcode is None else 0,
+            'AuthenticationMethod': 'AuthHeader',
+            'x-amz-id-2': host_id(rng),
+        },
+        'requestID': uuid_hex(rng, 16),
+        'eventID': str(uuid.UUID(int=rng.getrandbits(128))),
+        'readOnly': event_name.startswith(('Get', 'Head', 'List')),
+        'resources': resources,
+        'eventType': 'AwsApiCall',
+        'managementEvent': 'Bucket' in event_name,
+        'recipientAccountId': options['account_id'],
+        'eventCategory': 'Management' if 'Bucket' in event_name else 'Data',
+    }
+    if errorcode:
+        record['errorCode'] = errorcode
+        record['errorMessage'] = {'AccessDenied': 'Access Denied', 'NoSuchKey': 'The specified key does not exist.'}.get(errorcode, errorcode)
+    return record
+
+
+# Dataset ########################################################
+
+# Path of a log file, named like the files S3 and CloudTrail deliver
+def log_file_path(options, file_index, file_time):
+    if options['log_type'] == 'CloudTrail':
+        return os.path.join(
+            'AWSLogs', options['account_id'], 'CloudTrail', options['region'], file_time.strftime('%Y/%m/%d'),
+            f"{options['account_id']}_CloudTrail_{options['region']}_{file_time.strftime('%Y%m%dT%H%MZ')}_{file_index:08X}.json.gz")
+    return os.path.join('logs', f"{file_time.strftime('%Y-%m-%d-%H-%M-%S')}-{file_index:016X}")
+
+
+# Write one log file, its requests are spread over the file's share of the time window
+# The file is named after its delivery, a delay after its latest record, as S3 and CloudTrail never deliver a record early
+def generate_log_file(options, file_index):
+    rng = random.Random(options['seed'] * 1000003 + file_index)
+    window_start = datetime.datetime.strptime(options['start_date'], '%Y-%m-%d')
+    file_seconds = options['days'] * 86400 / options['file_count']
+    file_start = window_start + datetime.timedelta(seconds=file_index * file_seconds)
+    partial_path = os.path.join(options['output'], f'.partial-{file_index:016X}')
+
+    records = 0
+    latest_time = file_start
+    with open(partial_path, 'wb') as raw_file:
+        if options['log_type'] == 'CloudTrail':
+            with gzip.GzipFile(fileobj=raw_file, mode='wb', compresslevel=6) as log_file:
+                log_file.write(b'{"Records":[')
+                while raw_file.tell() < options['file_size']:
+                    event_time = file_start + datetime.timedelta(seconds=rng.random() * file_seconds)
+                    latest_time = max(latest_time, event_time)
+                    log_file.write((',' if records else '').encode() + json.dumps(cloudtrail_record(rng, options, event_time)).encode())
+                    records += 1
+                log_file.write(b']}')
+        else:
+            while raw_file.tell() < options['file_size']:
+                # Write in blocks, tell() is only checked between blocks
+                block = []
+                for _ in range(1000):
+                    request_time = file_start + datetime.timedelta(seconds=rng.random() * file_seconds)
+                    latest_time = max(latest_time, request_time)
+                    block.append(access_log_line(rng, options, request_time))
+                raw_file.write(('\n'.join(block) + '\n').encode())
+                records += len(block)
+        file_bytes = raw_file.tell()
+
+    delivery_delay = cloudtrail_delivery_delay if options['log_type'] == 'CloudTrail' else access_log_delivery_delay
+    delivery_time = latest_time.replace(microsecond=0) + datetime.timedelta(seconds=rng.randrange(*delivery_delay))
+    path = os.path.join(options['output'], log_file_path(options, file_index, delivery_time))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(partial_path, path)
+    return records, file_bytes
+
+
+def generate_dataset(log_type, size, output, **overrides):
+    options = dict(default_options, **{name: value for name, value in overrides.items() if value is not None})
+    options.update({'log_type': log_type, 'size': size, 'output': output})
+    options['bucketowner'] = f"{random.Random(options['seed']).getrandbits(256):064x}"
+    options['file_size'] = min(options['file_size'], size, cloudtrail_max_file_size if log_type == 'CloudTrail' else size)
+    options['file_count'] = max(1, math.ceil(size / options['file_size']))
+    logger.info(f"Generating {format_size(size)} of {log_type} logs in {options['file_count']} files under {output}")
+
+    # Files of an earlier dataset would be read with the new files
+    if os.path.exists(os.path.join(output, dataset_file_name)):
+        raise ValueError(f'{output} already holds a generated dataset, remove it first')
+    os.makedirs(output, exist_ok=True)
+    with multiprocessing.Pool(options.get('workers') or os.cpu_count()) as pool:
+        file_results = pool.starmap(generate_log_file, [(options, file_index) for file_index in range(options['file_count'])])
+
+    dataset = dict(options, records=sum(records for records, file_bytes in file_results), bytes=sum(file_bytes for records, file_bytes in file_results))
+    with open(os.path.join(output, dataset_file_name), 'w') as dataset_file:
+        json.dump(dataset, dataset_file, indent=2)
+    logger.info(f"Generated {dataset['records']} records, {dataset['bytes']} bytes")
+    return dataset
+
+
+# Return the description of a dataset, or None when it was not generated with the same options
+def read_dataset(output, log_type, size, **overrides):
+    try:
+        with open(os.path.join(output, dataset_file_name)) as dataset_file:
+            dataset = json.load(dataset_file)
+    except (OSError, ValueError):
+        return None
+    options = dict(default_options, **{name: value for name, value in overrides.items() if value is not None})
+    options.update({'log_type': log_type, 'size': size})
+    if any(dataset.get(name) != value for name, value in options.items() if name not in ['file_size', 'workers']):
+        return None
+    return dataset
+
+
+def add_generator_arguments(parser):
+    parser.add_argument('--start-date', help=f"First day of the logs, YYYY-MM-DD, default {default_options['start_date']}")
+    parser.add_argument('--days', type=int, help=f"Number of days of logs, default {default_options['days']}")
+    parser.add_argument('--bucket', help=f"Bucket name in the logs, default {default_options['bucket']}")
+    parser.add_argument('--keys', type=int, help=f"Number of distinct object keys, default {default_options['keys']}")
+    parser.add_argument('--hot-keys', type=float, help=f"Share of the keys that are hot, default {default_options['hot_keys']}")
+    parser.add_argument('--hot-key-share', type=float, help=f"Share of the requests to the hot keys, default {default_options['hot_key_share']}")
+    parser.add_argument('--client-error-rate', type=float, help=f"Share of 4xx responses, default {default_options['client_error_rate']}")
+    parser.add_argument('--server-error-rate', type=float, help=f"Share of 5xx responses, default {default_options['server_error_rate']}")
+    parser.add_argument('--delete-rate', type=float, help=f"Share of delete requests, default {default_options['delete_rate']}")
+    parser.add_argument('--lifecycle-rate', type=float, help=f"Share of lifecycle actions, bucket configuration events for CloudTrail, default {default_options['lifecycle_rate']}")
+    parser.add_argument('--anonymous-rate', type=float, help=f"Share of anonymous requests, default {default_options['anonymous_rate']}")
+    parser.add_argument('--seed', type=int, help=f"Random seed, default {default_options['seed']}")
+    parser.add_argument('--file-size', help='Size of each log file, default 64MB')
+    parser.add_argument('--workers', type=int, help='Number of processes writing files, default the number of CPUs')
+
+
+def generator_overrides(args):
+    return {
+        'start_date': args.start_date, 'days': args.days, 'bucket': args.bucket, 'keys': args.keys,
+        'hot_keys': args.hot_keys, 'hot_key_share': args.hot_key_share,
+        'client_error_rate': args.client_error_rate, 'server_error_rate': args.server_error_rate,
+        'delete_rate': args.delete_rate, 'lifecycle_rate': args.lifecycle_rate, 'anonymous_rate': args.anonymous_rate,
+        'seed': args.seed, 'workers': args.workers,
+        'file_size': parse_size(args.file_size) if args.file_size else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic S3 server access log or CloudTrail log files')
+    parser.add_argument('--log-type', choices=['CloudTrail', 'S3AccessLogs'], required=True)
+    parser.add_argument('--size', required=True, help='Total size of the log files, for example 500MB or 10GB')
+    parser.add_argument('--output', required=True, help='Directory of the generated dataset')
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+    generate_dataset(args.log_type, parse_size(args.size), args.output, **generator_overrides(args))
+
+
+if __name__ == '__main__':
+    main()
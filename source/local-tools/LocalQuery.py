@@ -0,0 +1,212 @@
+import argparse
+import glob
+import importlib.util
+import logging
+import os
+import re
+import duckdb
+
+
+# Run the analyses of the AthenaQuery functions on local log files with DuckDB
+# The analysis catalogue is loaded from the function code, so local results use the same queries and result
+# columns as Athena. Only a few Athena (Trino) functions are translated by the dialect layer below.
+#
+# Usage:
+#   python3 LocalQuery.py --log-type S3AccessLogs --logs 'logs/*' --analysis ClientError-4xx,Latency-Percentiles --after 2024-01-01 --before 2024-01-08
+#   python3 LocalQuery.py --log-type CloudTrail --logs 'cloudtrail/**/*.json.gz' --analysis AccessDenied --after 2024-01-01 --before 2024-01-08
+
+
+# Set up logging
+logging.basicConfig(format='%(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel('INFO')
+
+# Function code of each log type
+function_codes_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'function-codes')
+query_function_paths = {
+    'S3AccessLogs': os.path.join(function_codes_path, 'server-access-log', 'AthenaQuery.py'),
+    'CloudTrail': os.path.join(function_codes_path, 'cloudtrail-logs', 'AthenaQuery.py'),
+}
+
+# The local table the analyses read, in place of the Glue database and table
+local_schema = 'main'
+local_table = 'logs'
+
+# Environment of the query function, only the Glue names and the analysis window are used by the query builder
+query_function_environment = {
+    'AWS_REGION': 'us-east-1',
+    'glue_db': local_schema,
+    'glue_tbl': local_table,
+    'glue_rollup_tbl': f'{local_table}_rollup',
+    'glue_in_place_tbl': '',
+    'workgroup_name': 'local',
+    's3_bucket': '',
+    'query_analysis_type': '',
+    'query_logs_before': '',
+    'query_logs_after': '',
+    'tool_bucket': 'local',
+    'batch_ops_report_prefix': 'local',
+    'query_cache_prefix': 'local',
+    'rollup_state_key': 'local',
+    'report_function': 'local',
+    'max_concurrent_queries': '1',
+    'preview_sample_percent': '0',
+    'sns_topic_arn': 'local',
+    'result_format': 'CSV',
+    'unload_prefix': 'local',
+}
+
+# S3 server access log line, the same expression as the RegexSerDe of the raw Glue table
+access_log_regex = r'([^ ]*) ([^ ]*) \[(.*?)\] ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ("[^"]*"|-) (-|[0-9]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ("[^"]*"|-) ([^ ]*)(?: ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*))?.*$'
+access_log_columns = ['bucketowner', 'bucket_name', 'requestdatetime', 'remoteip', 'requester', 'requestid', 'operation', 'key', 'request_uri', 'httpstatus', 'errorcode', 'bytessent', 'objectsize', 'totaltime', 'turnaroundtime', 'referrer', 'useragent', 'versionid', 'hostid', 'sigv', 'ciphersuite', 'authtype', 'endpoint', 'tlsversion', 'accesspointarn', 'aclrequired']
+# Each CloudTrail log file is read as one JSON object
+cloudtrail_max_file_bytes = 1024 ** 3
+
+# Dialect layer, Athena SQL generated by the query builder rewritten for DuckDB
+dialect_rewrites = [
+    # IF(condition, value) without an else value
+    (re.compile(r"\bIF\(([^,()]+), ('[^']*')\)"), r'CASE WHEN \1 THEN \2 END'),
+    (re.compile(r'\barray_join\('), 'array_to_string('),
+    (re.compile(r'\bapprox_percentile\('), 'approx_quantile('),
+    (re.compile(r'\bjson_extract_scalar\('), 'json_extract_string('),
+    # Heavy hitter candidates, approx_top_k returns the values of the frequency sketch without their counts
+    (re.compile(r'\bmap_keys\(approx_most_frequent\(([0-9]+), ([a-z_]+), [0-9]+\)\)'), r'approx_top_k(\2, \1)'),
+    (re.compile(r'\bcontains\('), 'list_contains('),
+    # Preview queries, DuckDB samples whole vectors with SYSTEM, rows are sampled instead to preview small local files
+    (re.compile(r'TABLESAMPLE SYSTEM \(([0-9.]+)\)'), r'TABLESAMPLE BERNOULLI (\1 PERCENT)'),
+    # Calendar of the LifecycleActionStatistics-Daily analysis
+    (re.compile(r"\bsequence\((CAST\('[0-9-]+' AS date\)), date_add\('day', -1, (CAST\('[0-9-]+' AS date\))\)\)"), r'CAST(generate_series(\1, \2 - INTERVAL 1 DAY, INTERVAL 1 DAY) AS DATE[])'),
+]
+
+
+def load_query_function(log_type, query_logs_after, query_logs_before, s3_bucket):
+    os.environ.update(query_function_environment)
+    os.environ.update({'query_logs_after': query_logs_after, 'query_logs_before': query_logs_before, 's3_bucket': s3_bucket or ''})
+    module_spec = importlib.util.spec_from_file_location(f'AthenaQuery{log_type}', query_function_paths[log_type])
+    query_function = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(query_function)
+    return query_function
+
+
+def to_local_dialect(query_string):
+    for pattern, replacement in dialect_rewrites:
+        query_string = pattern.sub(replacement, query_string)
+    return query_string.strip().rstrip(';')
+
+
+# Typed view of S3 server access log files, the same columns as the Parquet table of the conversion function
+# Server access logs are written in UTC, so the +0000 offset of the request time is dropped
+def create_access_log_view(connection, log_files):
+    connection.execute(f"""
+    CREATE VIEW {local_schema}.{local_table} AS
+    SELECT bucketowner, bucket_name,
+    try_strptime(split_part(requestdatetime, ' ', 1), '%d/%b/%Y:%H:%M:%S') AS requestdatetime,
+    remoteip, requester, requestid, operation, key, request_uri,
+    TRY_CAST(httpstatus AS INTEGER) AS httpstatus,
+    errorcode,
+    TRY_CAST(bytessent AS BIGINT) AS bytessent,
+    TRY_CAST(objectsize AS BIGINT) AS objectsize,
+    TRY_CAST(totaltime AS INTEGER) AS totaltime,
+    TRY_CAST(turnaroundtime AS INTEGER) AS turnaroundtime,
+    referrer, useragent, versionid, hostid, sigv, ciphersuite, authtype, endpoint, tlsversion, accesspointarn, aclrequired,
+    strftime(try_strptime(split_part(requestdatetime, ' ', 1), '%d/%b/%Y:%H:%M:%S'), '%Y-%m-%d') AS dt
+    FROM (
+        SELECT unnest(regexp_extract(line, $access_log_regex, $access_log_columns))
+        FROM read_csv($log_files, columns={{'line': 'VARCHAR'}}, delim='\\x01', quote='', escape='', header=false, auto_detect=false)
+    )
+    """.replace('$access_log_regex', sql_literal(access_log_regex)).replace('$access_log_columns', sql_list(access_log_columns)).replace('$log_files', sql_list(log_files)))
+
+
+# View of the S3 events of CloudTrail log files, the same columns as the Parquet table of the conversion function
+def create_cloudtrail_view(connection, log_files):
+    connection.execute(f"""
+    CREATE VIEW {local_schema}.{local_table} AS
+    SELECT eventtime, eventsource, eventname, awsregion, sourceipaddress, useragent, userarn, accountid, useridentitytype, errorcode, errormessage,
+    json_extract_string(requestparameters, '$.bucketName') AS bucketname,
+    json_extract_string(requestparameters, '$.key') AS objectkey,
+    CAST(TRY_CAST(json_extract_string(additionaleventdata, '$.bytesTransferredOut') AS DOUBLE) AS BIGINT) AS bytestransferredout,
+    requestid, eventid, readonly, requestparameters, additionaleventdata,
+    strftime(eventtime, '%Y-%m-%d') AS dt
+    FROM (
+        SELECT
+        try_strptime(json_extract_string(record, '$.eventTime'), '%Y-%m-%dT%H:%M:%SZ') AS eventtime,
+        json_extract_string(record, '$.eventSource') AS eventsource,
+        json_extract_string(record, '$.eventName') AS eventname,
+        json_extract_string(record, '$.awsRegion') AS awsregion,
+        json_extract_string(record, '$.sourceIPAddress') AS sourceipaddress,
+        json_extract_string(record, '$.userAgent') AS useragent,
+        json_extract_string(record, '$.userIdentity.arn') AS userarn,
+        json_extract_string(record, '$.userIdentity.accountId') AS accountid,
+        json_extract_string(record, '$.userIdentity.type') AS useridentitytype,
+        json_extract_string(record, '$.errorCode') AS errorcode,
+        json_extract_string(record, '$.errorMessage') AS errormessage,
+        json_extract_string(record, '$.requestID') AS requestid,
+        json_extract_string(record, '$.eventID') AS eventid,
+        json_extract_string(record, '$.readOnly') AS readonly,
+        CAST(json_extract(record, '$.requestParameters') AS VARCHAR) AS requestparameters,
+        CAST(json_extract(record, '$.additionalEventData') AS VARCHAR) AS additionaleventdata
+        FROM (
+            SELECT unnest(Records) AS record
+            FROM read_json($log_files, columns={{'Records': 'JSON[]'}}, format='auto', maximum_object_size=$maximum_object_size)
+        )
+    )
+    WHERE eventsource = 's3.amazonaws.com' AND eventtime IS NOT NULL
+    """.replace('$log_files', sql_list(log_files)).replace('$maximum_object_size', str(cloudtrail_max_file_bytes)))
+
+
+def sql_literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def sql_list(values):
+    return '[' + ', '.join(sql_literal(value) for value in values) + ']'
+
+
+# Create the local logs view of the given log type
+def create_log_view(connection, log_type, log_files):
+    if log_type == 'CloudTrail':
+        create_cloudtrail_view(connection, log_files)
+    else:
+        create_access_log_view(connection, log_files)
+
+
+# Run one analysis and write its result CSV file, returns the number of result rows or None for an unknown analysis
+def run_local_analysis(connection, query_function, analysis_type, s3_bucket, query_logs_after, query_logs_before, result_path, sample_percent=None):
+    query_string = query_function.build_analysis_query(analysis_type, s3_bucket, query_logs_after, query_logs_before, sample_percent=sample_percent)
+    if not query_string:
+        logger.error(f'Unknown analysis type {analysis_type}')
+        return None
+    return connection.execute(f"COPY ({to_local_dialect(query_string)}) TO {sql_literal(result_path)} (HEADER, DELIMITER ',')").fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the support tool analyses on local log files with DuckDB')
+    parser.add_argument('--log-type', choices=sorted(query_function_paths), required=True)
+    parser.add_argument('--logs', required=True, action='append', help='Log files or glob patterns, can be repeated')
+    parser.add_argument('--analysis', required=True, help='One or more analysis types separated by commas')
+    parser.add_argument('--after', required=True, help='Include logs AFTER this date, YYYY-MM-DD')
+    parser.add_argument('--before', required=True, help='Include logs BEFORE this date, YYYY-MM-DD')
+    parser.add_argument('--bucket', default='', help='Limit the analyses to this bucket')
+    parser.add_argument('--output', default='.', help='Directory of the result CSV files')
+    parser.add_argument('--sample-percent', type=float, help='Run the preview queries on this percent of the logs')
+    args = parser.parse_args()
+
+    log_files = sorted({log_file for pattern in args.logs for log_file in glob.glob(pattern, recursive=True) if os.path.isfile(log_file)})
+    if not log_files:
+        parser.error(f'No log files match {args.logs}')
+    logger.info(f'Reading {len(log_files)} log files')
+
+    query_function = load_query_function(args.log_type, args.after, args.before, args.bucket)
+    connection = duckdb.connect()
+    create_log_view(connection, args.log_type, log_files)
+
+    os.makedirs(args.output, exist_ok=True)
+    for analysis_type in [analysis_type.strip() for analysis_type in args.analysis.split(',') if analysis_type.strip()]:
+        result_path = os.path.join(args.output, f"{analysis_type.replace('*', 'all')}.csv")
+        result_rows = run_local_analysis(connection, query_function, analysis_type, args.bucket, args.after, args.before, result_path, args.sample_percent)
+        if result_rows is not None:
+            logger.info(f'{analysis_type}: {result_rows} rows in {result_path}')
+
+
+if __name__ == '__main__':
+    main()